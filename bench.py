@@ -0,0 +1,940 @@
+#!/usr/bin/env python3
+
+# Copyright Red Hat
+#
+# createhdds is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for createhdds.py. Run from the createhdds checkout (or
+anywhere - like createhdds.py itself, we find hdds.json next to the
+script). Each benchmark prints its results as JSON on stdout.
+
+The 'offline' benchmark doesn't need KVM, libguestfs, libvirt or the
+network: it swaps in stand-in backends for guestfs, libvirt, virt-
+install and osinfo-query (see install_fakes()) with configurable
+simulated latencies, so it measures createhdds' own planning and
+scheduling overhead. guestfs images that don't need an appliance are
+built for real with mke2fs, though.
+
+The 'engines' benchmark builds the guestfs images that can be built
+without an appliance both ways, and checks the results match.
+
+The 'profiles' benchmark installs a virt-install image with each disk
+profile (see DISK_PROFILES in createhdds) and reports how long each
+install took. It needs a working libvirt and virt-install.
+
+The 'refresh' benchmark simulates a run of nightly 'all' runs, with and
+without --budget, starting from every image having been built on the
+same day, and reports how much each night rebuilds. Nothing is really
+built; it just needs the kickstarts.
+
+The 'startup' benchmark times how long 'createhdds.py check' takes to
+run as a fresh process, as monitoring runs it, against the time just
+starting Python and importing createhdds take.
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import uuid
+import zlib
+
+# imported by load_createhdds(), as the offline benchmark has to set
+# up the fake backends before createhdds imports them
+createhdds = None
+
+logger = logging.getLogger('createhdds.bench')
+
+# default simulated latencies (in seconds) for the fake backends
+DEFAULT_LATENCIES = {
+    'launch': 0.05,
+    'disk_create': 0.0,
+    'part_add': 0.0,
+    'mkfs': 0.01,
+    'mount': 0.0,
+    'write': 0.0,
+    'tar_in': 0.0,
+    'shutdown': 0.01,
+    'virt-install': 0.2,
+    'osinfo-query': 0.02,
+    'libvirt-open': 0.005,
+}
+
+
+def load_createhdds():
+    """Import createhdds (once)."""
+    global createhdds
+    if createhdds is None:
+        createhdds = importlib.import_module('createhdds')
+    return createhdds
+
+
+class FakeGuestFS(object):
+    """Stand-in for guestfs.GuestFS. Keeps track of drives, partitions
+    and mounts just well enough for GuestfsImage.populate(), creates
+    the (sparse) disk files, and sleeps for the configured latency in
+    each operation.
+    """
+    latencies = {}
+
+    def __init__(self, **_):
+        self.drives = []
+        self.parts = {}
+
+    def _wait(self, operation):
+        time.sleep(self.latencies.get(operation, 0))
+
+    def disk_create(self, path, _fmt, size, **_):
+        self._wait('disk_create')
+        with open(path, 'wb') as disk:
+            disk.truncate(size)
+
+    def add_drive_opts(self, path, **_):
+        self.drives.append(path)
+
+    def launch(self):
+        self._wait('launch')
+
+    def list_devices(self):
+        return ["/dev/sd{0}".format(chr(ord('a') + num)) for num in range(len(self.drives))]
+
+    def part_init(self, disk, _label):
+        self.parts[disk] = []
+
+    def part_add(self, disk, _type, start, end):
+        self._wait('part_add')
+        self.parts[disk].append((start, end))
+
+    def list_partitions(self):
+        return ["{0}{1}".format(disk, num) for disk in sorted(self.parts)
+                for num in range(1, len(self.parts[disk]) + 1)]
+
+    def part_to_dev(self, partition):
+        return partition.rstrip('0123456789')
+
+    def part_list(self, disk):
+        return [{'part_num': num, 'part_start': start * 512, 'part_end': end * 512}
+                for (num, (start, end)) in enumerate(self.parts[disk], 1)]
+
+    def part_set_gpt_type(self, *_):
+        pass
+
+    def mkfs(self, *_, **__):
+        self._wait('mkfs')
+
+    def mount(self, *_):
+        self._wait('mount')
+
+    def write(self, *_):
+        self._wait('write')
+
+    def tar_in(self, *_, **__):
+        self._wait('tar_in')
+
+    def umount_opts(self, *_, **__):
+        pass
+
+    def umount_all(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def shutdown(self):
+        self._wait('shutdown')
+
+    def close(self):
+        pass
+
+
+class FakeLibvirtError(Exception):
+    """Stand-in for libvirt.libvirtError."""
+
+
+class FakeDomain(object):
+    """Stand-in for a libvirt domain defined by the fake virt-install.
+    Domains are marker files in the fake libvirt state directory, so
+    the virt-install script (a separate process) can define them.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def name(self):
+        return os.path.basename(self.path)
+
+    def destroy(self):
+        with open(self.path, 'w') as markfh:
+            markfh.write('shutoff')
+
+    def undefineFlags(self, _flags):
+        for path in (self.path, self.path + '.disk'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def state(self):
+        try:
+            with open(self.path, 'r') as markfh:
+                running = markfh.read() == 'running'
+        except OSError:
+            raise FakeLibvirtError("Domain not found: {0}".format(self.name()))
+        if running:
+            return [FakeLibvirt.VIR_DOMAIN_RUNNING, 1]
+        return [FakeLibvirt.VIR_DOMAIN_SHUTOFF, 0]
+
+    def blockStats(self, path):
+        # like libvirt, only the disk path virt-install was given (made
+        # absolute) will do
+        with open(self.path + '.disk', 'r') as diskfh:
+            if path != diskfh.read():
+                raise FakeLibvirtError("invalid path {0} not assigned to domain".format(path))
+        # the 'guest' is always writing something
+        return (0, 0, 0, int(time.time() * 1000), 0)
+
+    def interfaceStats(self, _dev):
+        return (0,) * 8
+
+    def XMLDesc(self, _flags):
+        return "<domain><devices/></domain>"
+
+    def info(self):
+        return [self.state()[0], 0, 0, 1, 0]
+
+
+class FakeConnection(object):
+    """Stand-in for a libvirt connection."""
+    def __init__(self, statedir):
+        self.statedir = statedir
+
+    def lookupByName(self, name):
+        path = os.path.join(self.statedir, name)
+        if not os.path.exists(path):
+            raise FakeLibvirtError("Domain not found: {0}".format(name))
+        return FakeDomain(path)
+
+    def isAlive(self):
+        return True
+
+    def domainEventRegisterAny(self, _dom, _event, _callback, _opaque):
+        return 1
+
+    def domainEventDeregisterAny(self, _callbackid):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeLibvirt(types.ModuleType):
+    """Stand-in for the libvirt module."""
+    VIR_DOMAIN_RUNNING = 1
+    VIR_DOMAIN_PAUSED = 3
+    VIR_DOMAIN_SHUTOFF = 5
+    VIR_DOMAIN_CRASHED = 6
+    VIR_DOMAIN_PAUSED_IOERROR = 5
+    VIR_DOMAIN_UNDEFINE_NVRAM = 4
+    VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+    VIR_DOMAIN_EVENT_SUSPENDED = 3
+    VIR_DOMAIN_EVENT_CRASHED = 8
+    VIR_DOMAIN_EVENT_SUSPENDED_IOERROR = 2
+    libvirtError = FakeLibvirtError
+
+    def __init__(self, statedir, latency):
+        super(FakeLibvirt, self).__init__('libvirt')
+        self.statedir = statedir
+        self.latency = latency
+
+    def open(self, *_):
+        time.sleep(self.latency)
+        return FakeConnection(self.statedir)
+
+    def virEventRegisterDefaultImpl(self):
+        pass
+
+    def virEventRunDefaultImpl(self):
+        time.sleep(1)
+
+
+# the fake virt-install: creates the disk file and 'defines' the domain
+FAKE_VIRTINSTALL = """#!{python}
+import os, sys, time
+args = sys.argv[1:]
+disk = dict(opt.split('=', 1) for opt in args[args.index('--disk') + 1].split(','))
+with open(disk['path'], 'wb') as diskfh:
+    diskfh.truncate(int(float(disk.get('size', 1)) * 1024 * 1024 * 1024))
+domain = os.path.join({statedir!r}, args[args.index('--name') + 1])
+with open(domain + '.disk', 'w') as diskfh:
+    diskfh.write(os.path.abspath(disk['path']))
+with open(domain, 'w') as markfh:
+    markfh.write('running')
+time.sleep({latency})
+with open(domain, 'w') as markfh:
+    markfh.write('shutoff')
+"""
+
+# the fake osinfo-query: claims to know whatever short-id is asked for
+FAKE_OSINFO = """#!{python}
+import sys, time
+time.sleep({latency})
+print(" Short ID ")
+print(" " + sys.argv[-1].split('=', 1)[1] + " | Fake OS")
+"""
+
+def install_fakes(workdir, latencies):
+    """Set up the fake backends: put fake guestfs and libvirt modules
+    in sys.modules, and fake virt-install and osinfo-query commands at
+    the front of $PATH. Must be called before createhdds is imported.
+    """
+    FakeGuestFS.latencies = latencies
+    sys.modules['guestfs'] = types.ModuleType('guestfs')
+    sys.modules['guestfs'].GuestFS = FakeGuestFS
+    statedir = os.path.join(workdir, 'libvirt')
+    bindir = os.path.join(workdir, 'bin')
+    os.makedirs(statedir)
+    os.makedirs(bindir)
+    sys.modules['libvirt'] = FakeLibvirt(statedir, latencies.get('libvirt-open', 0))
+    scripts = (('virt-install', FAKE_VIRTINSTALL), ('osinfo-query', FAKE_OSINFO))
+    for (name, template) in scripts:
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as script:
+            script.write(template.format(python=sys.executable, statedir=statedir,
+                                         latency=latencies.get(name, 0)))
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = os.pathsep.join((bindir, os.environ.get('PATH', '')))
+
+def synthetic_hdds(scriptdir, guestfs_groups, virtinstall_groups):
+    """Make a synthetic hdds dict with the given numbers of guestfs and
+    virt-install image groups, by cycling through the real groups in
+    hdds.json and renaming the copies. The kickstarts and upload files
+    the copies need are created in 'scriptdir'.
+    """
+    real = _load_hdds()
+    hdds = {'guestfs': [], 'virtinstall': [], 'renames': []}
+    os.makedirs(os.path.join(scriptdir, 'uploads'))
+    for upload in os.listdir(os.path.join(createhdds.SCRIPTDIR, 'uploads')):
+        shutil.copy(os.path.join(createhdds.SCRIPTDIR, 'uploads', upload),
+                    os.path.join(scriptdir, 'uploads'))
+    for num in range(guestfs_groups):
+        grp = json.loads(json.dumps(real['guestfs'][num % len(real['guestfs'])]))
+        grp['name'] = "{0}-{1}".format(grp['name'], num)
+        hdds['guestfs'].append(grp)
+    with open(os.path.join(createhdds.SCRIPTDIR, 'minimal.ks'), 'r') as ksfh:
+        kickstart = ksfh.read()
+    for num in range(virtinstall_groups):
+        grp = json.loads(json.dumps(real['virtinstall'][num % len(real['virtinstall'])]))
+        grp['name'] = "{0}-{1}".format(grp['name'], num)
+        hdds['virtinstall'].append(grp)
+        with open(os.path.join(scriptdir, "{0}.ks".format(grp['name'])), 'w') as ksfh:
+            ksfh.write(kickstart)
+    return hdds
+
+def _timeit(func, repeat):
+    """Run func() 'repeat' times, returning timing stats in seconds."""
+    runs = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        func()
+        runs.append(time.monotonic() - start)
+    return {'min': min(runs), 'mean': statistics.mean(runs), 'runs': runs}
+
+def bench_offline(args):
+    """Time createhdds' planning and scheduling with fake backends:
+    get_all_images() and check() over a synthetic hdds.json, the
+    planning part of 'all' (everything but the actual builds), and
+    building a sample of images with the fake backends.
+    """
+    latencies = dict(DEFAULT_LATENCIES)
+    for spec in args.latency or []:
+        (name, value) = spec.split('=', 1)
+        latencies[name] = float(value)
+    olddir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='createhdds-bench-')
+    try:
+        install_fakes(workdir, latencies)
+        load_createhdds()
+        scriptdir = os.path.join(workdir, 'scripts')
+        imgdir = os.path.join(workdir, 'images')
+        os.makedirs(imgdir)
+        hdds = synthetic_hdds(scriptdir, args.guestfs_groups, args.virtinstall_groups)
+        with open(os.path.join(scriptdir, 'hdds.json'), 'w') as hddsfh:
+            json.dump(hdds, hddsfh)
+        createhdds.SCRIPTDIR = scriptdir
+        createhdds.OSINFO_CACHE = os.path.join(workdir, 'osinfo.json')
+        os.chdir(imgdir)
+
+        results = {}
+        expected = createhdds.get_all_images(hdds)
+        results['get_all_images'] = _timeit(lambda: createhdds.get_all_images(hdds), args.repeat)
+        # make every other image 'present', so check() has some of
+        # everything to do, and record half of those in the manifest
+        for (num, img) in enumerate(expected):
+            if num % 2:
+                open(img.filename, 'w').close()
+                if num % 4 == 1:
+                    img.record()
+        results['check'] = _timeit(lambda: createhdds.check(hdds), args.repeat)
+
+        # the planning part of 'all' is everything except the builds.
+        # the preflight checks are run, but as the synthetic images
+        # would never fit on the disk, their verdict is ignored
+        planned = []
+        realbuild = createhdds.build_images
+        realpreflight = createhdds.run_preflight
+        createhdds.build_images = lambda imgs, _: planned.append(len(imgs))
+        createhdds.run_preflight = lambda imgs, args, **_: createhdds.preflight(imgs, args)
+        try:
+            allargs = createhdds.parse_args(hdds, ['all'])
+            results['all_planning'] = _timeit(lambda: createhdds.cli_all(allargs, hdds),
+                                              args.repeat)
+        finally:
+            createhdds.build_images = realbuild
+            createhdds.run_preflight = realpreflight
+        results['all_planning']['images'] = planned[-1]
+
+        # now actually build a sample of images with the fake backends
+        gfsimgs = [img for img in expected if isinstance(img, createhdds.GuestfsImage)]
+        viimgs = [img for img in expected if isinstance(img, createhdds.VirtInstallImage)
+                  and img.arch in createhdds.supported_arches()]
+        sample = gfsimgs[:args.build_guestfs] + viimgs[:args.build_virtinstall]
+        buildargs = createhdds.parse_args(hdds, ['-j', str(args.jobs), '--logdir', workdir,
+                                                 'all'])
+        def _build():
+            for img in sample:
+                if os.path.exists(img.filename):
+                    os.remove(img.filename)
+            createhdds.build_images(sample, buildargs)
+        createhdds.METRICS = createhdds.Metrics()
+        results['build'] = _timeit(_build, args.repeat)
+        results['build']['images'] = len(sample)
+        # where the build time went, per phase, summed over all runs
+        phases = {}
+        for event in createhdds.METRICS.spans:
+            phases[event['phase']] = phases.get(event['phase'], 0) + event['duration']
+        results['build']['phases'] = {phase: round(duration, 4)
+                                      for (phase, duration) in sorted(phases.items())}
+    finally:
+        os.chdir(olddir)
+        shutil.rmtree(workdir)
+    return {
+        'config': {
+            'guestfs_groups': args.guestfs_groups,
+            'virtinstall_groups': args.virtinstall_groups,
+            'expected_images': len(expected),
+            'jobs': args.jobs,
+            'latencies': latencies,
+        },
+        'timings': results,
+    }
+
+def _load_hdds():
+    """Read hdds.json from the script directory."""
+    with open('{0}/hdds.json'.format(createhdds.SCRIPTDIR), 'r') as fout:
+        return json.load(fout)
+
+def _wipe(imgs):
+    """Remove the image files for the given images, if present."""
+    for img in imgs:
+        if os.path.isfile(img.filename):
+            os.remove(img.filename)
+
+def bench_appliance(args):
+    """Compare total wall time for building guestfs images with one
+    appliance launch per image against building them all with a
+    single shared appliance (create_guestfs_images). Images are built
+    in a scratch directory which is removed afterwards.
+    """
+    load_createhdds()
+    hdds = _load_hdds()
+    groups = [grp for grp in hdds['guestfs'] if not args.group or grp['name'] in args.group]
+    imgs = []
+    for grp in groups:
+        imgs.extend(createhdds.get_guestfs_images(grp))
+    results = {'images': [img.filename for img in imgs], 'per_image': [], 'batched': []}
+    olddir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='createhdds-bench-', dir=args.workdir)
+    os.chdir(workdir)
+    try:
+        for _ in range(args.repeat):
+            start = time.monotonic()
+            for img in imgs:
+                createhdds.create_guestfs_images([img])
+            results['per_image'].append(time.monotonic() - start)
+            _wipe(imgs)
+            start = time.monotonic()
+            failed = createhdds.create_guestfs_images(imgs)
+            results['batched'].append(time.monotonic() - start)
+            _wipe(imgs)
+            if failed:
+                sys.exit("Batched build failed for: {0}".format(
+                    ', '.join(img.filename for (img, _) in failed)))
+    finally:
+        os.chdir(olddir)
+        shutil.rmtree(workdir)
+    per_image = min(results['per_image'])
+    batched = min(results['batched'])
+    results['speedup'] = per_image / batched if batched else None
+    return results
+
+def read_partition_table(path):
+    """Read the partition table of the disk image 'path'. Returns a
+    tuple of the label ('mbr' or 'gpt') and a list of (first sector,
+    last sector, type) tuples, where the type is the MBR type byte or
+    GPT type GUID. GPT header and table checksums are verified.
+    """
+    with open(path, 'rb') as imgfh:
+        mbr = imgfh.read(512)
+        if mbr[510:] != b'\x55\xaa':
+            raise ValueError("{0}: no partition table".format(path))
+        entries = [mbr[446+16*num:462+16*num] for num in range(4)]
+        if entries[0][4] != 0xee:
+            parts = []
+            for entry in entries:
+                (start, count) = struct.unpack('<II', entry[8:])
+                if entry[4]:
+                    parts.append((start, start + count - 1, "{0:02x}".format(entry[4])))
+            return ('mbr', parts)
+        header = imgfh.read(512)
+        fields = list(struct.unpack('<8sIIIIQQQQ16sQIII', header[:92]))
+        crc = fields[3]
+        fields[3] = 0
+        if zlib.crc32(struct.pack('<8sIIIIQQQQ16sQIII', *fields)) != crc:
+            raise ValueError("{0}: bad GPT header checksum".format(path))
+        imgfh.seek(fields[10] * 512)
+        table = imgfh.read(fields[11] * fields[12])
+        if zlib.crc32(table) != fields[13]:
+            raise ValueError("{0}: bad GPT table checksum".format(path))
+    parts = []
+    for num in range(fields[11]):
+        entry = table[num*fields[12]:(num+1)*fields[12]]
+        if entry[:16] != bytes(16):
+            (start, end) = struct.unpack('<QQ', entry[32:48])
+            parts.append((start, end, str(uuid.UUID(bytes_le=entry[:16])).upper()))
+    return ('gpt', parts)
+
+def read_filesystem(path, start, files):
+    """Describe the filesystem starting at sector 'start' of the disk
+    image 'path', using blkid and debugfs: its type and label, the
+    name, mode and owner of each entry in its root directory, and the
+    contents of each of the files at the paths in 'files'.
+    """
+    device = "{0}?offset={1}".format(path, start * 512)
+    probe = subprocess.run(["blkid", "-p", "-O", str(start * 512), "-o", "export", path],
+                           stdout=subprocess.PIPE, check=False).stdout.decode()
+    probe = dict(line.split('=', 1) for line in probe.splitlines() if '=' in line)
+    def _debugfs(cmd):
+        return subprocess.run(["debugfs", "-R", cmd, device], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout
+    # 'ls -p' lines are /inode/mode/uid/gid/name/size/
+    listing = sorted(tuple(line.split('/')[2:6])
+                     for line in _debugfs("ls -p /").decode().splitlines() if line)
+    return {
+        'type': probe.get('TYPE'),
+        'label': probe.get('LABEL'),
+        'root': listing,
+        'files': dict((fpath, _debugfs("cat {0}".format(fpath))) for fpath in files),
+    }
+
+def describe_image(img):
+    """Describe the built guestfs image 'img' for bench_engines: its
+    partition table, and each partition's filesystem (see
+    read_filesystem()).
+    """
+    (label, parts) = read_partition_table(img.filename)
+    filesystems = []
+    for (num, (start, _, _)) in enumerate(parts, 1):
+        files = [item.get('path', item.get('target')) for item in img.writes + img.uploads
+                 if int(item['part']) == num]
+        filesystems.append(read_filesystem(img.filename, start, files))
+    return {'label': label, 'parts': parts, 'filesystems': filesystems}
+
+def bench_engines(args):
+    """Build each guestfs image that can be built without an appliance
+    both ways - with a guestfs appliance (create_guestfs_images) and
+    directly (GuestfsImage.create_direct) - timing each, and check
+    the two images have the same partition tables and the same
+    filesystems and files (see describe_image()). Differences are
+    listed in the report, and the run exits 1 if there are any.
+    """
+    load_createhdds()
+    hdds = _load_hdds()
+    imgs = []
+    for grp in hdds['guestfs']:
+        if not args.group or grp['name'] in args.group:
+            imgs.extend(img for img in createhdds.get_guestfs_images(grp) if img.direct)
+    results = {'images': {}, 'match': True}
+    olddir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='createhdds-bench-', dir=args.workdir)
+    os.chdir(workdir)
+    try:
+        for img in imgs:
+            times = {}
+            start = time.monotonic()
+            failed = createhdds.create_guestfs_images([img])
+            times['appliance'] = time.monotonic() - start
+            if failed:
+                sys.exit("Appliance build of {0} failed: {1}".format(img.filename, failed[0][1]))
+            appliance = describe_image(img)
+            _wipe([img])
+            start = time.monotonic()
+            img.create_direct()
+            times['direct'] = time.monotonic() - start
+            direct = describe_image(img)
+            _wipe([img])
+            diffs = [key for key in ('label', 'parts') if appliance[key] != direct[key]]
+            for (num, (afs, dfs)) in enumerate(zip(appliance['filesystems'],
+                                                   direct['filesystems']), 1):
+                diffs.extend("partition {0} {1}".format(num, key) for key in afs
+                             if afs[key] != dfs[key])
+            results['images'][img.filename] = dict(times, differences=diffs)
+            if diffs:
+                results['match'] = False
+    finally:
+        os.chdir(olddir)
+        shutil.rmtree(workdir)
+    return results
+
+def bench_profiles(args):
+    """Install an image from the virt-install group args.group with
+    each of the disk profiles named in args.profile (default: all the
+    DISK_PROFILES), args.repeat times each, and report how long the
+    whole build, the install and the flush before the rename took
+    with each, and how much space the image took up. Images are built
+    in a scratch directory which is removed afterwards. If
+    args.cache_dir is set, the installs go through a caching mirror
+    using that directory, so the network doesn't skew the results.
+    """
+    load_createhdds()
+    hdds = _load_hdds()
+    profiles = args.profile or sorted(createhdds.DISK_PROFILES)
+    unknown = [name for name in profiles if name not in createhdds.DISK_PROFILES]
+    if unknown:
+        sys.exit("Unknown disk profile(s): {0}".format(', '.join(unknown)))
+    grps = [grp for grp in hdds['virtinstall'] if grp['name'] == args.group]
+    if not grps:
+        sys.exit("No virt-install image group {0}".format(args.group))
+    arches = createhdds.supported_arches()
+    imgs = [img for img in createhdds.get_virtinstall_images(grps[0], groups=hdds['virtinstall'])
+            if img.arch in arches and not img.base]
+    if not imgs:
+        sys.exit("Image group {0} has no image this host can install".format(args.group))
+    olddir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='createhdds-bench-', dir=args.workdir)
+    os.chdir(workdir)
+    results = {'image': imgs[0].filename, 'profiles': {}}
+    try:
+        argv = ['--logdir', workdir, 'all']
+        if args.cache_dir:
+            argv = ['--cache-dir', args.cache_dir] + argv
+        buildargs = createhdds.parse_args(hdds, argv)
+        for profile in profiles:
+            runs = []
+            for _ in range(args.repeat):
+                img = createhdds.VirtInstallImage(
+                    imgs[0].name, imgs[0].release, imgs[0].arch, size=imgs[0].size,
+                    imgver=profile, bootopts=imgs[0].bootopts, disk_profile=profile)
+                createhdds.METRICS = createhdds.Metrics()
+                start = time.monotonic()
+                createhdds.build_images([img], buildargs)
+                phases = {}
+                for event in createhdds.METRICS.spans:
+                    phases[event['phase']] = phases.get(event['phase'], 0) + event['duration']
+                runs.append({
+                    'seconds': time.monotonic() - start,
+                    'install': phases.get('virt-install'),
+                    'flush': phases.get('flush'),
+                    'allocated': createhdds.image_sizes(img.filename)[1],
+                })
+                os.remove(img.filename)
+            results['profiles'][profile] = {
+                'settings': createhdds.DISK_PROFILES[profile],
+                'min_seconds': min(run['seconds'] for run in runs),
+                'runs': runs,
+            }
+    finally:
+        os.chdir(olddir)
+        shutil.rmtree(workdir)
+    results['fastest'] = min(results['profiles'],
+                             key=lambda name: results['profiles'][name]['min_seconds'])
+    return results
+
+def bench_refresh(args):
+    """Simulate args.days nightly 'all' runs with each budget in
+    args.budget (and with no budget), from a state where all the
+    expected images were built on the same day, on a simulated clock.
+    Each night, the images 'all' would build are taken as built that
+    night, taking as long as preflight() estimates, spread over
+    args.jobs workers. Reports, for each budget, the number of images
+    and the estimated wall time of each night's builds, and the most
+    days any image was left outdated.
+    """
+    load_createhdds()
+    hdds = _load_hdds()
+    workdir = tempfile.mkdtemp(prefix='createhdds-bench-')
+    olddir = os.getcwd()
+    realtime = createhdds.time
+    now = [time.time()]
+    clock = types.ModuleType('time')
+    clock.__dict__.update(time.__dict__)
+    clock.time = lambda: now[0]
+    createhdds.time = clock
+    results = {}
+    try:
+        os.chdir(workdir)
+        imgs = createhdds.get_all_images(hdds)
+        arches = createhdds.supported_arches()
+        for img in imgs:
+            open(img.filename, 'w').close()
+        for budget in [None] + (args.budget or []):
+            createhdds.save_state({'images': {}})
+            now[0] = time.time()
+            createhdds.adopt_images(imgs)
+            (nights, walls, overdue) = ([], [], 0)
+            for _ in range(args.days):
+                now[0] += 24 * 60 * 60
+                (missing, outdated, _) = createhdds.check(hdds)
+                if budget:
+                    stale = set(img.filename for img in missing + outdated)
+                    current = [img for img in imgs if img.filename not in stale and
+                               img.arch in arches]
+                    (build, early, deferred) = createhdds.refresh_plan(
+                        missing, outdated, current, createhdds.parse_budget(budget),
+                        jobs=args.jobs)
+                    build += early
+                else:
+                    (build, deferred) = (missing + outdated, [])
+                build = [img for img in build if img.arch in arches]
+                images = createhdds.load_state()['images']
+                workers = [0] * args.jobs
+                for img in sorted(build, key=lambda img: -createhdds._estimate(
+                        img, images)['seconds']):
+                    workers[workers.index(min(workers))] += createhdds._estimate(
+                        img, images)['seconds']
+                for img in deferred:
+                    overdue = max(overdue, (now[0] - img.expires(images)) / 86400)
+                def _built(images):
+                    for img in build:
+                        images[img.filename]['mtime'] = now[0]
+                createhdds.update_state(_built)
+                nights.append(len(build))
+                walls.append(max(workers))
+            results[budget or 'none'] = {
+                'images': nights,
+                'max_images': max(nights),
+                'mean_images': round(statistics.mean(nights), 2),
+                'max_wall': max(walls),
+                'mean_wall': round(statistics.mean(walls)),
+                'max_overdue_days': round(overdue, 1),
+            }
+    finally:
+        createhdds.time = realtime
+        os.chdir(olddir)
+        shutil.rmtree(workdir)
+    return {
+        'config': {'images': len(imgs), 'days': args.days, 'jobs': args.jobs},
+        'results': results,
+    }
+
+def bench_startup(args):
+    """Time running 'createhdds.py check' in a fresh process, against
+    a working directory where all the expected images are present and
+    recorded (so it's all up to date). For comparison, also time just
+    starting the interpreter, and starting it and importing createhdds.
+    If args.guestfs_groups or args.virtinstall_groups is set, a
+    synthetic hdds.json with that many groups is used instead of the
+    real one.
+    """
+    load_createhdds()
+    workdir = tempfile.mkdtemp(prefix='createhdds-bench-')
+    olddir = os.getcwd()
+    try:
+        scriptdir = os.path.join(workdir, 'scripts')
+        imgdir = os.path.join(workdir, 'images')
+        if args.guestfs_groups or args.virtinstall_groups:
+            hdds = synthetic_hdds(scriptdir, args.guestfs_groups, args.virtinstall_groups)
+        else:
+            hdds = _load_hdds()
+            shutil.copytree(createhdds.SCRIPTDIR, scriptdir,
+                            ignore=shutil.ignore_patterns('*.img', '*.qcow2', '.*'))
+        with open(os.path.join(scriptdir, 'hdds.json'), 'w') as hddsfh:
+            json.dump(hdds, hddsfh)
+        shutil.copy(os.path.join(createhdds.SCRIPTDIR, 'createhdds.py'), scriptdir)
+        os.makedirs(imgdir)
+        os.chdir(imgdir)
+        # all the images are 'present' (empty files will do) and
+        # recorded, as on a host where everything is up to date
+        createhdds.SCRIPTDIR = scriptdir
+        imgs = createhdds.get_all_images(hdds)
+        for img in imgs:
+            open(img.filename, 'w').close()
+        createhdds.adopt_images(imgs)
+
+        def _run(cmd):
+            return lambda: subprocess.run(cmd, stdout=subprocess.DEVNULL, check=False)
+
+        importer = "import sys; sys.path.insert(0, {0!r}); import createhdds".format(scriptdir)
+        results = {
+            'interpreter': _timeit(_run([sys.executable, '-c', 'pass']), args.repeat),
+            'import': _timeit(_run([sys.executable, '-c', importer]), args.repeat),
+            'check': _timeit(_run([sys.executable, os.path.join(scriptdir, 'createhdds.py'),
+                                   'check']), args.repeat),
+        }
+    finally:
+        os.chdir(olddir)
+        shutil.rmtree(workdir)
+    return {
+        'config': {'images': len(imgs), 'groups': len(hdds['guestfs']) +
+                   len(hdds['virtinstall'])},
+        'results': results,
+    }
+
+def parse_args():
+    """Parse arguments with argparse."""
+    parser = argparse.ArgumentParser(description="Benchmarks for createhdds.")
+    parser.add_argument(
+        '-l', '--loglevel', help="The level of log messages to show",
+        choices=('debug', 'info', 'warning', 'error', 'critical'),
+        default='warning')
+    parser.add_argument(
+        '-o', '--output', help="Write the JSON report to this file as well as stdout")
+    subparsers = parser.add_subparsers(dest='subcommand')
+    subparsers.required = True
+
+    parser_appliance = subparsers.add_parser(
+        'appliance', description="Compare building guestfs images with one appliance "
+        "per image against one shared appliance. Needs a working libguestfs.")
+    parser_appliance.add_argument(
+        '-g', '--group', help="Only build images from this guestfs group (may be "
+        "given more than once; default is all guestfs groups)", action='append')
+    parser_appliance.add_argument(
+        '-r', '--repeat', help="Run each variant this many times and report "
+        "the best", type=int, default=1)
+    parser_appliance.add_argument(
+        '-w', '--workdir', help="Create the scratch directory for the images "
+        "in this directory (default: the system temporary directory)")
+    parser_appliance.set_defaults(func=bench_appliance)
+
+    parser_engines = subparsers.add_parser(
+        'engines', description="Build the guestfs images that don't need an "
+        "appliance both with and without one, time both, and check they come out "
+        "the same. Exits 1 if they don't. Needs a working libguestfs, blkid and debugfs.")
+    parser_engines.add_argument(
+        '-g', '--group', help="Only build images from this guestfs group (may be "
+        "given more than once; default is all guestfs groups)", action='append')
+    parser_engines.add_argument(
+        '-w', '--workdir', help="Create the scratch directory for the images "
+        "in this directory (default: the system temporary directory)")
+    parser_engines.set_defaults(func=bench_engines)
+
+    parser_offline = subparsers.add_parser(
+        'offline', description="Time planning, check and scheduling overhead with "
+        "fake guestfs, libvirt, virt-install and osinfo-query backends, over a "
+        "synthetic hdds.json. Needs none of the real backends.")
+    parser_offline.add_argument(
+        '--guestfs-groups', help="Number of guestfs image groups to generate",
+        type=int, default=200)
+    parser_offline.add_argument(
+        '--virtinstall-groups', help="Number of virt-install image groups to generate",
+        type=int, default=100)
+    parser_offline.add_argument(
+        '--build-guestfs', help="Number of guestfs images to actually build",
+        type=int, default=20)
+    parser_offline.add_argument(
+        '--build-virtinstall', help="Number of virt-install images to actually build",
+        type=int, default=5)
+    parser_offline.add_argument(
+        '-j', '--jobs', help="Value of createhdds --jobs for the build", type=int, default=1)
+    parser_offline.add_argument(
+        '--latency', help="Simulated latency for a fake backend operation, as "
+        "NAME=SECONDS (may be given more than once). Names: {0}".format(
+            ', '.join(sorted(DEFAULT_LATENCIES))), action='append')
+    parser_offline.add_argument(
+        '-r', '--repeat', help="Run each benchmark this many times", type=int, default=3)
+    parser_offline.set_defaults(func=bench_offline)
+
+    parser_profiles = subparsers.add_parser(
+        'profiles', description="Install an image with each virt-install disk "
+        "profile and compare how long the installs take. Needs a working libvirt "
+        "and virt-install.")
+    parser_profiles.add_argument(
+        '-g', '--group', help="Install an image from this virt-install image group "
+        "(default: %(default)s)", default='minimal')
+    parser_profiles.add_argument(
+        '-p', '--profile', help="Try this disk profile (may be given more than once; "
+        "default is all of them)", action='append')
+    parser_profiles.add_argument(
+        '-r', '--repeat', help="Install with each profile this many times", type=int,
+        default=1)
+    parser_profiles.add_argument(
+        '--cache-dir', help="Install via a caching mirror using this directory (as "
+        "createhdds --cache-dir)")
+    parser_profiles.add_argument(
+        '-w', '--workdir', help="Create the scratch directory for the images "
+        "in this directory (default: the system temporary directory)")
+    parser_profiles.set_defaults(func=bench_profiles)
+
+    parser_refresh = subparsers.add_parser(
+        'refresh', description="Simulate nightly 'all' runs from a state where all "
+        "the images were built on the same day, with no budget and with each "
+        "--budget, and report how much each night rebuilds. Needs none of the "
+        "backends.")
+    parser_refresh.add_argument(
+        '-b', '--budget', help="An 'all --budget' value to simulate (may be given "
+        "more than once)", action='append')
+    parser_refresh.add_argument(
+        '-d', '--days', help="Number of nights to simulate", type=int, default=42)
+    parser_refresh.add_argument(
+        '-j', '--jobs', help="Value of createhdds --jobs", type=int, default=1)
+    parser_refresh.set_defaults(func=bench_refresh)
+
+    parser_startup = subparsers.add_parser(
+        'startup', description="Time 'createhdds.py check' from process start to "
+        "exit, with all images up to date, against interpreter startup and "
+        "importing createhdds. Needs none of the backends.")
+    parser_startup.add_argument(
+        '--guestfs-groups', help="Use a synthetic hdds.json with this many guestfs "
+        "image groups (default: use the real hdds.json)", type=int, default=0)
+    parser_startup.add_argument(
+        '--virtinstall-groups', help="Use a synthetic hdds.json with this many "
+        "virt-install image groups (default: use the real hdds.json)", type=int, default=0)
+    parser_startup.add_argument(
+        '-r', '--repeat', help="Run each command this many times", type=int, default=10)
+    parser_startup.set_defaults(func=bench_startup)
+    return parser.parse_args()
+
+def main():
+    """Run the requested benchmark and print its report."""
+    args = parse_args()
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper(), logging.WARNING))
+    # the benchmarks run createhdds code, which logs a lot at info
+    logging.getLogger('createhdds').setLevel(
+        getattr(logging, args.loglevel.upper(), logging.WARNING))
+    report = {'benchmark': args.subcommand, 'results': args.func(args)}
+    out = json.dumps(report, indent=2, sort_keys=True)
+    print(out)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(out + "\n")
+    if report['results'].get('match') is False:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
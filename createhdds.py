@@ -20,20 +20,38 @@
 """Tool for creating hard disk images for Rocky Linux openQA."""
 
 import argparse
+import contextlib
+import ctypes
+import errno
+import fcntl
+import hashlib
 import logging
 import json
 import os
 import os.path
+import re
+import select
+import shlex
+import shutil
+import socket
+import statistics
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ET
+import zlib
 
-import guestfs
-import libvirt
-import platform
-
-from six.moves.urllib.request import urlopen
+# the guestfs and libvirt bindings, and the heavier standard library
+# modules only some commands need (the mirror's http.server and
+# urllib.request, the history's sqlite3, the thread pools'
+# concurrent.futures, tarfile for uploads), are only imported by the
+# functions that use them: 'check' is run a lot, by monitoring, and
+# most of its time used to go on importing them
 
 # this is a bit icky, but it means you can run the script from
 # anywhere - we use this to locate hdds.json and the virtinstall
@@ -41,9 +59,89 @@ from six.moves.urllib.request import urlopen
 # as the script itself. images are checked/created in the working
 # directory.
 SCRIPTDIR = os.path.abspath(os.path.dirname(sys.argv[0]))
-CPUARCH = platform.processor()
-if CPUARCH == '' : CPUARCH = platform.machine()
+# (platform.processor() runs 'uname -p', which is slow)
+CPUARCH = os.uname().machine
+# bump this when a change to createhdds itself changes the content of
+# the images it builds; it's part of every image's input fingerprint,
+# so this causes all images to be rebuilt
+FPVERSION = 1
+# how input files go into fingerprints: in format 2, as their hashes,
+# which are cached in the state file (see input_hash()); in format 1,
+# their whole contents went in. each manifest entry records the format
+# of its fingerprint, and adopt_images() moves format 1 ones on
+FPFORMAT = 2
+# where virt-install images are installed from
+UPSTREAM = 'https://download.rockylinux.org'
+# file in the working directory where we record state about the
+# images we've built: a manifest of each image's size, mtime, input
+# fingerprint and build result, which lets 'check' avoid stat()ing
+# every image
+STATEFILE = '.createhdds.json'
+_STATELOCK = threading.Lock()
+# the hashes of fingerprint input files (see input_hash()), as loaded
+# from the state file, and whether we've worked out any new ones
+_INPUTHASHES = {'lock': threading.Lock(), 'hashes': None, 'dirty': False}
+# where we cache osinfo lookups between runs
+OSINFO_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'createhdds', 'osinfo.json')
+# block size and file name suffix of the block hash indexes 'sync'
+# keeps beside each image
+SYNC_BLOCKSIZE = 4 * 1024 * 1024
+BLOCKINDEX = '.blocks'
+# the image store (see store_add()), in the working directory
+STOREDIR = '.store'
+# the checksum manifest of the images (see write_sums()), in the
+# working directory, and how much of an image we read at a time when
+# hashing it
+SUMSFILE = 'SHA256SUMS'
+HASH_CHUNK = 1024 * 1024
+# the build history database (see record_history()), in the working
+# directory; how many builds of each image it keeps; how many of an
+# image's latest successful builds its next build time is estimated
+# from; and how much longer than that a build has to take for
+# 'history' to call the image slow
+HISTORYFILE = '.createhdds-history.sqlite'
+HISTORY_KEEP = 50
+HISTORY_RECENT = 5
+SLOW_FACTOR = 1.5
+# the Linux ioctl to make one file a copy-on-write clone of another
+FICLONE = 0x40049409
+# the inotify events 'watch' wants to hear about (a file was written,
+# created, deleted or renamed in or out of a watched directory), and
+# the one that means the kernel dropped some
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+# how long preflight() reckons building an image takes, in seconds,
+# and how much of its full size it takes up on disk, if it's never
+# been built here before. guestfs images are sparse, and a fresh
+# install only fills a fraction of its qcow2 image
+BUILD_SECONDS = {'guestfs': 30, 'virtinstall': 1800, 'derived': 300}
+BUILD_ALLOCATED = {'guestfs': 0.05, 'virtinstall': 0.35, 'derived': 0.35}
+# install-time settings for the install VM's disk, which virt-install
+# images can choose by name with 'disk_profile' in hdds.json (or give
+# their own). 'default' is libvirt's defaults. 'nocache' bypasses the
+# host page cache. 'unsafe' has the host ignore the guest's flushes,
+# which anaconda does a lot of: the install is thrown away if it
+# fails, and the image is flushed to disk before it's renamed into
+# place (see flush_rename()), so the risk is only to the temporary file
+DISK_PROFILES = {
+    'default': {},
+    'nocache': {'cache': 'none', 'io': 'native', 'discard': 'unmap'},
+    'unsafe': {'cache': 'unsafe', 'io': 'threads', 'discard': 'unmap',
+               'detect_zeroes': 'unmap', 'bus': 'virtio'},
+}
+# with 'all --budget', images that are up to date may be rebuilt early
+# to use up spare budget once they're this far through their maxage
+EARLY_REFRESH = 0.5
 logger = logging.getLogger('createhdds')
+# records which image (if any) the current thread is building, so log
+# messages can be routed to per-image log files when building in
+# parallel (see ImageLogFilter and build_images)
+_LOGCTX = threading.local()
 
 def handle_size(size):
     """Simple function to handle sizes like '10G' or '100MB', returns
@@ -57,6 +155,54 @@ def handle_size(size):
     else:
         return int(size)
 
+def format_size(size):
+    """Format a size in bytes for humans, e.g. '1.5G'."""
+    for unit in ('', 'K', 'M', 'G'):
+        if abs(size) < 1024:
+            return "{0:.1f}{1}".format(size, unit) if unit else "{0}".format(size)
+        size = size / 1024
+    return "{0:.1f}T".format(size)
+
+def flush_rename(src, dst):
+    """Rename the file 'src' to 'dst', but only once all of 'src' is
+    on disk, and make sure the rename is too. Images may be written
+    with the host caching the writes (see DISK_PROFILES), and we don't
+    want a crash to leave a partly written image under its real name.
+    """
+    with open(src, 'rb') as fileh:
+        os.fsync(fileh.fileno())
+    os.rename(src, dst)
+    dirfd = os.open(os.path.dirname(os.path.abspath(dst)), os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+def format_duration(seconds):
+    """Format a duration in seconds for humans, e.g. '1h05m'."""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "{0}s".format(seconds)
+    if seconds < 3600:
+        return "{0}m{1:02d}s".format(seconds // 60, seconds % 60)
+    return "{0}h{1:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+
+def image_sizes(filename):
+    """Returns a tuple of the apparent size (what 'ls' shows) and the
+    allocated size (what's actually used on disk, like 'du') of the
+    given file, in bytes. Sparse and qcow2 images typically have an
+    allocated size far smaller than their apparent size.
+    """
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_blocks * 512)
+
+def is_image_file(filename):
+    """Whether a file in the working directory looks like one of our
+    images.
+    """
+    return filename.startswith('disk') and (filename.endswith('img') or
+                                            filename.endswith('qcow2'))
+
 def supported_arches():
     """Provides a list of the arches for which virt-install images can
     be built on this host.
@@ -75,7 +221,438 @@ def supported_arches():
         logger.info("Need to add a list of supported arches for %s CPU", CPUARCH)
     return supported_arches
 
-class GuestfsImage(object):
+class Metrics(object):
+    """Collects the timing spans recorded by span() during a run. Each
+    span is a dict: 'phase' is what was timed, 'image' the image it
+    was for (if any), 'start' (epoch time) and 'duration' (seconds),
+    'status' is 'ok' or 'error', plus any extra attributes. If an
+    events file has been opened with open_events(), each span is also
+    written to it as a line of JSON as soon as it ends. At the end of
+    a run, write_prometheus() can write a summary for the Prometheus
+    node_exporter textfile collector.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.built = 0
+        self.failed = 0
+        self.eventfile = None
+
+    def open_events(self, path):
+        """Start writing spans to 'path' (appending), as JSON lines."""
+        self.eventfile = open(path, 'a')
+
+    def emit(self, event):
+        """Record a span."""
+        with self.lock:
+            self.spans.append(event)
+            if self.eventfile:
+                self.eventfile.write(json.dumps(event, sort_keys=True) + "\n")
+                self.eventfile.flush()
+
+    def result(self, success):
+        """Count an image as built (if success is True) or failed."""
+        with self.lock:
+            if success:
+                self.built += 1
+            else:
+                self.failed += 1
+
+    def image_phases(self, image, since):
+        """Return the time spent in each phase of building 'image' in
+        the spans that started at or after 'since' (epoch time), as a
+        dict, and the number of attempts the build took (the highest
+        'attempt' of any of the spans, or 1).
+        """
+        phases = {}
+        attempts = 1
+        with self.lock:
+            for event in self.spans:
+                if event.get('image') != image or event['start'] < since:
+                    continue
+                phases[event['phase']] = phases.get(event['phase'], 0) + event['duration']
+                attempts = max(attempts, event.get('attempt', 1))
+        return (phases, attempts)
+
+    def write_prometheus(self, path):
+        """Write the time spent in each phase (per image, and in total)
+        plus the numbers of images built and failed to 'path', in
+        the Prometheus text format. The file is written atomically,
+        as the textfile collector requires.
+        """
+        perimage = {}
+        totals = {}
+        with self.lock:
+            (built, failed) = (self.built, self.failed)
+            for event in self.spans:
+                phase = event['phase']
+                totals[phase] = totals.get(phase, 0) + event['duration']
+                if event.get('image'):
+                    key = (event['image'], phase)
+                    perimage[key] = perimage.get(key, 0) + event['duration']
+        lines = [
+            "# HELP createhdds_phase_seconds Time spent in each build phase per image "
+            "in the last run.",
+            "# TYPE createhdds_phase_seconds gauge",
+        ]
+        for ((image, phase), duration) in sorted(perimage.items()):
+            lines.append('createhdds_phase_seconds{{image="{0}",phase="{1}"}} {2:.3f}'.format(
+                image, phase, duration))
+        lines.extend([
+            "# HELP createhdds_phase_seconds_total Time spent in each build phase over "
+            "all images in the last run.",
+            "# TYPE createhdds_phase_seconds_total gauge",
+        ])
+        for (phase, duration) in sorted(totals.items()):
+            lines.append('createhdds_phase_seconds_total{{phase="{0}"}} {1:.3f}'.format(
+                phase, duration))
+        lines.extend([
+            "# HELP createhdds_images_built Images built in the last run.",
+            "# TYPE createhdds_images_built gauge",
+            "createhdds_images_built {0}".format(built),
+            "# HELP createhdds_images_failed Images that failed to build in the last run.",
+            "# TYPE createhdds_images_failed gauge",
+            "createhdds_images_failed {0}".format(failed),
+            "# HELP createhdds_last_run_timestamp_seconds When the last run finished.",
+            "# TYPE createhdds_last_run_timestamp_seconds gauge",
+            "createhdds_last_run_timestamp_seconds {0:.0f}".format(time.time()),
+        ])
+        tmpfile = "{0}.tmp".format(path)
+        with open(tmpfile, 'w') as promfh:
+            promfh.write("\n".join(lines) + "\n")
+        os.rename(tmpfile, path)
+
+METRICS = Metrics()
+
+@contextlib.contextmanager
+def span(phase, image=None, **attrs):
+    """Context manager which times the wrapped code as a span of the
+    given phase (for the given image, if any) and records it in
+    METRICS. Extra keyword arguments are added to the span.
+    """
+    start = time.time()
+    mono = time.monotonic()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        event = dict(attrs, phase=phase, image=image, start=start,
+                     duration=time.monotonic() - mono, status=status)
+        METRICS.emit(event)
+        logger.debug("%s%s took %.2fs", "{0}: ".format(image) if image else '', phase,
+                     event['duration'])
+
+class ImageLogFilter(logging.Filter):
+    """Logging filter that only passes records emitted by a thread
+    while it is building the image with the given filename. Used to
+    give each image its own log file when building in parallel.
+    """
+    def __init__(self, filename):
+        super(ImageLogFilter, self).__init__()
+        self.filename = filename
+
+    def filter(self, record):
+        return getattr(_LOGCTX, 'image', None) == self.filename
+
+def load_state():
+    """Read the state file from the working directory, returning a dict
+    with an 'images' dict keyed by image filename. Returns an empty
+    state if the file doesn't exist (or can't be parsed).
+    """
+    try:
+        with open(STATEFILE, 'r') as statefh:
+            state = json.load(statefh)
+    except (OSError, ValueError):
+        state = {}
+    state.setdefault('images', {})
+    return state
+
+def save_state(state):
+    """Write out the state file, atomically."""
+    tmpfile = "{0}.tmp".format(STATEFILE)
+    with open(tmpfile, 'w') as statefh:
+        json.dump(state, statefh, indent=2, sort_keys=True)
+    os.rename(tmpfile, STATEFILE)
+
+def update_state(func):
+    """Load the state, call func(state['images']) to modify it, and
+    save it again (with any new input file hashes), all under a lock
+    so parallel builds don't trample on each other's changes.
+    """
+    with _STATELOCK:
+        state = load_state()
+        func(state['images'])
+        _store_input_hashes(state)
+        save_state(state)
+
+def _store_input_hashes(state):
+    """Put the input file hashes input_hash() has worked out into the
+    state dict 'state', if there are new ones, dropping those of files
+    that no longer exist.
+    """
+    with _INPUTHASHES['lock']:
+        if not _INPUTHASHES['dirty']:
+            return
+        hashes = dict(state.get('inputs', {}), **_INPUTHASHES['hashes'])
+        state['inputs'] = dict((path, cached) for (path, cached) in hashes.items()
+                               if os.path.exists(path))
+        _INPUTHASHES['dirty'] = False
+
+def save_input_hashes():
+    """Save any new input file hashes to the state file. For 'check',
+    which doesn't otherwise write the state file; if it can't (say
+    it's run by a monitoring user), the hashes are just worked out
+    again next time.
+    """
+    if not _INPUTHASHES['dirty']:
+        return
+    try:
+        with _STATELOCK:
+            state = load_state()
+            _store_input_hashes(state)
+            save_state(state)
+    except OSError as err:
+        logger.debug("Could not save input file hashes: %s", err)
+
+def _file_digest(path):
+    """The SHA-256 hex digest of the contents of the file at 'path'."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fileh:
+        for chunk in iter(lambda: fileh.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def input_hash(path):
+    """Return the SHA-256 hex digest of the fingerprint input file at
+    'path', or None if it doesn't exist. The digests are cached in the
+    state file ('inputs') with the size and mtime of the file they are
+    for, and only worked out again when those change, so checking
+    whether images are up to date doesn't mean rereading every
+    kickstart and upload.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    with _INPUTHASHES['lock']:
+        if _INPUTHASHES['hashes'] is None:
+            _INPUTHASHES['hashes'] = load_state().get('inputs', {})
+        cached = _INPUTHASHES['hashes'].get(path)
+    if cached and (cached['size'], cached['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+        return cached['sha256']
+    try:
+        digest = _file_digest(path)
+    except OSError:
+        return None
+    with _INPUTHASHES['lock']:
+        _INPUTHASHES['hashes'][path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                        'sha256': digest}
+        _INPUTHASHES['dirty'] = True
+    return digest
+
+def fingerprint(inputs, files=(), legacy=False):
+    """Return a fingerprint (a sha256 hex digest) for an image with the
+    given inputs. 'inputs' is a JSON-serializable value describing
+    everything that affects the image content; 'files' is a list of
+    paths of files whose contents are also inputs, which go in as
+    their hashes (see input_hash()). A file that is missing is hashed
+    as such, rather than causing an error. With 'legacy', the files'
+    contents go in as they did in FPFORMAT 1 (see
+    Image.legacy_fingerprint).
+    """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([FPVERSION, inputs], sort_keys=True).encode())
+    for path in files:
+        hasher.update(b"\0" + os.path.basename(path).encode() + b"\0")
+        if not legacy:
+            digest = input_hash(path)
+            hasher.update(digest.encode() if digest else b"\0missing\0")
+            continue
+        try:
+            with open(path, 'rb') as fileh:
+                for chunk in iter(lambda: fileh.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+        except OSError:
+            hasher.update(b"\0missing\0")
+    return hasher.hexdigest()
+
+
+class Image(object):
+    """Base class for images, providing the staleness logic. Subclasses
+    must set 'filename' and 'maxage', and provide
+    'fingerprint_inputs'.
+    """
+    def fingerprint_inputs(self, legacy=False):
+        """The inputs and the input files for the image's fingerprint
+        (see fingerprint()), worked out as they were in FPFORMAT 1 if
+        'legacy' is set.
+        """
+        raise NotImplementedError
+
+    @property
+    def fingerprint(self):
+        """A fingerprint of all the inputs that determine the content
+        of the image (see fingerprint()).
+        """
+        return fingerprint(*self.fingerprint_inputs())
+
+    @property
+    def legacy_fingerprint(self):
+        """The image's fingerprint in FPFORMAT 1, which manifest entries
+        recorded before format 2 have. Working it out means reading
+        all the input files.
+        """
+        return fingerprint(*self.fingerprint_inputs(legacy=True), legacy=True)
+
+    def inputs_unchanged(self, entry):
+        """Whether the fingerprint recorded in the state file manifest
+        'entry' is the image's current one (or there is none, for
+        images built before we recorded fingerprints). Format 1
+        fingerprints are checked against legacy_fingerprint.
+        """
+        recorded = entry.get('fingerprint')
+        if not recorded:
+            return True
+        if entry.get('fpformat', 1) < FPFORMAT:
+            return recorded == self.legacy_fingerprint
+        return recorded == self.fingerprint
+
+    # set (to a time.monotonic() value) when build_images starts on
+    # the image, so record() can note how long building it took; and
+    # the same as epoch time, to pick out the build's spans
+    started = None
+    started_at = None
+
+    @property
+    def requires(self):
+        """The names of the tools and Python bindings needed to build
+        the image (see check_backend()).
+        """
+        raise NotImplementedError
+
+    @property
+    def watches(self):
+        """The paths of the files (which may or may not exist) whose
+        changes can change the image, for 'watch'.
+        """
+        raise NotImplementedError
+
+    def preflight(self, planned=()):
+        """Check that the things the image is built from are all in
+        place, without building anything. 'planned' is the filenames
+        of all the images to be built in this run. Returns a list of
+        problem strings, empty if all is well.
+        """
+        return []
+
+    def record(self, **extra):
+        """Record the image in the state file manifest: its current
+        fingerprint, its size and mtime, its checksum, and that it was
+        built OK, plus any keyword arguments, and add it to the image
+        store and the checksum manifest. Called after the image has
+        been built. If we know when the build started, how long it
+        took is stored as 'build_seconds', for preflight() to estimate
+        from next time, and the build goes in the build history (see
+        record_history()).
+        """
+        entry = self.manifest_entry()
+        if self.started is not None:
+            entry['build_seconds'] = round(time.monotonic() - self.started, 1)
+        # an image restored from the store has the same data, size and
+        # mtime as the image the store's copy came from, so we may not
+        # need to hash it again; otherwise hash it now, while it's
+        # likely still in the page cache
+        entry['sha256'] = known_checksum(entry)
+        if not entry['sha256']:
+            with span('checksum', self.filename):
+                entry['sha256'] = file_checksum(self.filename)
+        entry.update(extra)
+        def _record(images):
+            images[self.filename] = entry
+        update_state(_record)
+        store_add(self.filename, entry['fingerprint'])
+        write_sums()
+        if self.started is not None:
+            record_history(self, 'ok')
+        METRICS.result(True)
+
+    def manifest_entry(self):
+        """The state file manifest entry for the image as it is now."""
+        stat = os.stat(self.filename)
+        return {
+            'fingerprint': self.fingerprint,
+            'fpformat': FPFORMAT,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'result': 'ok',
+            'built': time.time(),
+        }
+
+    def record_failure(self):
+        """Record in the state file (and the build history, if the
+        build got as far as starting) that building the image failed.
+        Any existing image file (and its record) is left alone.
+        """
+        def _record(images):
+            entry = images.setdefault(self.filename, {})
+            entry['result'] = 'failed'
+            entry['attempted'] = time.time()
+        update_state(_record)
+        if self.started is not None:
+            record_history(self, 'failed')
+        METRICS.result(False)
+
+    def is_outdated(self, images=None, mtime=None):
+        """Whether the image is outdated - if the fingerprint of its
+        inputs has changed since it was built, or if self.maxage is
+        set and it's older than that. Images built before we recorded
+        fingerprints are only checked against maxage. This assumes the
+        image exists. 'images' is the state file 'images' dict and
+        'mtime' the image file's mtime, if the caller already has them;
+        otherwise we read the state file, and use the mtime it records
+        or stat the file.
+        """
+        if images is None:
+            images = load_state()['images']
+        entry = images.get(self.filename, {})
+        if not self.inputs_unchanged(entry):
+            logger.debug("Inputs for %s have changed", self.filename)
+            return True
+
+        if self.maxage:
+            if mtime is None:
+                mtime = entry.get('mtime') or os.path.getmtime(self.filename)
+            age = int(time.time()) - int(mtime)
+            # maxage is in days
+            if age > int(self.maxage) * 24 * 60 * 60:
+                return True
+
+        return False
+
+    def expires(self, images=None):
+        """When (as an epoch time) the image will exceed its maxage, or
+        None if it has no maxage. This assumes the image exists.
+        'images' is the state file 'images' dict, as for is_outdated.
+        """
+        if not self.maxage:
+            return None
+        if images is None:
+            images = load_state()['images']
+        mtime = images.get(self.filename, {}).get('mtime') or os.path.getmtime(self.filename)
+        return int(mtime) + int(self.maxage) * 24 * 60 * 60
+
+    @property
+    def outdated(self):
+        """Whether the image exists and is outdated (see is_outdated)."""
+        if not os.path.isfile(self.filename):
+            return False
+        return self.is_outdated()
+
+
+class GuestfsImage(Image):
     """Class representing an image created by guestfs. 'size' is the
     desired image size, valid formats are a digit string (size in
     bytes, digit string plus 'M', 'MB' or 'MiB' (size in power of two
@@ -92,15 +669,22 @@ class GuestfsImage(object):
     of strings which should be appended to the image file name, with _
     separators (this provides a mechanism for get_guestfs_images to
     include the label and/or filesystem in the image name when
-    creating images from a group with variants).
+    creating images from a group with variants). 'maxage' is the
+    maximum age of the image file (in days); by default guestfs images
+    never expire, and are only rebuilt when their inputs change.
+    'imgformat' is the disk image format, 'raw' (the default) or
+    'qcow2'; qcow2 images get a .qcow2 extension instead of .img. If
+    'compress' is set, qcow2 images are compressed once built.
     """
     def __init__(self, name, size, imgver='', filesystem='ext4', label='mbr', parts=None,
-                 writes=None, uploads=None, name_extras=None):
+                 writes=None, uploads=None, name_extras=None, maxage=0, imgformat='raw',
+                 compress=False):
         self.name = name
         self.arch = 'noarch'
         self.size = handle_size(size)
-        # guestfs images are never outdated
-        self.outdated = False
+        self.maxage = maxage
+        self.imgformat = imgformat
+        self.compress = compress and imgformat == 'qcow2'
         self.filesystem = filesystem
         self.label = label
         self.parts = []
@@ -119,84 +703,1502 @@ class GuestfsImage(object):
         if name_extras:
             for item in name_extras:
                 self.filename = "{0}_{1}".format(self.filename, item)
-        self.filename = "{0}.img".format(self.filename)
+        if imgformat == 'qcow2':
+            self.filename = "{0}.qcow2".format(self.filename)
+        else:
+            self.filename = "{0}.img".format(self.filename)
+
+    @property
+    def tmpfile(self):
+        """The temporary file name the image is built under."""
+        return "{0}.tmp".format(self.filename)
+
+    def fingerprint_inputs(self, legacy=False):
+        """The fingerprint inputs for the image's layout and contents.
+        The name and imgver aren't included, as they only affect the
+        filename. The format and compression are only included when
+        they aren't the defaults.
+        """
+        inputs = {
+            'type': 'guestfs',
+            'size': self.size,
+            'filesystem': self.filesystem,
+            'label': self.label,
+            'parts': self.parts,
+            'writes': self.writes,
+            'uploads': self.uploads,
+        }
+        # only included when set, so images built before they could be
+        # set keep their fingerprints
+        if self.imgformat != 'raw':
+            inputs['format'] = self.imgformat
+        if self.compress:
+            inputs['compress'] = True
+        return (inputs, self.watches)
+
+    @property
+    def direct(self):
+        """Whether the image can be built without a guestfs appliance
+        (see create_direct()): it must be a raw image with an MBR or
+        GPT label, only primary partitions (at most four on MBR, where
+        GPT types aren't supported either), and only ext2/3/4
+        filesystems.
+        """
+        if self.imgformat != 'raw' or self.label not in ('mbr', 'gpt'):
+            return False
+        if self.label == 'mbr' and (len(self.parts) > 4 or
+                                    any(part.get('gpt_type') for part in self.parts)):
+            return False
+        return all(part['type'] == 'p' and
+                   part.get('filesystem', self.filesystem) in ('ext2', 'ext3', 'ext4')
+                   for part in self.parts)
+
+    @property
+    def requires(self):
+        """The guestfs bindings, plus qemu-img to compress the image;
+        or for images that can be built directly, mke2fs (and debugfs,
+        unless we're root - see create_direct()).
+        """
+        if self.direct:
+            return ['mke2fs'] if os.geteuid() == 0 else ['mke2fs', 'debugfs']
+        return ['guestfs', 'qemu-img'] if self.compress else ['guestfs']
+
+    @property
+    def watches(self):
+        """The files uploaded to the image."""
+        return ['/'.join((SCRIPTDIR, 'uploads', upload['source'])) for upload in self.uploads]
+
+    def sectors(self):
+        """The image's partitions as a list of (type, first sector,
+        last sector) tuples, with the negative sector numbers guestfs
+        allows (counting back from the end of the disk) resolved.
+        """
+        total = self.size // 512
+        ranges = []
+        for part in self.parts:
+            (start, end) = (int(part['start']), int(part['end']))
+            ranges.append((part['type'], start + total if start < 0 else start,
+                           end + total if end < 0 else end))
+        return ranges
+
+    def preflight(self, planned=()):
+        """Check the partitions fit on the disk and don't overlap, that
+        the writes and uploads are to partitions that exist, and that
+        the upload source files are there.
+        """
+        problems = []
+        total = self.size // 512
+        # the MBR or the primary GPT header and table come first, and
+        # on GPT disks the backup table and header take the last 33
+        # sectors (guestfs' part_add won't touch them either)
+        (first, last) = (34, total - 34) if self.label == 'gpt' else (1, total - 1)
+        outer = []
+        for (num, (ptype, start, end)) in enumerate(self.sectors(), start=1):
+            desc = "{0}: partition {1} ({2}-{3})".format(self.filename, num, start, end)
+            if start < first or end > last or end < start:
+                problems.append("{0} does not fit on the {1} sector disk (usable sectors "
+                                "{2}-{3})".format(desc, total, first, last))
+                continue
+            if ptype == 'l':
+                if not any(otype == 'e' and ostart < start and end <= oend
+                           for (otype, ostart, oend) in outer):
+                    problems.append("{0} is logical but not inside an extended "
+                                    "partition".format(desc))
+                continue
+            for (_, ostart, oend) in outer:
+                if start <= oend and ostart <= end:
+                    problems.append("{0} overlaps partition ({1}-{2})".format(
+                        desc, ostart, oend))
+            outer.append((ptype, start, end))
+        if self.label != 'gpt' and len(outer) > 4:
+            problems.append("{0}: more than 4 primary and extended partitions on an "
+                            "MBR disk".format(self.filename))
+        for item in self.writes + self.uploads:
+            if int(item['part']) > len(self.parts):
+                problems.append("{0}: writes to partition {1}, but there are only "
+                                "{2}".format(self.filename, item['part'], len(self.parts)))
+        for upload in self.uploads:
+            source = '/'.join((SCRIPTDIR, 'uploads', upload['source']))
+            if not os.path.isfile(source):
+                problems.append("{0}: upload source {1} not found".format(
+                    self.filename, source))
+        return problems
 
     def create(self, _):
         """Create the image. The unused arg is the 'textinst' arg that
         only VirtInstallImages care about (but which has to be passed
-        here too).
+        here too). If the image can be built directly, we do that (see
+        create_direct()); otherwise this launches a guestfs appliance
+        just for this image (create_guestfs_images() can build several
+        images with a single appliance).
+        """
+        if self.direct:
+            return self.create_direct()
+        failed = create_guestfs_images([self])
+        if failed:
+            raise failed[0][1]
+
+    def create_direct(self):
+        """Create the image without a guestfs appliance: write the
+        partition table into the image file ourselves (see
+        write_partition_table()), and have mke2fs create each
+        filesystem straight into its partition, populated from a
+        staging directory holding the partition's writes and uploads.
+        Only works for images where self.direct is True. The result is
+        equivalent to what the appliance builds: the same partitions,
+        and the same files, owned by root and mode 0644. mke2fs copies
+        the staged files' owners, so if we're not root, we fix them up
+        with debugfs afterwards.
         """
-        gfs = guestfs.GuestFS(python_return_dict=True)
         try:
-            # Create the disk image with a temporary name
-            tmpfile = "{0}.tmp".format(self.filename)
-            gfs.disk_create(tmpfile, "raw", int(self.size))
-            # 'launch' guestfs with the disk attached
-            gfs.add_drive_opts(tmpfile, format="raw", readonly=0)
-            gfs.launch()
-            # identify the disk and create a disk label
-            disk = gfs.list_devices()[0]
+            with span('disk_create', self.filename):
+                with open(self.tmpfile, 'wb') as imgfh:
+                    imgfh.truncate(self.size)
+            sectors = self.sectors()
+            with span('part_init', self.filename):
+                write_partition_table(self.tmpfile, self.size, self.label,
+                                      [(start, end, part.get('gpt_type')) for
+                                       (part, (_, start, end)) in zip(self.parts, sectors)])
+            for (partnum, (part, (_, start, end))) in enumerate(zip(self.parts, sectors), 1):
+                filesystem = part.get('filesystem', self.filesystem)
+                with span('mkfs', self.filename, filesystem=filesystem, partition=partnum):
+                    self._mkfs_direct(partnum, part, filesystem, start, end)
+            self.finalize()
+        except:
+            if os.path.isfile(self.tmpfile):
+                os.remove(self.tmpfile)
+            raise
+
+    def _mkfs_direct(self, partnum, part, filesystem, start, end):
+        """Create and populate the filesystem for partition number
+        'partnum' (dict 'part', from sector 'start' to 'end') of the
+        image's temporary file, for create_direct().
+        """
+        offset = start * 512
+        staging = tempfile.mkdtemp(prefix='createhdds-fs-')
+        try:
+            # mke2fs gives the filesystem root the staging dir's mode
+            os.chmod(staging, 0o755)
+            paths = []
+            files = [(write['path'], write['content'].encode()) for write in self.writes
+                     if int(write['part']) == partnum]
+            files.extend((upload['target'], '/'.join((SCRIPTDIR, 'uploads', upload['source'])))
+                         for upload in self.uploads if int(upload['part']) == partnum)
+            for (target, content) in files:
+                dest = os.path.join(staging, target.lstrip('/'))
+                os.makedirs(os.path.dirname(dest), mode=0o755, exist_ok=True)
+                if isinstance(content, bytes):
+                    with open(dest, 'wb') as destfh:
+                        destfh.write(content)
+                else:
+                    shutil.copyfile(content, dest)
+                os.chmod(dest, 0o644)
+                paths.append(target)
+            args = ["mke2fs", "-q", "-F", "-t", filesystem, "-E",
+                    "offset={0},root_owner=0:0".format(offset), "-d", staging]
+            if part.get('label'):
+                args.extend(("-L", part['label']))
+            args.extend((self.tmpfile, "{0}k".format((end - start + 1) * 512 // 1024)))
+            subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+            if paths and os.geteuid() != 0:
+                # every file and every directory above it
+                fixes = set()
+                for path in paths:
+                    while path not in ('', '/'):
+                        fixes.add(path)
+                        path = os.path.dirname(path)
+                cmds = ''.join("sif {0} uid 0\nsif {0} gid 0\n".format(path)
+                               for path in sorted(fixes))
+                subprocess.run(["debugfs", "-w", "-f", "-",
+                                "{0}?offset={1}".format(self.tmpfile, offset)],
+                               input=cmds.encode(), check=True, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def finalize(self):
+        """Finish off the image once the appliance is done with it:
+        compress it if requested, rename it to the correct name, and
+        record it.
+        """
+        if self.compress:
+            ctmp = "{0}.c".format(self.tmpfile)
+            try:
+                subprocess.run(["qemu-img", "convert", "-c", "-O", "qcow2", self.tmpfile, ctmp],
+                               check=True)
+                os.rename(ctmp, self.tmpfile)
+            finally:
+                if os.path.isfile(ctmp):
+                    os.remove(ctmp)
+        os.rename(self.tmpfile, self.filename)
+        self.record()
+        (apparent, allocated) = image_sizes(self.filename)
+        logger.info("Created %s: apparent size %s, allocated %s", self.filename,
+                    format_size(apparent), format_size(allocated))
+
+    def populate(self, gfs, disk):
+        """Create the partitions, filesystems and files on this image.
+        'gfs' is a launched guestfs handle with the image's temporary
+        file attached as 'disk' (there may be other disks attached to
+        the same handle, we only touch our own).
+        """
+        def partitions():
+            # the partitions on *our* disk, in order
+            return [partn for partn in gfs.list_partitions() if gfs.part_to_dev(partn) == disk]
+
+        # create a disk label
+        with span('part_init', self.filename):
             gfs.part_init(disk, self.label)
-            # create and format the partitions
-            for part in self.parts:
-                # each partition can specify a filesystem, if it doesn't,
-                # we use the image default
-                if 'filesystem' not in part:
-                    part['filesystem'] = self.filesystem
-                # create the partition: the dict must specify type ('p'
-                # for primary, 'l' for logical, 'e' for extended), and
-                # start and end sector numbers - more details in
-                # guestfs docs
+        # create and format the partitions
+        for part in self.parts:
+            # each partition can specify a filesystem, if it doesn't,
+            # we use the image default. note we must not write this
+            # into the part dict, it's shared with the other variants
+            filesystem = part.get('filesystem', self.filesystem)
+            # create the partition: the dict must specify type ('p'
+            # for primary, 'l' for logical, 'e' for extended), and
+            # start and end sector numbers - more details in
+            # guestfs docs
+            with span('part_add', self.filename):
                 gfs.part_add(disk, part['type'], int(part['start']), int(part['end']))
-                # identify the partition
-                partname = gfs.list_partitions()[-1]
-                partnum = gfs.part_list(disk)[-1]["part_num"]
-                # sometimes, we want to set the gpt type of the partition
-                gpt_type = part.get("gpt_type", None)
-                if gpt_type:
-                    gfs.part_set_gpt_type(disk, partnum, gpt_type)
-                # format the partition
-                gfs.mkfs(part['filesystem'], partname, label=part.get('label'))
-            # do file 'writes' (create a file with a given string as
-            # its content)
-            for write in self.writes:
-                # the write dict must specify the partition to be
-                # written to, numbered from 1 as humans usually do;
-                # find that part and mount it
-                partn = gfs.list_partitions()[int(write['part'])-1]
-                gfs.mount(partn, "/")
-                # do the write: the dict must specify the target path
-                # and the string to be written ('content')
-                gfs.write(write['path'], write['content'])
-                gfs.sync()
-                gfs.umount_opts("/")
-            # do file 'uploads'. in guestfs-speak that means transfer
-            # a file from the host to the image, we use it to mean
-            # download a file from an http server and transfer that
-            # to the image
-            for upload in self.uploads:
-                # as with write, the dict must specify a target
-                # partition and location ('target')
-                partn = gfs.list_partitions()[int(upload['part'])-1]
-                gfs.mount(partn, "/")
-                gfs.upload('/'.join((SCRIPTDIR, 'uploads', upload['source'])), upload['target'])
-                gfs.sync()
-                gfs.umount_opts("/")
-            # we're all done! rename to the correct name
-            os.rename(tmpfile, self.filename)
+            # identify the partition
+            partname = partitions()[-1]
+            partnum = gfs.part_list(disk)[-1]["part_num"]
+            # sometimes, we want to set the gpt type of the partition
+            gpt_type = part.get("gpt_type", None)
+            if gpt_type:
+                gfs.part_set_gpt_type(disk, partnum, gpt_type)
+            # format the partition
+            with span('mkfs', self.filename, filesystem=filesystem, partition=partnum):
+                gfs.mkfs(filesystem, partname, label=part.get('label'))
+
+        # do the file 'writes' (create a file with a given string as
+        # its content) and 'uploads' (in guestfs-speak that means
+        # transfer a file from the host to the image). each must
+        # specify the partition to be written to, numbered from 1 as
+        # humans usually do. we group them by partition so we only
+        # mount each partition once, and send all the uploads for a
+        # partition in a single tar stream
+        byparts = {}
+        for write in self.writes:
+            byparts.setdefault(int(write['part']), ([], []))[0].append(write)
+        for upload in self.uploads:
+            byparts.setdefault(int(upload['part']), ([], []))[1].append(upload)
+        partnames = partitions()
+        for (partnum, (writes, uploads)) in byparts.items():
+            with span('mount', self.filename, partition=partnum):
+                gfs.mount(partnames[partnum-1], "/")
+            for write in writes:
+                # the write dict must specify the target path and
+                # the string to be written ('content')
+                with span('write', self.filename, partition=partnum, path=write['path']):
+                    gfs.write(write['path'], write['content'])
+            if uploads:
+                # the upload dict must specify the source file (in
+                # the uploads/ directory) and the target path
+                with span('upload', self.filename, partition=partnum,
+                          paths=[upload['target'] for upload in uploads]):
+                    with tempfile.NamedTemporaryFile(suffix='.tar') as tarfh:
+                        _make_upload_tar(tarfh, uploads)
+                        gfs.tar_in(tarfh.name, "/")
+            gfs.umount_opts("/")
+        with span('sync', self.filename):
+            gfs.sync()
+
+    def verify(self, gfs, disk):
+        """Check the image matches its definition: the disk label, the
+        partition bounds, filesystems, filesystem labels and GPT types,
+        the contents of the 'writes' and the SHA-256 checksums of the
+        uploaded files. 'gfs' is a launched guestfs handle with the
+        image attached read-only as 'disk' (see verify_images()).
+        Returns a list of problems, empty if all is well.
+        """
+        problems = []
+        label = {'mbr': 'msdos'}.get(self.label, self.label)
+        try:
+            found = gfs.part_get_parttype(disk)
+        except RuntimeError:
+            return ["no partition table"]
+        if found != label:
+            problems.append("partition table is {0}, not {1}".format(found, label))
+        expected = sorted((start * 512, end * 512 + 511) for (_, start, end) in self.sectors())
+        actual = sorted((part['part_start'], part['part_end']) for part in gfs.part_list(disk))
+        if actual != expected:
+            problems.append("partitions are {0}, not {1}".format(
+                ', '.join("{0}-{1}".format(start // 512, end // 512) for (start, end) in actual),
+                ', '.join("{0}-{1}".format(start // 512, end // 512)
+                          for (start, end) in expected)))
+            return problems
+        partnames = [partn for partn in gfs.list_partitions() if gfs.part_to_dev(partn) == disk]
+        for (partnum, (part, partname)) in enumerate(zip(self.parts, partnames), 1):
+            if part['type'] == 'e':
+                continue
+            filesystem = part.get('filesystem', self.filesystem)
+            found = gfs.vfs_type(partname)
+            if found != filesystem:
+                problems.append("partition {0} has {1}, not {2}".format(
+                    partnum, found or 'no filesystem', filesystem))
+                continue
+            if part.get('label') and gfs.vfs_label(partname) != part['label']:
+                problems.append("partition {0} is labelled {1!r}, not {2!r}".format(
+                    partnum, gfs.vfs_label(partname), part['label']))
+            if part.get('gpt_type') and self.label == 'gpt':
+                found = gfs.part_get_gpt_type(disk, gfs.part_to_partnum(partname))
+                if found.upper() != part['gpt_type'].upper():
+                    problems.append("partition {0} has GPT type {1}, not {2}".format(
+                        partnum, found, part['gpt_type']))
+            writes = [write for write in self.writes if int(write['part']) == partnum]
+            uploads = [upload for upload in self.uploads if int(upload['part']) == partnum]
+            if not writes and not uploads:
+                continue
+            gfs.mount_ro(partname, "/")
+            try:
+                for write in writes:
+                    if not gfs.is_file(write['path']):
+                        problems.append("{0} is missing from partition {1}".format(
+                            write['path'], partnum))
+                    elif gfs.read_file(write['path']) != write['content'].encode():
+                        problems.append("{0} on partition {1} has the wrong content".format(
+                            write['path'], partnum))
+                for upload in uploads:
+                    source = '/'.join((SCRIPTDIR, 'uploads', upload['source']))
+                    with open(source, 'rb') as sourcefh:
+                        checksum = hashlib.sha256(sourcefh.read()).hexdigest()
+                    if not gfs.is_file(upload['target']):
+                        problems.append("{0} is missing from partition {1}".format(
+                            upload['target'], partnum))
+                    elif gfs.checksum('sha256', upload['target']) != checksum:
+                        problems.append("{0} on partition {1} doesn't match {2}".format(
+                            upload['target'], partnum, upload['source']))
+            finally:
+                gfs.umount_all()
+        return problems
+
+
+def _make_upload_tar(fileobj, uploads):
+    """Write a tar archive of the given 'uploads' entries to the open
+    file 'fileobj', with each source file from uploads/ stored at its
+    target path. The files are owned by root and mode 0644, just like
+    files sent with guestfs' upload().
+    """
+    import tarfile
+    now = time.time()
+    with tarfile.open(fileobj=fileobj, mode='w') as tar:
+        for upload in uploads:
+            source = '/'.join((SCRIPTDIR, 'uploads', upload['source']))
+            info = tarfile.TarInfo(upload['target'].lstrip('/'))
+            info.size = os.path.getsize(source)
+            info.mode = 0o644
+            info.mtime = now
+            with open(source, 'rb') as sourcefh:
+                tar.addfile(info, sourcefh)
+    fileobj.flush()
+
+
+# the GPT partition type GUID parted gives partitions by default
+# ('Linux filesystem data')
+GPT_LINUX = '0FC63DAF-8483-4772-8E79-3D69D8477DE4'
+
+def _chs(lba):
+    """The 3-byte cylinder/head/sector address of sector 'lba' for an
+    MBR partition entry, using the usual 255 head, 63 sector geometry
+    (or the 'too big, use the LBA' value, past 1024 cylinders).
+    """
+    (cyl, rem) = divmod(lba, 255 * 63)
+    (head, sector) = divmod(rem, 63)
+    if cyl > 1023:
+        return b'\xfe\xff\xff'
+    return bytes((head, ((cyl >> 2) & 0xc0) | (sector + 1), cyl & 0xff))
+
+def _mbr_entry(ptype, start, end):
+    """A 16-byte MBR partition table entry."""
+    return (b'\0' + _chs(start) + bytes((ptype,)) + _chs(end) +
+            struct.pack('<II', start, end - start + 1))
+
+def _gpt_header(disk, current, backup, entries, sectors, crc):
+    """A GPT header sector: 'current' and 'backup' are where this
+    header and the other one live, 'entries' where this header's copy
+    of the partition entries starts.
+    """
+    fields = [b'EFI PART', 0x10000, 92, 0, 0, current, backup, 34, sectors - 34, disk,
+              entries, 128, 128, crc]
+    header = struct.pack('<8sIIIIQQQQ16sQIII', *fields)
+    fields[3] = zlib.crc32(header)
+    return struct.pack('<8sIIIIQQQQ16sQIII', *fields).ljust(512, b'\0')
+
+def write_partition_table(path, size, label, parts):
+    """Write a partition table to the (blank) image file 'path' of
+    'size' bytes, as guestfs' part_init and part_add (which use
+    parted) would. 'label' is 'mbr' or 'gpt'. 'parts' is a list of
+    (first sector, last sector, GPT type GUID or None) tuples, all
+    primary partitions. MBR partitions get the Linux type (0x83) and
+    GPT ones the given type or GPT_LINUX, and the name 'primary'; the
+    disk and partition identifiers are random. Raises ValueError if a
+    GPT partition would overlap the GPT headers or tables, as parted
+    would refuse to create it.
+    """
+    sectors = size // 512
+    if label == 'gpt':
+        for (start, end, _) in parts:
+            if start < 34 or end > sectors - 34:
+                raise ValueError("partition {0}-{1} overlaps the GPT headers (usable sectors "
+                                 "34-{2})".format(start, end, sectors - 34))
+    with open(path, 'r+b') as imgfh:
+        if label == 'gpt':
+            disk = uuid.uuid4().bytes_le
+            table = b''.join(
+                uuid.UUID(gpt_type or GPT_LINUX).bytes_le + uuid.uuid4().bytes_le +
+                struct.pack('<QQQ', start, end, 0) +
+                'primary'.encode('utf-16-le').ljust(72, b'\0')
+                for (start, end, gpt_type) in parts).ljust(128 * 128, b'\0')
+            crc = zlib.crc32(table)
+            # a 'protective' MBR covering the whole disk comes first
+            mbr = _mbr_entry(0xee, 1, min(sectors - 1, 0xffffffff))
+            imgfh.write(bytes(446) + mbr + bytes(48) + b'\x55\xaa')
+            imgfh.write(_gpt_header(disk, 1, sectors - 1, 2, sectors, crc))
+            imgfh.write(table)
+            # and the backup copy of the table and header at the end
+            imgfh.seek((sectors - 33) * 512)
+            imgfh.write(table)
+            imgfh.write(_gpt_header(disk, sectors - 1, 1, sectors - 33, sectors, crc))
+        else:
+            entries = b''.join(_mbr_entry(0x83, start, end) for (start, end, _) in parts)
+            imgfh.write(bytes(440) + os.urandom(4) + bytes(2) + entries.ljust(64, b'\0') +
+                        b'\x55\xaa')
+
+def create_guestfs_images(imgs, imgctx=None):
+    """Create several GuestfsImages using a single guestfs appliance.
+    Booting the appliance is the most expensive part of building most
+    guestfs images, so we create all the temporary image files up
+    front, attach them all as drives, launch once, and then populate
+    each disk in turn. Each image is renamed into place as soon as it
+    is done (images that are to be compressed are finished off after
+    the appliance is shut down). If building one image fails, its
+    temporary file is wiped
+    and we carry on with the rest; returns a list of (image,
+    exception) tuples for the images that failed. If the appliance
+    itself can't be set up, all the temporary files are wiped and the
+    exception is raised. 'imgctx', if given, is a callable that takes
+    an image and returns a context manager that will be entered while
+    that image is being populated (build_images uses this for logging).
+    """
+    import guestfs
+    failed = []
+    compress = []
+    gfs = guestfs.GuestFS(python_return_dict=True)
+    try:
+        try:
+            for img in imgs:
+                # Create the disk image with a temporary name
+                with span('disk_create', img.filename):
+                    gfs.disk_create(img.tmpfile, img.imgformat, int(img.size))
+                # attach it to the appliance
+                gfs.add_drive_opts(img.tmpfile, format=img.imgformat, readonly=0)
+            # 'launch' guestfs with all the disks attached. this is
+            # shared by all the images, so not attributed to any
+            with span('launch', images=[img.filename for img in imgs]):
+                gfs.launch()
         except:
-            # if anything went wrong, we want to wipe the temp file
+            # if we couldn't get this far, wipe all the temp files
             # then raise
-            os.remove(tmpfile)
+            for img in imgs:
+                if os.path.isfile(img.tmpfile):
+                    os.remove(img.tmpfile)
             raise
+        # devices are listed in the order the drives were added
+        for (img, disk) in zip(imgs, gfs.list_devices()):
+            with imgctx(img) if imgctx else contextlib.nullcontext():
+                try:
+                    start = time.monotonic()
+                    with span('populate', img.filename):
+                        img.populate(gfs, disk)
+                    logger.info("Populated %s in %.2fs", img.filename, time.monotonic() - start)
+                    if img.compress:
+                        # can't do this while the appliance has the
+                        # image open
+                        compress.append(img)
+                    else:
+                        # we're all done! rename to the correct name
+                        img.finalize()
+                except Exception as err:
+                    # if anything went wrong, we want to wipe the temp
+                    # file, make sure nothing is left mounted, and move
+                    # on to the next image
+                    logger.error("Creation of %s failed: %s", img.filename, err)
+                    failed.append((img, err))
+                    # finalize() may have got as far as renaming it
+                    if os.path.isfile(img.tmpfile):
+                        os.remove(img.tmpfile)
+                    gfs.umount_all()
+    finally:
+        # whether things go right or wrong, we want to close the
+        # gfs instance, and rwmj recommends 'shutdown()' too
+        gfs.shutdown()
+        gfs.close()
+    for img in compress:
+        try:
+            logger.info("Compressing %s...", img.filename)
+            with span('compress', img.filename):
+                img.finalize()
+        except Exception as err:
+            logger.error("Creation of %s failed: %s", img.filename, err)
+            failed.append((img, err))
+            if os.path.isfile(img.tmpfile):
+                os.remove(img.tmpfile)
+    return failed
+
+
+def _verify_session(imgs):
+    """Verify the images in the list 'imgs' with a single guestfs
+    appliance, with them all attached read-only, for verify_images().
+    """
+    import guestfs
+    results = {}
+    gfs = guestfs.GuestFS(python_return_dict=True)
+    try:
+        for img in imgs:
+            gfs.add_drive_opts(img.filename, format=img.imgformat, readonly=1)
+        with span('launch', images=[img.filename for img in imgs]):
+            gfs.launch()
+        for (img, disk) in zip(imgs, gfs.list_devices()):
+            with span('verify', img.filename):
+                try:
+                    results[img.filename] = img.verify(gfs, disk)
+                except RuntimeError as err:
+                    results[img.filename] = ["verification failed: {0}".format(err)]
+    finally:
+        gfs.shutdown()
+        gfs.close()
+    return results
+
+def verify_images(imgs, sessions=1):
+    """Check the existing images in the list 'imgs' contain what their
+    definitions say they should (see the images' verify()). Booting
+    an appliance is the expensive part, so all the images are
+    attached to one appliance, or spread across 'sessions' appliances
+    running at once. Returns a dict of lists of problems, keyed by
+    image filename. If an appliance can't be launched, all of its
+    images get that as their problem.
+    """
+    import concurrent.futures
+    sessions = max(1, min(sessions, len(imgs)))
+    chunks = [imgs[num::sessions] for num in range(sessions)]
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=sessions) as executor:
+        futures = dict((executor.submit(_verify_session, chunk), chunk) for chunk in chunks)
+        for (future, chunk) in futures.items():
+            try:
+                results.update(future.result())
+            except RuntimeError as err:
+                for img in chunk:
+                    results[img.filename] = ["could not launch guestfs: {0}".format(err)]
+    return results
+
+def _mirror_handler():
+    """Returns the request handler class for MirrorCache. Only GET and
+    HEAD are supported; the MirrorCache instance is self.server.mirror.
+    The class is made here rather than at module level so http.server
+    is only imported when a mirror is actually used.
+    """
+    import http.server
+    class _MirrorHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.mirror.handle(self, head=False)
+
+        def do_HEAD(self):
+            self.server.mirror.handle(self, head=True)
+
+        def log_message(self, format, *args):
+            logger.debug("mirror: %s", format % args)
+
+    return _MirrorHandler
+
+
+class MirrorCache(object):
+    """A caching HTTP mirror of 'upstream' (by default, the Rocky
+    download server). A request for /some/path is answered from
+    'cachedir'/some/path if we have it, otherwise it is fetched from
+    'upstream'/some/path, stored in the cache, and sent on to the
+    client. Package files and checksum-named repodata never change,
+    so are served straight from the cache; everything else (the
+    .treeinfo, repomd.xml, kernel and initrd...) is revalidated with
+    upstream using If-Modified-Since, but still served from the cache
+    if upstream says it's unchanged or can't be reached. When the
+    cache grows past 'maxsize' bytes, the least recently used files
+    are evicted. The mirror listens on 'port' (0 means pick a free
+    one) on all addresses; 'address' is the address clients are
+    told to use. It must be reachable both from the host (virt-install
+    fetches the kernel and initrd) and from install guests, so it
+    defaults to the host's primary address. Hit and miss counts are
+    kept in 'stats'.
+    """
+    def __init__(self, cachedir, maxsize, upstream=UPSTREAM, address=None, port=0):
+        self.cachedir = os.path.abspath(cachedir)
+        self.maxsize = maxsize
+        self.upstream = upstream.rstrip('/')
+        self.address = address or self._default_address()
+        self.port = port
+        self.server = None
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'bytes_served': 0,
+                      'bytes_fetched': 0, 'evictions': 0}
+        os.makedirs(self.cachedir, exist_ok=True)
+        self.cachesize = sum(size for (_, _, size) in self._cached_files())
+
+    @staticmethod
+    def _default_address():
+        """Find the host's primary address: the one we'd use to talk
+        to the outside world. No packets are actually sent.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect(('192.0.2.1', 80))
+            return sock.getsockname()[0]
+        except OSError:
+            return socket.gethostbyname(socket.gethostname())
+        finally:
+            sock.close()
+
+    @property
+    def url(self):
+        """The base URL clients should use in place of upstream."""
+        return "http://{0}:{1}".format(self.address, self.port)
+
+    def start(self):
+        """Start serving, in a background thread."""
+        import http.server
+        self.server = http.server.ThreadingHTTPServer(('', self.port), _mirror_handler())
+        self.server.daemon_threads = True
+        self.server.mirror = self
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        logger.info("Caching mirror of %s running at %s", self.upstream, self.url)
+
+    def stop(self):
+        """Stop serving and log the statistics."""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        logger.info("Mirror cache: %s hits, %s misses, %s revalidated; %s served, %s "
+                    "fetched, %s evictions", self.stats['hits'], self.stats['misses'],
+                    self.stats['revalidated'], format_size(self.stats['bytes_served']),
+                    format_size(self.stats['bytes_fetched']), self.stats['evictions'])
+
+    def _count(self, **kwargs):
+        with self.lock:
+            for (key, value) in kwargs.items():
+                self.stats[key] += value
+
+    def _cached_files(self):
+        """Yields (path, atime, size) for every file in the cache."""
+        for (root, _, files) in os.walk(self.cachedir):
+            for name in files:
+                if name.endswith('.part'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield (path, stat.st_atime, stat.st_size)
+
+    def _evict(self):
+        """If the cache is over its maximum size, remove the least
+        recently used files until it's back down to 90% of it.
+        """
+        with self.lock:
+            if self.cachesize <= self.maxsize:
+                return
+            for (path, _, size) in sorted(self._cached_files(), key=lambda item: item[1]):
+                if self.cachesize <= self.maxsize * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.cachesize -= size
+                self.stats['evictions'] += 1
+
+    @staticmethod
+    def _immutable(path):
+        """Whether the file at this path never changes upstream, so we
+        don't need to revalidate it.
+        """
+        name = os.path.basename(path)
+        if name.endswith('.rpm'):
+            return True
+        # repodata files other than repomd.xml are named for their
+        # checksum
+        return '/repodata/' in path and name != 'repomd.xml'
+
+    def handle(self, request, head=False):
+        """Answer a request (see _mirror_handler())."""
+        import email.utils
+        import urllib.error
+        import urllib.request
+        path = urllib.parse.urlsplit(request.path).path
+        parts = [part for part in path.split('/') if part]
+        if path.endswith('/') or not parts or '..' in parts:
+            # we don't cache directory listings
+            request.send_error(404)
+            return
+        cpath = os.path.join(self.cachedir, *parts)
+        url = self.upstream + '/' + '/'.join(parts)
+        cached = os.path.isfile(cpath)
+        if cached and self._immutable(path):
+            self._serve(request, cpath, head)
+            return
+        req = urllib.request.Request(url, method='HEAD' if head and not cached else 'GET')
+        if cached:
+            req.add_header('If-Modified-Since', email.utils.formatdate(
+                os.path.getmtime(cpath), usegmt=True))
+        try:
+            resp = urllib.request.urlopen(req, timeout=60)
+        except urllib.error.HTTPError as err:
+            if cached and err.code == 304:
+                self._count(revalidated=1)
+                self._serve(request, cpath, head)
+            elif cached and err.code >= 500:
+                self._serve(request, cpath, head)
+            else:
+                request.send_error(err.code)
+            return
+        except (OSError, urllib.error.URLError) as err:
+            if cached:
+                logger.debug("mirror: can't revalidate %s (%s), using cached copy", url, err)
+                self._serve(request, cpath, head)
+            else:
+                request.send_error(502)
+            return
+        with resp:
+            if head and not cached:
+                request.send_response(200)
+                request.send_header('Content-Length', resp.headers.get('Content-Length', '0'))
+                request.end_headers()
+                return
+            self._fetch(request, resp, cpath, head)
+
+    def _serve(self, request, cpath, head):
+        """Send a cached file to the client."""
+        import email.utils
+        try:
+            stat = os.stat(cpath)
+            # record the access for LRU eviction, preserving the mtime
+            # (it's the upstream Last-Modified)
+            os.utime(cpath, (time.time(), stat.st_mtime))
+            with open(cpath, 'rb') as cfile:
+                request.send_response(200)
+                request.send_header('Content-Length', str(stat.st_size))
+                request.send_header('Last-Modified', email.utils.formatdate(
+                    stat.st_mtime, usegmt=True))
+                request.end_headers()
+                if not head:
+                    shutil.copyfileobj(cfile, request.wfile, 1024 * 1024)
+        except OSError:
+            # evicted under us, or the client went away
+            return
+        self._count(hits=1, bytes_served=0 if head else stat.st_size)
+
+    def _fetch(self, request, resp, cpath, head):
+        """Stream an upstream response to the client and into the cache
+        at the same time. The file is only added to the cache if the
+        whole thing was received.
+        """
+        import email.utils
+        self._count(misses=1)
+        os.makedirs(os.path.dirname(cpath), exist_ok=True)
+        (fd, partfile) = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(cpath))
+        received = 0
+        try:
+            with os.fdopen(fd, 'wb') as part:
+                request.send_response(200)
+                length = resp.headers.get('Content-Length')
+                if length:
+                    request.send_header('Content-Length', length)
+                request.end_headers()
+                for chunk in iter(lambda: resp.read(1024 * 1024), b''):
+                    part.write(chunk)
+                    received += len(chunk)
+                    if not head:
+                        try:
+                            request.wfile.write(chunk)
+                        except OSError:
+                            # the client went away, but we may as
+                            # well finish caching the file
+                            head = True
+            if length and received != int(length):
+                return
+            modified = resp.headers.get('Last-Modified')
+            if modified:
+                mtime = email.utils.parsedate_to_datetime(modified).timestamp()
+                os.utime(partfile, (time.time(), mtime))
+            replaced = os.path.getsize(cpath) if os.path.isfile(cpath) else 0
+            os.rename(partfile, cpath)
+            with self.lock:
+                self.cachesize += received - replaced
+        finally:
+            if os.path.exists(partfile):
+                os.remove(partfile)
+            self._count(bytes_fetched=received, bytes_served=0 if head else received)
+        self._evict()
+
+
+_EVENTLOOP = {'lock': threading.Lock(), 'started': False}
+
+def _start_libvirt_events():
+    """Register libvirt's default event loop implementation and run it
+    in a background thread, so connections opened afterwards can
+    deliver domain lifecycle events (see InstallMonitor). Only done
+    once per process. If it can't be done, InstallMonitor falls back
+    on polling the domain state.
+    """
+    import libvirt
+    with _EVENTLOOP['lock']:
+        if _EVENTLOOP['started']:
+            return
+        _EVENTLOOP['started'] = True
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except libvirt.libvirtError as err:
+            logger.debug("Could not register libvirt event loop: %s", err)
+            return
+
+    def _run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    threading.Thread(target=_run, name='libvirt-events', daemon=True).start()
+
+class AdmissionController(object):
+    """Decides when the host has room for another install VM, so many
+    virt-install images can be built at once without overcommitting
+    it. admit() blocks until there is enough available memory (going
+    by MemAvailable, less what is reserved for installs already
+    admitted, plus 'memheadroom'), a spare CPU (fewer installs than
+    CPUs, and a load average below the number of CPUs) and enough
+    free disk space in 'path' for the image at its full size (less
+    what is reserved for installs already admitted, plus
+    'diskheadroom').
+    Reservations are for the most the install can use, so this errs
+    on the side of caution. If nothing else is being installed, an
+    install is always admitted (with a warning if the host looks
+    short), so the build can't get stuck. After abort(), nothing more
+    is admitted. Safe to share between threads.
+    """
+    def __init__(self, path='.', memheadroom=1024**3, diskheadroom=1024**3, interval=10):
+        self.path = path
+        self.memheadroom = memheadroom
+        self.diskheadroom = diskheadroom
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.inflight = {}
+        self.aborted = False
+
+    def abort(self):
+        """Refuse any more installs, including those waiting."""
+        with self.cond:
+            self.aborted = True
+            self.cond.notify_all()
+
+    @staticmethod
+    def _memavailable():
+        """MemAvailable from /proc/meminfo, in bytes, or None if we
+        can't read it.
+        """
+        try:
+            with open('/proc/meminfo', 'r') as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def _shortages(self, memory, disk):
+        """Returns a list of what the host is short of to start an
+        install needing 'memory' and 'disk' bytes (empty if nothing).
+        Call with self.cond held.
+        """
+        shortages = []
+        resmem = sum(mem for (mem, _) in self.inflight.values())
+        resdisk = sum(dsk for (_, dsk) in self.inflight.values())
+        avail = self._memavailable()
+        if avail is not None and avail - resmem < memory + self.memheadroom:
+            shortages.append("memory ({0} available, {1} reserved, {2} needed)".format(
+                format_size(avail), format_size(resmem), format_size(memory)))
+        ncpus = os.cpu_count() or 1
+        if len(self.inflight) >= ncpus or os.getloadavg()[0] >= ncpus:
+            shortages.append("CPU ({0} installs running, load {1:.1f} on {2} CPUs)".format(
+                len(self.inflight), os.getloadavg()[0], ncpus))
+        stat = os.statvfs(self.path)
+        free = stat.f_bavail * stat.f_frsize
+        if free - resdisk < disk + self.diskheadroom:
+            shortages.append("disk space ({0} free, {1} reserved, {2} needed)".format(
+                format_size(free), format_size(resdisk), format_size(disk)))
+        return shortages
+
+    def admit(self, image, memory, disk):
+        """Wait until there's room to install 'image', which needs up
+        to 'memory' bytes of RAM and 'disk' bytes of disk space, then
+        reserve them. Returns a context manager which releases the
+        reservation when it exits; wrap the install in it.
+        """
+        waiting = False
+        with self.cond:
+            while True:
+                if self.aborted:
+                    sys.exit("Build interrupted before {0} could start".format(image))
+                shortages = self._shortages(memory, disk)
+                if not shortages:
+                    break
+                if not self.inflight:
+                    logger.warning("Host is short of %s, but nothing else is being installed, so "
+                                   "starting %s anyway", ', '.join(shortages), image)
+                    break
+                if not waiting:
+                    logger.info("Waiting for room to install %s: short of %s", image,
+                                ', '.join(shortages))
+                    waiting = True
+                self.cond.wait(self.interval)
+            self.inflight[image] = (memory, disk)
+
+        @contextlib.contextmanager
+        def _reservation():
+            try:
+                yield
+            finally:
+                with self.cond:
+                    del self.inflight[image]
+                    self.cond.notify_all()
+        return _reservation()
+
+class BuildContext(object):
+    """State shared by all the image builds in a single run, so things
+    that only need doing once per run are only done once. Holds a
+    single libvirt connection ('conn', opened when first needed), the
+    results of osinfo lookups (see os_variant()), the MirrorCache
+    virt-install images should use, if any ('mirror'), and the
+    AdmissionController which decides when installs can start
+    ('admission'). It keeps track of the libvirt domains the run's
+    installs are using; close() stops any that are still running,
+    and never touches any other domain. abort() stops them, and the
+    virt-install processes, straight away when the build is
+    interrupted. It also runs the compaction
+    of installed images in the background (see compact()). osinfo
+    results
+    are also cached on disk in 'osinfo_cache' (unless it's None), keyed
+    on the osinfo database version, so later runs don't need to query
+    it at all. 'stall_timeout' is how long (in seconds) a virt-install
+    may go without making progress before it is killed and retried,
+    and 'install_timeout' how long it may take in all, progress or not
+    (see InstallMonitor). Safe to share between threads. Call close()
+    when done.
+    """
+    def __init__(self, mirror=None, osinfo_cache=None, stall_timeout=900,
+                 install_timeout=3600):
+        self.mirror = mirror
+        self.osinfo_cache = osinfo_cache
+        self.stall_timeout = stall_timeout
+        self.install_timeout = install_timeout
+        self.admission = AdmissionController()
+        self.lock = threading.Lock()
+        self.domains = set()
+        self.procs = set()
+        self.aborted = threading.Event()
+        self.compactions = []
+        self._compactor = None
+        self._conn = None
+        self._dbversion = self._osinfo_db_version()
+        self._shortids = {}
+        if osinfo_cache and self._dbversion:
+            try:
+                with open(osinfo_cache, 'r') as cachefh:
+                    cache = json.load(cachefh)
+                if cache.get('dbversion') == self._dbversion:
+                    self._shortids = cache.get('shortids', {})
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def _osinfo_db_version():
+        """Returns a string identifying the installed osinfo database,
+        or None if we can't tell.
+        """
+        try:
+            with open('/usr/share/osinfo/VERSION', 'r') as verfh:
+                return verfh.read().strip()
+        except OSError:
+            pass
+        try:
+            return str(os.path.getmtime('/usr/share/osinfo'))
+        except OSError:
+            return None
+
+    @property
+    def conn(self):
+        """The shared libvirt connection. Reopened if it has died."""
+        import libvirt
+        with self.lock:
+            if self._conn is None or not self._conn.isAlive():
+                # the event loop has to be registered before the
+                # connection is opened for it to get events
+                _start_libvirt_events()
+                self._conn = libvirt.open()
+            return self._conn
+
+    def os_variant(self, release):
+        """Figure out the best virt-install --os-variant for a release.
+        osinfo doesn't know about beta, rc# and lookahead releases, so
+        we always use 'rockyN-unknown', which osinfo treats as 'the
+        latest Rocky N'.
+        """
+        # figure out the best os-variant. NOTE: libosinfo >= 0.3.1
+        # properly returns 1 on failure, but using workaround for old
+        # bug where it didn't in case EPEL doesn't have 0.3.1
+        shortid = "rocky{0}".format(release)
+        # rocky has beta, rc# and lookahead releases that aren't in osinfo db
+        # replace text suffix in those with unknown.
+        shortid = "{0}-unknown".format(shortid.split('-')[0])
+        with self.lock:
+            if shortid in self._shortids:
+                return self._shortids[shortid]
+        args = ["osinfo-query", "os", "short-id={0}".format(shortid)]
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        out = process.communicate()[0].decode()
+        variant = shortid
+        if shortid not in out:
+            # this will just use the most recent rocky release number
+            # virt-install / osinfo knows
+            variant = "rocky{0}".format(release).split('.')[0] + "-unknown"
+        with self.lock:
+            self._shortids[shortid] = variant
+            if self.osinfo_cache and self._dbversion:
+                try:
+                    os.makedirs(os.path.dirname(self.osinfo_cache), exist_ok=True)
+                    with open(self.osinfo_cache, 'w') as cachefh:
+                        json.dump({'dbversion': self._dbversion, 'shortids': self._shortids},
+                                  cachefh)
+                except OSError as err:
+                    logger.debug("Could not write osinfo cache: %s", err)
+        return variant
+
+    def compact(self, img, tmpfile):
+        """Queue the compaction of 'img' from 'tmpfile', its freshly
+        installed temporary file (see
+        VirtInstallImage.run_compaction()). It's done by a background
+        worker, so the next install can get on while it runs; collect
+        the results with finish_compactions().
+        """
+        import concurrent.futures
+        with self.lock:
+            if self._compactor is None:
+                self._compactor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='compact')
+            logger.info("Queueing compaction of %s", img.filename)
+            self.compactions.append((img, self._compactor.submit(img.run_compaction, tmpfile)))
+
+    def finish_compactions(self):
+        """Wait for all queued compactions to finish. Returns a list of
+        (image, exception) tuples for the ones that failed.
+        """
+        with self.lock:
+            compactions = self.compactions
+            self.compactions = []
+        failed = []
+        for (img, future) in compactions:
+            try:
+                future.result()
+            except Exception as err:
+                logger.error("Compaction of %s failed: %s", img.filename, err)
+                failed.append((img, err))
+        return failed
+
+    def track_domain(self, name):
+        """Note that an install is using the libvirt domain 'name'."""
+        with self.lock:
+            self.domains.add(name)
+
+    def untrack_domain(self, name):
+        """Note that the domain 'name' has been cleaned up."""
+        with self.lock:
+            self.domains.discard(name)
+
+    @contextlib.contextmanager
+    def track_process(self, proc):
+        """Context manager noting that the virt-install process 'proc'
+        is running for as long as it's entered (see abort()).
+        """
+        with self.lock:
+            self.procs.add(proc)
+        try:
+            yield proc
         finally:
-            # whether things go right or wrong, we want to close the
-            # gfs instance, and rwmj recommends 'shutdown()' too
-            gfs.shutdown()
-            gfs.close()
+            with self.lock:
+                self.procs.discard(proc)
 
+    def abort(self):
+        """Give up on the run, when it's interrupted: no more installs
+        are started or retried, and no install that ends from now on
+        is kept (see VirtInstallImage._install()); the domains in use
+        are destroyed and virt-install is terminated, so the workers
+        unwind now, rather than when their installs would have
+        finished. close() still has to be called.
+        """
+        import libvirt
+        self.aborted.set()
+        self.admission.abort()
+        with self.lock:
+            domains = sorted(self.domains)
+            procs = list(self.procs)
+            conn = self._conn
+        if conn is not None:
+            for name in domains:
+                try:
+                    conn.lookupByName(name).destroy()
+                    logger.info("Stopped libvirt domain %s", name)
+                except libvirt.libvirtError:
+                    # not running, or already gone
+                    pass
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+
+    def close(self):
+        """Stop any domains our installs left running (they're left
+        defined, for debugging), wait for any compactions, and close
+        the libvirt connection, if we opened one.
+        """
+        import libvirt
+        if self._compactor is not None:
+            self._compactor.shutdown(wait=True)
+        with self.lock:
+            if self._conn is not None:
+                for name in sorted(self.domains):
+                    try:
+                        self._conn.lookupByName(name).destroy()
+                        logger.info("Stopped libvirt domain %s", name)
+                    except libvirt.libvirtError:
+                        # not running, or already gone
+                        pass
+                self.domains.clear()
+                try:
+                    self._conn.close()
+                except libvirt.libvirtError:
+                    pass
+                self._conn = None
+
+
+class InstallMonitor(object):
+    """Watches the libvirt domain a virt-install process ('proc') is
+    installing into, from a background thread, and kills the install
+    if it gets stuck. Every 'interval' seconds it samples the domain's
+    block I/O on the image being installed ('disk'), its network I/O
+    and its CPU time; if none of them have moved for 'window' seconds
+    (or the domain hasn't even appeared in that time), the install is
+    considered stalled. An install that is still going after 'limit'
+    seconds is killed too, however busy it is, as a guest can keep
+    busy without ever finishing (an installer stuck in a loop, say);
+    a 'limit' of 0 means no limit. CPU time counts because with user-mode
+    networking there are no network statistics, and the installer
+    spends a while downloading its stage 2 image into RAM, which
+    causes no disk I/O; a guest which is just idling uses well under
+    'mincpu' (a fraction of one CPU) so doesn't count. The install
+    also fails straight away if the guest crashes or is paused on an
+    I/O error, which we find out from lifecycle events if libvirt's
+    event loop is running, and from polling the domain state if not.
+    When an install fails, 'stalled' is set to the reason, the domain
+    is destroyed and virt-install is terminated. Progress is logged
+    every 'report' seconds. Call start() once virt-install has been
+    started and stop() once it has exited.
+    """
+    def __init__(self, ctx, domname, image, disk, proc, window, limit=0, interval=10,
+                 report=60, mincpu=0.05):
+        self.ctx = ctx
+        self.domname = domname
+        self.image = image
+        self.disk = disk
+        self.proc = proc
+        self.window = window
+        self.limit = limit
+        self.interval = interval
+        self.report = report
+        self.mincpu = mincpu
+        self.stalled = None
+        self.failed = None
+        self._done = threading.Event()
+        self._wake = threading.Event()
+        self._callback = None
+        self._thread = None
+
+    def start(self):
+        """Start watching."""
+        import libvirt
+        try:
+            self._callback = self.ctx.conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._lifecycle, None)
+        except libvirt.libvirtError as err:
+            logger.debug("No lifecycle events, will poll domain state: %s", err)
+        self._thread = threading.Thread(target=self._run, name="monitor-{0}".format(self.image),
+                                        args=(getattr(_LOGCTX, 'image', None),), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching, and wait for the monitor thread to finish."""
+        import libvirt
+        self._done.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        if self._callback is not None:
+            try:
+                self.ctx.conn.domainEventDeregisterAny(self._callback)
+            except libvirt.libvirtError:
+                pass
+            self._callback = None
 
-class VirtInstallImage(object):
+    def _lifecycle(self, _conn, dom, event, detail, _opaque):
+        """libvirt lifecycle event callback. Runs in the event loop
+        thread, so just notes any failure and wakes the monitor.
+        """
+        import libvirt
+        if dom.name() != self.domname:
+            return
+        if event == libvirt.VIR_DOMAIN_EVENT_CRASHED:
+            self.failed = "guest crashed"
+        elif (event == libvirt.VIR_DOMAIN_EVENT_SUSPENDED and
+              detail == libvirt.VIR_DOMAIN_EVENT_SUSPENDED_IOERROR):
+            self.failed = "guest paused on an I/O error"
+        else:
+            return
+        self._wake.set()
+
+    def _sample(self, dom):
+        """Returns the domain's (block I/O bytes, network I/O bytes,
+        CPU time in seconds) so far.
+        """
+        import libvirt
+        (_, rdbytes, _, wrbytes, _) = dom.blockStats(self.disk)
+        netbytes = 0
+        xml = ET.fromstring(dom.XMLDesc(0))
+        for target in xml.findall('./devices/interface/target'):
+            try:
+                stats = dom.interfaceStats(target.get('dev'))
+            except libvirt.libvirtError:
+                continue
+            netbytes += stats[0] + stats[4]
+        cputime = dom.info()[4] / 1e9
+        return (rdbytes + wrbytes, netbytes, cputime)
+
+    def _run(self, logimage):
+        import libvirt
+        # log to the image's log file, like the thread we're watching
+        _LOGCTX.image = logimage
+        start = lastprogress = lastreport = time.monotonic()
+        last = None
+        seen = failedsample = False
+        while not self._done.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._done.is_set():
+                return
+            now = time.monotonic()
+            if self.failed:
+                self._kill(self.failed)
+                return
+            if self.limit and now - start > self.limit:
+                self._kill("not finished after {0}s".format(self.limit))
+                return
+            try:
+                dom = self.ctx.conn.lookupByName(self.domname)
+                (state, reason) = dom.state()
+            except libvirt.libvirtError:
+                # virt-install hasn't defined the domain yet (or it
+                # just went away)
+                dom = None
+            if dom is None:
+                if not seen and now - start > self.window:
+                    self._kill("domain did not start within {0}s".format(self.window))
+                    return
+                continue
+            seen = True
+            if state == libvirt.VIR_DOMAIN_CRASHED:
+                self._kill("guest crashed")
+                return
+            if state == libvirt.VIR_DOMAIN_PAUSED and reason == libvirt.VIR_DOMAIN_PAUSED_IOERROR:
+                self._kill("guest paused on an I/O error")
+                return
+            try:
+                sample = self._sample(dom)
+            except libvirt.libvirtError as err:
+                # the domain is there but we can't tell what it's
+                # doing (it may have just gone away); don't count this
+                # as a stall, just the overall limit applies
+                if not failedsample:
+                    logger.warning("Can't sample install progress: %s", err)
+                failedsample = True
+                continue
+            if last is None or (sample[0] != last[0] or sample[1] != last[1] or
+                                sample[2] - last[2] > self.mincpu * self.interval):
+                lastprogress = now
+            last = sample
+            if now - lastreport >= self.report:
+                lastreport = now
+                logger.info("Install progress: %s disk I/O, %s network I/O, %.0fs CPU, "
+                            "%.0fs elapsed", format_size(sample[0]), format_size(sample[1]),
+                            sample[2], now - start)
+            if state == libvirt.VIR_DOMAIN_RUNNING and now - lastprogress > self.window:
+                self._kill("no progress for {0:.0f}s".format(now - lastprogress))
+                return
+
+    def _kill(self, reason):
+        """Give up on the install: destroy the domain, which usually
+        makes virt-install exit, and terminate virt-install if not.
+        """
+        import libvirt
+        self.stalled = reason
+        logger.warning("Install of %s failed: %s, killing it", self.image, reason)
+        try:
+            self.ctx.conn.lookupByName(self.domname).destroy()
+        except libvirt.libvirtError:
+            pass
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+def parse_kickstart(path):
+    """Very simple kickstart parser, just enough for kickstart_delta().
+    Returns a dict with 'commands' (a list of the command lines),
+    'packages' (a list of the lines of the %packages section) and
+    'post' (a list of (options, script) tuples, one for each %post
+    section). Comments, blank lines and other sections are skipped.
+    """
+    parsed = {'commands': [], 'packages': [], 'post': []}
+    section = None
+    with open(path, 'r') as ksfh:
+        for line in ksfh:
+            stripped = line.strip()
+            if stripped.startswith('%'):
+                words = stripped.split()
+                if words[0] == '%packages':
+                    section = 'packages'
+                elif words[0] == '%post':
+                    section = 'post'
+                    parsed['post'].append((words[1:], []))
+                elif words[0] == '%end':
+                    section = None
+                else:
+                    section = 'other'
+                continue
+            if section == 'post':
+                parsed['post'][-1][1].append(line)
+                continue
+            if not stripped or stripped.startswith('#'):
+                continue
+            if section == 'packages':
+                parsed['packages'].append(stripped)
+            elif section is None:
+                parsed['commands'].append(stripped)
+    parsed['post'] = [(opts, ''.join(lines)) for (opts, lines) in parsed['post']]
+    return parsed
+
+def _ks_options(words):
+    """Parse kickstart command options like '--name=foo' or '--plaintext'
+    into a dict, plus a list of the other arguments.
+    """
+    opts = {}
+    rest = []
+    for word in words:
+        if word.startswith('--'):
+            (key, _, value) = word[2:].partition('=')
+            opts[key] = value
+        else:
+            rest.append(word)
+    return (opts, rest)
+
+def _ks_password(user, opts, password):
+    """virt-customize arguments to set 'user''s password as a kickstart
+    rootpw or user command would.
+    """
+    if 'lock' in opts:
+        return ["--run-command", "passwd -l {0}".format(shlex.quote(user))]
+    if 'iscrypted' in opts:
+        return ["--run-command", "usermod -p {0} {1}".format(shlex.quote(password),
+                                                             shlex.quote(user))]
+    return ["--password", "{0}:password:{1}".format(user, password)]
+
+def kickstart_delta(baseks, ks):
+    """Work out how to turn a system installed from kickstart 'baseks'
+    into one as if installed from kickstart 'ks', without installing
+    it: returns a list of virt-customize arguments and a list of
+    scripts to run with --run. Package (and group and environment)
+    lines in ks's %packages but not baseks's are installed, and '-pkg'
+    lines removed; rootpw, user and firstboot commands that differ
+    are applied; %post scripts that differ are run. Differences in
+    the url and repo commands (the install source) don't matter. Any
+    other difference (say, in partitioning) can't be applied to an
+    installed system, so raises ValueError. That includes %packages
+    lines baseks has and ks drops (unless ks removes the package with
+    a '-pkg' line, or installs one baseks removed): what a fresh
+    install would leave out of those, and what removing them would
+    take with it, can't be told from the kickstarts.
+    """
+    base = parse_kickstart(baseks)
+    new = parse_kickstart(ks)
+    args = []
+    install = [pkg for pkg in new['packages']
+               if not pkg.startswith('-') and pkg not in base['packages']]
+    uninstall = [pkg[1:] for pkg in new['packages']
+                 if pkg.startswith('-') and pkg not in base['packages']]
+    for pkg in [pkg for pkg in base['packages'] if pkg not in new['packages']]:
+        if pkg.startswith('-') and pkg[1:] in new['packages']:
+            continue
+        if '-' + pkg in new['packages']:
+            continue
+        raise ValueError("%packages line '{0}' is in the base but not here".format(pkg))
+    if install:
+        args.extend(("--install", ','.join(install)))
+    if uninstall:
+        args.extend(("--uninstall", ','.join(uninstall)))
+    for command in [cmd for cmd in new['commands'] if cmd not in base['commands']]:
+        words = shlex.split(command)
+        (opts, rest) = _ks_options(words[1:])
+        if words[0] in ('url', 'repo'):
+            continue
+        elif words[0] == 'rootpw':
+            args.extend(_ks_password('root', opts, rest[0] if rest else ''))
+        elif words[0] == 'user':
+            useradd = ["useradd", opts['name']]
+            if opts.get('groups'):
+                useradd[1:1] = ["-G", opts['groups']]
+            args.extend(("--run-command", ' '.join(shlex.quote(word) for word in useradd)))
+            if 'password' in opts:
+                args.extend(_ks_password(opts['name'], opts, opts['password']))
+        elif words[0] == 'firstboot':
+            action = 'disable' if 'disable' in opts else 'enable'
+            args.extend(("--run-command", "systemctl {0} initial-setup.service".format(action)))
+        else:
+            raise ValueError("kickstart command '{0}' differs from the base".format(command))
+    for command in [cmd for cmd in base['commands'] if cmd not in new['commands']]:
+        if shlex.split(command)[0] not in ('url', 'repo', 'rootpw', 'user', 'firstboot'):
+            raise ValueError("kickstart command '{0}' differs from the base".format(command))
+    scripts = []
+    for (opts, script) in new['post']:
+        if (opts, script) in base['post']:
+            continue
+        (postopts, _) = _ks_options(opts)
+        if 'nochroot' in postopts:
+            raise ValueError("%post --nochroot scripts can't be run on an installed system")
+        scripts.append("#!{0}\n{1}".format(postopts.get('interpreter') or '/bin/sh', script))
+    return (args, scripts)
+
+class VirtInstallImage(Image):
     """Class representing an image created by virt-install. 'release'
     is the release the image will be built for. 'arch' is the arch.
     'size' is the desired image size, in gigabytes. 'imgver' is
@@ -204,10 +2206,22 @@ class VirtInstallImage(object):
     included in the image file name if specified. 'maxage' is the
     maximum age of the image file (in days) - if the image is older
     than this, 'check' will report it as 'outdated' and 'all' will
-    rebuild it. 'bootopts' are used to pass boot options to the
-    virtual image to provide better control of the VM.
+    rebuild it (as they will if the kickstart or other inputs change,
+    see Image.outdated). 'bootopts' are used to pass boot options to
+    the virtual image to provide better control of the VM. If
+    'compact' is True, the image is compacted after the install (see
+    run_compaction()); 'compress' does that too, and compresses it as
+    well. If 'base' is another VirtInstallImage, this image isn't
+    installed with virt-install at all, but derived from that one
+    (see derive()). 'disk_profile' is the name of one of the
+    DISK_PROFILES, or a dict of the same kind of settings, for the
+    install VM's disk (see disk_args()).
     """
-    def __init__(self, name, release, arch, size, imgver='', maxage=14, bootopts=None):
+    # virt-install images are always qcow2
+    imgformat = 'qcow2'
+
+    def __init__(self, name, release, arch, size, imgver='', maxage=14, bootopts=None,
+                 compact=False, compress=False, base=None, disk_profile=None):
         self.name = name
         self.size = size
         self.filename = "disk_rocky{0}_{1}".format(str(release), name)
@@ -218,6 +2232,25 @@ class VirtInstallImage(object):
         self.arch = arch
         self.maxage = maxage
         self.bootopts = bootopts
+        self.compress = compress
+        self.compact = compact or compress
+        self.base = base
+        if isinstance(disk_profile, dict):
+            self.disk_profile = disk_profile
+        else:
+            self.disk_profile = DISK_PROFILES[disk_profile or 'default']
+
+    @property
+    def kickstart_candidates(self):
+        """The kickstart files that could be used for the image, most
+        specific first (see kickstart_file).
+        """
+        return [
+            f"{self.name}-{self.release}-{self.arch}.ks",
+            f"{self.name}-{self.release}.ks",
+            f"{self.name}-{self.arch}.ks",
+            f"{self.name}.ks"
+        ]
 
     @property
     def kickstart_file(self):
@@ -228,74 +2261,341 @@ class VirtInstallImage(object):
         * name-arch.ks
         * name.ks
         """
-        cands = [
-            f"{self.name}-{self.release}-{self.arch}.ks",
-            f"{self.name}-{self.release}.ks",
-            f"{self.name}-{self.arch}.ks",
-            f"{self.name}.ks"
-        ]
-        for cand in cands:
+        for cand in self.kickstart_candidates:
             if os.path.isfile("/".join((SCRIPTDIR, cand))):
                 logger.debug("Using kickstart %s", cand)
                 return cand
 
-    def create(self, baseurl, textinst, retries=3):
-        """Create the image."""
+    def fingerprint_inputs(self, legacy=False):
+        """The fingerprint inputs for the image's install: the release,
+        arch, size and boot options, and the kickstart (which kickstart
+        file is used, and its contents), plus the compaction settings
+        if any are set and the fingerprint of the base image, for
+        derived images. The name, imgver and maxage aren't included.
+        """
+        ksfile = self.kickstart_file
+        inputs = {
+            'type': 'virtinstall',
+            'release': str(self.release),
+            'arch': self.arch,
+            'size': str(self.size),
+            'bootopts': self.bootopts,
+            'kickstart': ksfile,
+        }
+        # only included when set, so turning them on doesn't change the
+        # fingerprint of every existing image
+        if self.compact:
+            inputs['compact'] = True
+        if self.compress:
+            inputs['compress'] = True
+        if self.base:
+            inputs['base'] = self.base.legacy_fingerprint if legacy else self.base.fingerprint
+        files = ["/".join((SCRIPTDIR, ksfile))] if ksfile else []
+        return (inputs, files)
+
+    @property
+    def domain_name(self):
+        """The name of the libvirt domain the image is installed with.
+        Each image gets its own, so several can be installed at once.
+        """
+        return "createhdds-{0}".format(self.filename.rsplit('.', 1)[0])
+
+    @property
+    def requires(self):
+        """What's needed to install the image (or to derive it), and
+        to compact it, if it's to be compacted.
+        """
+        if self.base:
+            needs = ['qemu-img', 'virt-customize']
+        else:
+            needs = ['libvirt', 'virt-install', 'osinfo-query']
+        if self.compact:
+            needs.extend(('virt-sparsify', 'qemu-img'))
+        return needs
+
+    @property
+    def watches(self):
+        """All the kickstart files that could be used for the image,
+        as creating a more specific one changes which is used, and
+        for derived images, the base image's.
+        """
+        paths = ["/".join((SCRIPTDIR, cand)) for cand in self.kickstart_candidates]
+        if self.base:
+            paths.extend(self.base.watches)
+        return paths
+
+    def preflight(self, planned=()):
+        """Check there's a kickstart for the image. For derived images,
+        also check the base image's, that the difference between them
+        is something derive() can apply, and that the base image will
+        be there and up to date when we need it.
+        """
+        problems = []
+        ksfile = self.kickstart_file
+        if not ksfile:
+            problems.append("{0}: no kickstart found (looked for {1}.ks and more specific "
+                            "variants)".format(self.filename, self.name))
+        if not self.base:
+            return problems
+        base = self.base
+        if (self.bootopts or None) != (base.bootopts or None):
+            problems.append("{0}: has different boot options from its base image "
+                            "{1}".format(self.filename, base.filename))
+        if base.filename not in planned and (not os.path.isfile(base.filename) or
+                                             base.is_outdated()):
+            problems.append("{0}: base image {1} is missing or outdated and not being "
+                            "built".format(self.filename, base.filename))
+        baseks = base.kickstart_file
+        if not baseks:
+            problems.append("{0}: base image {1} has no kickstart".format(
+                self.filename, base.filename))
+        elif ksfile:
+            try:
+                kickstart_delta("/".join((SCRIPTDIR, baseks)), "/".join((SCRIPTDIR, ksfile)))
+            except ValueError as err:
+                problems.append("{0}: can't be derived from {1}: {2}".format(
+                    self.filename, base.filename, err))
+        return problems
+
+    def verify(self, gfs, disk):
+        """Check the installed system on the image looks bootable: that
+        guestfs inspection finds an operating system, with a kernel
+        and boot loader configuration in /boot (and an EFI boot loader,
+        for UEFI images). 'gfs' is a launched guestfs handle with the
+        image attached read-only as 'disk' (see verify_images()). Every
+        install uses the same LVM volume group names, so LVM is only
+        allowed to see this image's devices while we look. Encrypted
+        partitions are opened with the passphrase from the kickstart.
+        Returns a list of problems, empty if all is well.
+        """
+        problems = []
+        passphrase = None
+        if self.kickstart_file:
+            for cmd in parse_kickstart("/".join((SCRIPTDIR, self.kickstart_file)))['commands']:
+                words = shlex.split(cmd)
+                if words[0] in ('autopart', 'part', 'logvol', 'raid'):
+                    passphrase = _ks_options(words[1:])[0].get('passphrase') or passphrase
+        partnames = [partn for partn in gfs.list_partitions() if gfs.part_to_dev(partn) == disk]
+        devices = [disk]
+        try:
+            for partname in partnames:
+                if gfs.vfs_type(partname) != 'crypto_LUKS':
+                    continue
+                if not passphrase:
+                    problems.append("{0} is encrypted, but the kickstart has no "
+                                    "passphrase".format(partname))
+                    continue
+                mapname = "verify{0}".format(len(devices))
+                gfs.cryptsetup_open(partname, passphrase, mapname)
+                devices.append("/dev/mapper/{0}".format(mapname))
+            gfs.lvm_set_filter(devices)
+            gfs.vg_activate_all(True)
+            ours = set(partnames + devices[1:] + gfs.lvs())
+            roots = [root for root in gfs.inspect_os()
+                     if gfs.canonical_device_name(root) in ours or root in ours]
+            if not roots:
+                problems.append("no operating system found")
+            for root in roots:
+                mounts = gfs.inspect_get_mountpoints(root)
+                for mountpoint in sorted(mounts, key=len):
+                    try:
+                        gfs.mount_ro(mounts[mountpoint], mountpoint)
+                    except RuntimeError as err:
+                        problems.append("can't mount {0}: {1}".format(mountpoint, err))
+                if not gfs.glob_expand('/boot/vmlinuz-*'):
+                    problems.append("no kernel in /boot")
+                if not (gfs.is_file('/boot/grub2/grub.cfg') or
+                        gfs.glob_expand('/boot/loader/entries/*.conf') or
+                        gfs.glob_expand('/boot/efi/EFI/*/grub.cfg')):
+                    problems.append("no boot loader configuration in /boot")
+                if 'uefi' in (self.bootopts or '') and \
+                        not gfs.glob_expand('/boot/efi/EFI/*/*.efi'):
+                    problems.append("no EFI boot loader in /boot/efi")
+                gfs.umount_all()
+        finally:
+            gfs.umount_all()
+            gfs.vg_activate_all(False)
+            for device in devices[1:]:
+                gfs.cryptsetup_close(device)
+            gfs.lvm_clear_filter()
+        return problems
+
+    def disk_args(self, tmpfile):
+        """The virt-install arguments for the install VM's disk, which is
+        'tmpfile', with the settings from the image's disk profile:
+        the host 'cache' mode, 'io' mode, 'discard' and 'detect_zeroes'
+        handling, the 'bus' (virtio or scsi - the latter is a virtio-
+        scsi controller) and the number of 'queues'. These only affect
+        how fast the install goes, not the image, so they aren't part
+        of the fingerprint.
+        """
+        profile = self.disk_profile
+        disk = ["size={0}".format(self.size), "path={0}".format(tmpfile)]
+        for key in ('cache', 'io', 'discard', 'detect_zeroes', 'bus'):
+            if key in profile:
+                disk.append("{0}={1}".format(key, profile[key]))
+        args = []
+        if profile.get('bus') == 'scsi':
+            controller = "type=scsi,model=virtio-scsi"
+            if 'queues' in profile:
+                controller += ",driver.queues={0}".format(profile['queues'])
+            args = ["--controller", controller]
+        elif 'queues' in profile:
+            disk.append("driver.queues={0}".format(profile['queues']))
+        return ["--disk", ",".join(disk)] + args
+
+    @property
+    def memsize(self):
+        """The install VM's memory, in MiB."""
+        if self.arch in ['ppc64','ppc64le']:
+            return 4096
+        return 3072
+
+    def create(self, baseurl, textinst, retries=3, ctx=None):
+        """Create the image. 'ctx' is the BuildContext for the run; if
+        not passed, we use one just for this image. The install only
+        starts once the context's AdmissionController says the host
+        has room for it.
+        """
         if self.arch not in supported_arches():
             logger.info("Won't create %s image on %s host. This is normal, don't worry. If you "
                         "intend to have %s workers you will need to run createhdds again on one "
                         "of them to create their base images", self.arch, CPUARCH, self.arch)
             return
+        if ctx is None:
+            ctx = BuildContext()
+            try:
+                self.create(baseurl, textinst, retries=retries, ctx=ctx)
+                for (_, err) in ctx.finish_compactions():
+                    raise err
+                return
+            finally:
+                ctx.close()
 
-        # figure out the best os-variant. NOTE: libosinfo >= 0.3.1
-        # properly returns 1 on failure, but using workaround for old
-        # bug where it didn't in case EPEL doesn't have 0.3.1
-        shortid = "rocky{0}".format(self.release)
-        # rocky has beta, rc# and lookahead releases that aren't in osinfo db
-        # replace text suffix in those with unknown.
-        shortid = "{0}-unknown".format(shortid.split('-')[0])
-        args = ["osinfo-query", "os", "short-id={0}".format(shortid)]
-        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        out = process.communicate()[0].decode()
-        if shortid not in out:
-            # this will just use the most recent rocky release number
-            # virt-install / osinfo knows
-            shortid = "rocky{0}".format(self.release).split('.')[0] + "-unknown"
+        # deriving an image only needs a libguestfs appliance, not a
+        # whole install VM
+        memory = 1024 if self.base else self.memsize
+        with span('admission', self.filename):
+            ticket = ctx.admission.admit(self.filename, memory * 1024 * 1024,
+                                         handle_size("{0}G".format(self.size)))
+        with ticket:
+            if self.base:
+                return self.derive(ctx)
+            return self._install(baseurl, textinst, retries, ctx)
 
-        # destroy and delete the domain we use for all virt-installs
-        conn = libvirt.open()
+    def derive(self, ctx):
+        """Build the image from its base image instead of installing it:
+        create a qcow2 overlay on top of the base image, use
+        virt-customize to apply the differences between the base
+        image's kickstart and ours to it (see kickstart_delta()), then
+        flatten the overlay into a standalone image with qemu-img
+        convert, so nothing needs the base image to use it. The base
+        image must already exist and be up to date; build_images()
+        builds bases first.
+        """
+        base = self.base
+        if (self.bootopts or None) != (base.bootopts or None):
+            sys.exit("{0} has different boot options from its base image {1}, so can't be "
+                     "derived from it!".format(self.filename, base.filename))
+        if not os.path.isfile(base.filename) or base.is_outdated():
+            sys.exit("Base image {0} for {1} is missing or outdated, build it first!".format(
+                base.filename, self.filename))
+        try:
+            (args, scripts) = kickstart_delta(
+                "/".join((SCRIPTDIR, base.kickstart_file)),
+                "/".join((SCRIPTDIR, self.kickstart_file)))
+        except ValueError as err:
+            sys.exit("Can't derive {0} from {1}: {2}".format(self.filename, base.filename, err))
+        tmpfile = "{0}.tmp".format(self.filename)
+        overlay = "{0}.overlay.tmp".format(self.filename)
+        scriptdir = tempfile.mkdtemp(prefix='createhdds-post-')
+        stream = getattr(_LOGCTX, 'stream', None)
         try:
-            dom = conn.lookupByName('createhdds')
+            for (num, script) in enumerate(scripts):
+                path = os.path.join(scriptdir, "post{0}.sh".format(num))
+                with open(path, 'w') as scriptfh:
+                    scriptfh.write(script)
+                args.extend(("--run", path))
+            with span('overlay', self.filename):
+                subprocess.run(["qemu-img", "create", "-q", "-f", "qcow2", "-F", "qcow2", "-b",
+                                os.path.abspath(base.filename), overlay,
+                                "{0}G".format(self.size)], check=True)
+            logger.info("Deriving %s from %s...", self.filename, base.filename)
+            logger.debug("virt-customize arguments: %s", ' '.join(args))
+            with span('customize', self.filename):
+                subprocess.run(["virt-customize", "-a", overlay] + args + ["--selinux-relabel"],
+                               check=True, stdout=stream,
+                               stderr=subprocess.STDOUT if stream else None)
+            with span('flatten', self.filename):
+                subprocess.run(["qemu-img", "convert", "-O", "qcow2", overlay, tmpfile],
+                               check=True)
+            os.remove(overlay)
+            if self.compact:
+                ctx.compact(self, tmpfile)
+                return
+            os.chmod(tmpfile, 0o644)
+            with span('flush', self.filename):
+                flush_rename(tmpfile, self.filename)
+            self.record()
+        except:
+            for fn in (tmpfile, overlay):
+                if os.path.isfile(fn):
+                    os.remove(fn)
+            raise
+        finally:
+            shutil.rmtree(scriptdir, ignore_errors=True)
+
+    def _install(self, baseurl, textinst, retries, ctx):
+        """Do the actual install (see create()), retrying up to
+        'retries' times if it stalls.
+        """
+        import libvirt
+        with span('osinfo', self.filename):
+            shortid = ctx.os_variant(self.release)
+        mirror = ctx.mirror.url if ctx.mirror else None
+
+        # destroy and delete this image's domain, in case it was left
+        # behind by a failed build
+        domname = self.domain_name
+        with span('domain_cleanup', self.filename):
             try:
-                dom.destroy()
+                dom = ctx.conn.lookupByName(domname)
+                try:
+                    dom.destroy()
+                except libvirt.libvirtError:
+                    # domain may not be running, so this is fine
+                    pass
+                dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
             except libvirt.libvirtError:
-                # domain may not be running, so this is fine
+                # domain may not exist, so this is fine
                 pass
-            dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
-        except libvirt.libvirtError:
-            # domain may not exist, so this is fine
-            pass
-        conn.close()
 
         tmpfile = "{0}.tmp".format(self.filename)
         arch = self.arch
-        rockydir = 'rocky/linux'
-        memsize = '3072'
-        if arch in ['ppc64','ppc64le']:
-            rockydir = 'rocky-secondary'
-            memsize = '4096'
 
+        ksdir = None
         try:
-            locbase = "https://download.rockylinux.org/{0}/rocky".format(baseurl)
+            locbase = "{0}/{1}/rocky".format(mirror or UPSTREAM, baseurl)
             # loctmp is the Distribution tree installation source. Point at the good location
             loctmp = "{0}/{1}/BaseOS/{2}/os"
             ksfile = self.kickstart_file
+            kspath = "{0}/{1}".format(SCRIPTDIR, ksfile)
+            if mirror:
+                # the kickstart's own 'url' and 'repo' lines point at
+                # upstream too: inject a copy that uses the mirror. it
+                # has to have the same file name
+                ksdir = tempfile.mkdtemp(prefix='createhdds-ks-')
+                with open(kspath, 'r') as ksin:
+                    kscontent = ksin.read()
+                kspath = os.path.join(ksdir, ksfile)
+                with open(kspath, 'w') as ksout:
+                    ksout.write(kscontent.replace(UPSTREAM, mirror))
             xargs = "inst.ks=file:/{0}".format(ksfile)
-            args = ["virt-install", "--disk", "size={0},path={1}".format(self.size, tmpfile),
+            args = ["virt-install"] + self.disk_args(tmpfile) + [
                     "--os-variant", shortid, "-x", xargs, "--initrd-inject",
-                    "{0}/{1}".format(SCRIPTDIR, ksfile), "--location",
-                    loctmp.format(locbase, str(self.release), arch), "--name", "createhdds",
-                    "--memory", memsize, "--noreboot", "--wait", "-1"]
+                    kspath, "--location",
+                    loctmp.format(locbase, str(self.release), arch), "--name", domname,
+                    "--memory", str(self.memsize), "--noreboot", "--wait", "-1"]
             if logger.getEffectiveLevel() == logging.DEBUG:
                 # let's get virt-install debug logs too
                 args.append("--debug")
@@ -309,37 +2609,57 @@ class VirtInstallImage(object):
             # openQA server:
             # https://bugzilla.redhat.com/show_bug.cgi?id=1387798
             args.extend(("--network", "user"))
-            # run the command, timing out after 1 hour; sometimes creation
-            # seems to just get mysteriously stuck, we need to bail and
-            # retry in this case
-            try:
-                logger.info("Install starting...")
-                logger.debug("Command: %s", ' '.join(args))
-                if not textinst:
-                    logger.info("Connect via VNC to monitor")
-                ret = subprocess.call(args, timeout=3600)
-            except subprocess.TimeoutExpired:
-                logger.warning("Image creation timed out!")
-                # clean up the domain again
-                conn = libvirt.open()
-                dom = conn.lookupByName('createhdds')
+            # run the command, watching it; sometimes creation seems to
+            # just get mysteriously stuck, we need to bail and retry in
+            # this case
+            attempt = 4 - retries
+            logger.info("Install starting (attempt %s)...", str(attempt))
+            logger.debug("Command: %s", ' '.join(args))
+            if not textinst:
+                logger.info("Connect via VNC to monitor")
+            # when building in parallel, send virt-install's own
+            # output to the image's log file rather than the console
+            stream = getattr(_LOGCTX, 'stream', None)
+            with span('virt-install', self.filename, attempt=attempt):
+                ctx.track_domain(domname)
+                proc = subprocess.Popen(args, stdout=stream,
+                                        stderr=subprocess.STDOUT if stream else None)
+                # virt-install gives libvirt the absolute path of the
+                # disk, and that's what blockStats() wants
+                monitor = InstallMonitor(ctx, domname, self.filename, os.path.abspath(tmpfile),
+                                         proc, ctx.stall_timeout, limit=ctx.install_timeout)
+                monitor.start()
                 try:
-                    dom.destroy()
-                except libvirt.libvirtError:
-                    # maybe it died already
-                    pass
+                    with ctx.track_process(proc):
+                        ret = proc.wait()
+                finally:
+                    monitor.stop()
+            if ctx.aborted.is_set():
+                # the build was interrupted, and the domain destroyed
+                # under virt-install: whatever it left is no good
+                sys.exit("Install of {0} interrupted".format(self.filename))
+            if monitor.stalled:
+                logger.warning("Image creation attempt %s failed: %s", str(attempt),
+                               monitor.stalled)
+                # clean up the domain again
                 try:
+                    dom = ctx.conn.lookupByName(domname)
+                    try:
+                        dom.destroy()
+                    except libvirt.libvirtError:
+                        # maybe it died already
+                        pass
                     dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
                 except libvirt.libvirtError:
+                    # or never got defined
                     pass
-                conn.close()
                 if os.path.isfile(tmpfile):
                     os.remove(tmpfile)
                 if retries:
                     logger.info("Retrying: %s retries remain after this", str(retries))
-                    return self.create(baseurl, textinst, retries=retries-1)
+                    return self._install(baseurl, textinst, retries-1, ctx)
                 else:
-                    sys.exit("Image creation timed out too many times!")
+                    sys.exit("Image creation stalled too many times!")
             if ret > 0:
                 # wipe the temp file
                 if os.path.isfile(tmpfile):
@@ -347,44 +2667,275 @@ class VirtInstallImage(object):
                 sys.exit("virt-install command {0} failed!".format(' '.join(args)))
             # at this point the domain should be shut off; if it's
             # anything else, something went wrong: clean up and exit
-            conn = libvirt.open()
-            dom = conn.lookupByName('createhdds')
-            if dom.state()[0] != libvirt.VIR_DOMAIN_SHUTOFF:
-                conn.close()
-                if os.path.isfile(tmpfile):
-                    os.remove(tmpfile)
-                sys.exit("libvirt domain ('createhdds') is not shutdown! "
-                         "this is an unexpected condition, aborting.")
-            # we're all done! rename to the correct name and clean up
-            # the domain
-            os.rename(tmpfile, self.filename)
-            os.chmod(self.filename, 0o644)
-            dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
-            conn.close()
+            with span('finalize', self.filename):
+                dom = ctx.conn.lookupByName(domname)
+                if dom.state()[0] != libvirt.VIR_DOMAIN_SHUTOFF:
+                    if os.path.isfile(tmpfile):
+                        os.remove(tmpfile)
+                    sys.exit("libvirt domain ('{0}') is not shutdown! "
+                             "this is an unexpected condition, aborting.".format(domname))
+                # we're all done! clean up the domain, and rename to the
+                # correct name, or leave that to the compaction
+                dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
+                ctx.untrack_domain(domname)
+                if self.compact:
+                    ctx.compact(self, tmpfile)
+                    return
+            os.chmod(tmpfile, 0o644)
+            with span('flush', self.filename):
+                flush_rename(tmpfile, self.filename)
+            self.record()
         except:
             # if anything went wrong, we want to wipe the temp file
-            # then raise. we leave the domain intact in case we want
-            # to debug it
+            # then raise. we leave the domain defined in case we want
+            # to debug it (BuildContext.close() will stop it)
             if os.path.isfile(tmpfile):
                 os.remove(tmpfile)
             raise
+        finally:
+            if ksdir:
+                shutil.rmtree(ksdir, ignore_errors=True)
 
-    @property
-    def outdated(self):
-        """Whether the image is outdated - if self.maxage is set and
-        it's older than that.
+    def run_compaction(self, tmpfile):
+        """Compact the freshly installed image 'tmpfile': virt-sparsify
+        it in place, which zeroes and discards the blocks of free space
+        in its filesystems (deleted files, the package cache...), then
+        copy it with qemu-img convert, which leaves out the zeroed and
+        discarded clusters (and compresses the rest, if self.compress
+        is set). The copy is then renamed into place and recorded,
+        along with how much smaller it is than the installed image.
+        Usually run in the background by BuildContext.compact().
         """
-        if not os.path.isfile(self.filename):
-            return False
+        outfile = "{0}.compact.tmp".format(self.filename)
+        try:
+            before = os.path.getsize(tmpfile)
+            with span('sparsify', self.filename):
+                subprocess.run(["virt-sparsify", "--quiet", "--in-place", tmpfile], check=True)
+            args = ["qemu-img", "convert", "-O", "qcow2", tmpfile, outfile]
+            if self.compress:
+                args.insert(2, "-c")
+            with span('convert', self.filename, compress=self.compress):
+                subprocess.run(args, check=True)
+            after = os.path.getsize(outfile)
+            os.chmod(outfile, 0o644)
+            with span('flush', self.filename):
+                flush_rename(outfile, self.filename)
+            os.remove(tmpfile)
+        except:
+            for fn in (tmpfile, outfile):
+                if os.path.isfile(fn):
+                    os.remove(fn)
+            raise
+        self.record(compaction={'before': before, 'after': after, 'saved': before - after})
+        logger.info("Compacted %s from %s to %s (saved %s)", self.filename, format_size(before),
+                    format_size(after), format_size(before - after))
 
-        if self.maxage:
-            age = int(time.time()) - int(os.path.getmtime(self.filename))
-            # maxage is in days
-            if age > int(self.maxage) * 24 * 60 * 60:
-                return True
 
-        return False
+# the schema hdds.json must match, in JSON Schema form. only the
+# small subset of JSON Schema that _schema_errors() understands is
+# used: type, required, properties, additionalProperties, items,
+# enum, pattern and minItems
+_SIZE = {'type': ['string', 'integer'], 'pattern': r'^[0-9]+(G|GB|GiB|M|MB|MiB)?$'}
+_SECTOR = {'type': ['string', 'integer'], 'pattern': r'^-?[0-9]+$'}
+_PARTNUM = {'type': ['string', 'integer'], 'pattern': r'^[1-9][0-9]*$'}
+_DAYS = {'type': ['string', 'integer'], 'pattern': r'^[0-9]+$'}
+_DISK_PROFILE = {'anyOf': [
+    {'type': 'string', 'enum': sorted(DISK_PROFILES)},
+    {'type': 'object', 'additionalProperties': False, 'properties': {
+        'cache': {'enum': ['none', 'writethrough', 'writeback', 'directsync', 'unsafe']},
+        'io': {'enum': ['native', 'threads', 'io_uring']},
+        'discard': {'enum': ['unmap', 'ignore']},
+        'detect_zeroes': {'enum': ['off', 'on', 'unmap']},
+        'bus': {'enum': ['virtio', 'scsi']},
+        'queues': {'type': 'integer', 'pattern': r'^[1-9][0-9]*$'},
+    }},
+]}
+HDDS_SCHEMA = {
+    'type': 'object',
+    'required': ['guestfs', 'virtinstall', 'renames'],
+    'additionalProperties': False,
+    'properties': {
+        'guestfs': {'type': 'array', 'items': {
+            'type': 'object',
+            'required': ['name', 'size', 'parts'],
+            'additionalProperties': False,
+            'properties': {
+                'name': {'type': 'string', 'pattern': r'^[A-Za-z0-9_.-]+$'},
+                'size': _SIZE,
+                'imgver': {'type': 'string'},
+                'maxage': _DAYS,
+                'format': {'enum': ['raw', 'qcow2']},
+                'compress': {'type': 'boolean'},
+                'labels': {'type': 'array', 'minItems': 1, 'items': {'type': 'string'}},
+                'filesystems': {'type': 'array', 'minItems': 1, 'items': {'type': 'string'}},
+                'parts': {'type': 'array', 'minItems': 1, 'items': {
+                    'type': 'object',
+                    'required': ['type', 'start', 'end'],
+                    'additionalProperties': False,
+                    'properties': {
+                        'type': {'enum': ['p', 'l', 'e']},
+                        'start': _SECTOR,
+                        'end': _SECTOR,
+                        'filesystem': {'type': 'string'},
+                        'label': {'type': 'string'},
+                        'gpt_type': {'type': 'string'},
+                    },
+                }},
+                'writes': {'type': 'array', 'items': {
+                    'type': 'object',
+                    'required': ['part', 'path', 'content'],
+                    'additionalProperties': False,
+                    'properties': {
+                        'part': _PARTNUM,
+                        'path': {'type': 'string', 'pattern': r'^/'},
+                        'content': {'type': 'string'},
+                    },
+                }},
+                'uploads': {'type': 'array', 'items': {
+                    'type': 'object',
+                    'required': ['part', 'target', 'source'],
+                    'additionalProperties': False,
+                    'properties': {
+                        'part': _PARTNUM,
+                        'target': {'type': 'string', 'pattern': r'^/'},
+                        'source': {'type': 'string'},
+                    },
+                }},
+            },
+        }},
+        'virtinstall': {'type': 'array', 'items': {
+            'type': 'object',
+            'required': ['name', 'releases'],
+            'additionalProperties': False,
+            'properties': {
+                'name': {'type': 'string', 'pattern': r'^[A-Za-z0-9_.-]+$'},
+                'releases': {'type': 'object', 'additionalProperties': {
+                    'type': 'array', 'minItems': 1, 'items': {'type': 'string'}}},
+                'size': {'type': ['string', 'integer'], 'pattern': r'^[1-9][0-9]*$'},
+                'imgver': {'type': 'string'},
+                'maxage': _DAYS,
+                'bootopts': {'type': 'string'},
+                'compact': {'type': 'boolean'},
+                'compress': {'type': 'boolean'},
+                'base': {'type': 'string'},
+                'disk_profile': _DISK_PROFILE,
+            },
+        }},
+        'renames': {'type': 'array', 'items': {
+            'type': 'array', 'minItems': 2, 'items': {'type': 'string'}}},
+    },
+}
 
+_JSONTYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'integer': int,
+    'boolean': bool,
+}
+
+def _schema_errors(value, schema, where):
+    """Check 'value' against the JSON Schema subset 'schema', returning
+    a list of error strings. 'where' says where in the document the
+    value is, for the messages.
+    """
+    if 'anyOf' in schema:
+        results = [_schema_errors(value, sub, where) for sub in schema['anyOf']]
+        if all(results):
+            # report what's wrong with it as whichever alternative it
+            # has the type of
+            typed = [errors for (sub, errors) in zip(schema['anyOf'], results)
+                     if not _schema_errors(value, {'type': sub['type']}, where)]
+            if typed:
+                return typed[0]
+            return _schema_errors(value, {'type': [sub['type'] for sub in schema['anyOf']]},
+                                  where)
+        return []
+    types = schema.get('type')
+    if types:
+        if isinstance(types, str):
+            types = [types]
+        # bool is a subclass of int, but true is not an integer
+        if not any(isinstance(value, _JSONTYPES[typ]) and
+                   not (typ == 'integer' and isinstance(value, bool)) for typ in types):
+            return ["{0}: should be {1}, not {2}".format(where, ' or '.join(types),
+                                                         json.dumps(value))]
+    if 'enum' in schema and value not in schema['enum']:
+        return ["{0}: should be one of {1}, not {2}".format(
+            where, ', '.join(json.dumps(item) for item in schema['enum']), json.dumps(value))]
+    if 'pattern' in schema and not re.search(schema['pattern'], str(value)):
+        return ["{0}: {1} is not valid".format(where, json.dumps(value))]
+    errors = []
+    if isinstance(value, dict):
+        for key in schema.get('required', []):
+            if key not in value:
+                errors.append("{0}: missing required key '{1}'".format(where, key))
+        props = schema.get('properties', {})
+        extra = schema.get('additionalProperties', True)
+        for (key, item) in value.items():
+            if key in props:
+                errors.extend(_schema_errors(item, props[key], "{0}.{1}".format(where, key)))
+            elif extra is False:
+                errors.append("{0}: unknown key '{1}'".format(where, key))
+            elif isinstance(extra, dict):
+                errors.extend(_schema_errors(item, extra, "{0}.{1}".format(where, key)))
+    if isinstance(value, list):
+        if len(value) < schema.get('minItems', 0):
+            errors.append("{0}: needs at least {1} item(s)".format(where, schema['minItems']))
+        if 'items' in schema:
+            for (num, item) in enumerate(value):
+                errors.extend(_schema_errors(item, schema['items'],
+                                             "{0}[{1}]".format(where, num)))
+    return errors
+
+def validate_hdds(hdds):
+    """Check the hdds.json data 'hdds' is valid: that it matches
+    HDDS_SCHEMA, that the image group names are unique (each one
+    becomes a subcommand) and that every 'base' names another
+    virtinstall group, without any loops. Returns a list of error
+    strings, which is empty if all is well. This can't check things
+    that depend on the files around it, like whether kickstarts and
+    uploads exist; preflight() does that.
+    """
+    errors = _schema_errors(hdds, HDDS_SCHEMA, 'hdds.json')
+    if errors:
+        # the checks below assume the basic structure is right
+        return errors
+    names = set(('all', 'check', 'checksum', 'gc', 'history', 'sync', 'sync-receive',
+                  'verify', 'watch'))
+    for (imgtype, grp) in [('guestfs', grp) for grp in hdds['guestfs']] + \
+                          [('virtinstall', grp) for grp in hdds['virtinstall']]:
+        if grp['name'] in names:
+            errors.append("{0} group name '{1}' is already used".format(imgtype, grp['name']))
+        names.add(grp['name'])
+    bases = dict((grp['name'], grp.get('base')) for grp in hdds['virtinstall'])
+    for (name, base) in bases.items():
+        seen = [name]
+        error = None
+        while base and not error:
+            if base not in bases:
+                error = "virtinstall group '{0}': base group '{1}' does not exist".format(
+                    seen[-1], base)
+            elif base in seen:
+                # start from the same group whichever one we came in by
+                loop = seen[seen.index(base):]
+                first = loop.index(min(loop))
+                loop = loop[first:] + loop[:first]
+                error = "virtinstall base groups loop: {0}".format(
+                    ' -> '.join(loop + loop[:1]))
+            seen.append(base)
+            base = bases.get(base)
+        # every group on the chain would report the same problem
+        if error and error not in errors:
+            errors.append(error)
+    for grp in hdds['virtinstall']:
+        profile = grp.get('disk_profile')
+        # native AIO needs the image opened with O_DIRECT
+        if isinstance(profile, dict) and profile.get('io') == 'native' and \
+                profile.get('cache') not in ('none', 'directsync'):
+            errors.append("virtinstall group '{0}': disk_profile io 'native' needs cache "
+                          "'none' or 'directsync'".format(grp['name']))
+    return errors
 
 def get_guestfs_images(imggrp, labels=None, filesystems=None):
     """Passed a single 'image group' dict (usually read out of hdds.
@@ -407,6 +2958,9 @@ def get_guestfs_images(imggrp, labels=None, filesystems=None):
     writes = imggrp.get('writes')
     uploads = imggrp.get('uploads')
     imgver = imggrp.get('imgver')
+    maxage = int(imggrp.get('maxage', 0))
+    imgformat = imggrp.get('format', 'raw')
+    compress = imggrp.get('compress', False)
 
     # Here we implement the 'labels / filesystems' behaviour explained
     # in the docstring
@@ -431,11 +2985,12 @@ def get_guestfs_images(imggrp, labels=None, filesystems=None):
             if len(imggrp.get('labels', [])) > 1 or len(labels) > 1:
                 name_extras.append(label)
             img = GuestfsImage(
-                name, size, imgver, filesystem, label, parts, writes, uploads, name_extras)
+                name, size, imgver, filesystem, label, parts, writes, uploads, name_extras,
+                maxage=maxage, imgformat=imgformat, compress=compress)
             imgs.append(img)
     return imgs
 
-def get_virtinstall_images(imggrp, nextrel=None, releases=None):
+def get_virtinstall_images(imggrp, nextrel=None, releases=None, groups=None):
     """Passed a single 'image group' dict (usually read out of hdds.
     json), returns a list of VirtInstallImage instances. 'nextrel'
     indicates the 'next' release of Fedora: sometimes we determine the
@@ -451,7 +3006,11 @@ def get_virtinstall_images(imggrp, nextrel=None, releases=None):
     used instead. The dict's keys must be release numbers or negative
     integers: -1 means 'one release lower than the "next" release',
     -2 means 'two releases lower than the "next" release', and so on.
-    The values are the arches to build for that release.
+    The values are the arches to build for that release. If the group
+    has a 'base', 'groups' must be the list of all the virtinstall
+    image groups, so we can find the base group; each image is then
+    derived from the base group's image for the same release and arch,
+    which must be one the base group builds.
     """
     imgs = {}
     # Set this here so if we need to calculate it, we only do it once
@@ -465,6 +3024,16 @@ def get_virtinstall_images(imggrp, nextrel=None, releases=None):
     size = imggrp.get('size', 0)
     imgver = imggrp.get('imgver')
     bootopts = imggrp.get('bootopts')
+    compact = imggrp.get('compact', False)
+    compress = imggrp.get('compress', False)
+    disk_profile = imggrp.get('disk_profile')
+    bases = {}
+    if imggrp.get('base'):
+        basegrps = [grp for grp in (groups or []) if grp['name'] == imggrp['base']]
+        if not basegrps:
+            sys.exit("Base image group {0} of {1} not found!".format(imggrp['base'], name))
+        bases = {(str(img.release), img.arch): img
+                 for img in get_virtinstall_images(basegrps[0], nextrel=nextrel, groups=groups)}
     # add an image for each release/arch combination
     for (release, arches) in releases.items():
         rels = [release]
@@ -473,9 +3042,17 @@ def get_virtinstall_images(imggrp, nextrel=None, releases=None):
                 if arch == 'i686' and int(rel) > 8:
                     continue
                 key = "{0}-{1}".format(rel, arch)
+                base = None
+                if imggrp.get('base'):
+                    base = bases.get((str(rel), arch))
+                    if not base:
+                        sys.exit("Base image group {0} of {1} has no {2} {3} image!".format(
+                            imggrp['base'], name, rel, arch))
                 # using a dict here avoids dupes
                 imgs[key] = VirtInstallImage(name, rel, arch, size=size,
-                                             imgver=imgver, maxage=maxage, bootopts=bootopts)
+                                             imgver=imgver, maxage=maxage, bootopts=bootopts,
+                                             compact=compact, compress=compress, base=base,
+                                             disk_profile=disk_profile)
     return list(imgs.values())
 
 def get_all_images(hdds, nextrel=None):
@@ -493,9 +3070,79 @@ def get_all_images(hdds, nextrel=None):
         imgs.extend(get_guestfs_images(imggrp))
 
     for imggrp in hdds['virtinstall']:
-        imgs.extend(get_virtinstall_images(imggrp, nextrel=nextrel))
+        imgs.extend(get_virtinstall_images(imggrp, nextrel=nextrel, groups=hdds['virtinstall']))
     return imgs
 
+def rename_image(orig, new):
+    """Rename an image file, carrying its recorded state (block hash
+    index, if any, and build history) across, and update the checksum
+    manifest.
+    """
+    import sqlite3
+    os.rename(orig, new)
+    if os.path.isfile(orig + BLOCKINDEX):
+        os.rename(orig + BLOCKINDEX, new + BLOCKINDEX)
+    def _rename(images):
+        if orig in images:
+            images[new] = images.pop(orig)
+    update_state(_rename)
+    write_sums()
+    if os.path.exists(HISTORYFILE):
+        try:
+            with history_db() as db:
+                db.execute("UPDATE builds SET image = ? WHERE image = ?", (new, orig))
+        except sqlite3.Error as err:
+            logger.warning("Could not rename %s in %s: %s", orig, HISTORYFILE, err)
+
+def forget_images(filenames):
+    """Drop the recorded state (and block hash indexes) for images
+    that have been removed, and update the checksum manifest.
+    """
+    for filename in filenames:
+        if os.path.isfile(filename + BLOCKINDEX):
+            os.remove(filename + BLOCKINDEX)
+    def _forget(images):
+        for filename in filenames:
+            images.pop(filename, None)
+    update_state(_forget)
+    write_sums()
+
+def adopt_images(imgs):
+    """Record the current input fingerprint for any of the images that
+    exist but have none recorded (because they were built before we
+    recorded fingerprints, or renamed into place). From now on they'll
+    be rebuilt when their inputs change. Images recorded with an
+    FPFORMAT 1 fingerprint that's still current get their format 2
+    fingerprint recorded instead, and their image store blob renamed
+    to match. Existing images that are up to date and not in the image
+    store yet are added to it.
+    """
+    current = []
+    def _adopt(images):
+        for img in imgs:
+            if not os.path.isfile(img.filename):
+                continue
+            entry = images.get(img.filename, {})
+            if 'fingerprint' not in entry:
+                logger.debug("Recording fingerprint for existing image %s", img.filename)
+                # keep the checksum, if 'checksum' recorded one
+                images[img.filename] = dict(entry, **img.manifest_entry())
+            elif entry.get('fpformat', 1) < FPFORMAT and img.inputs_unchanged(entry):
+                logger.debug("Updating fingerprint format for %s", img.filename)
+                (old, entry['fingerprint']) = (entry['fingerprint'], img.fingerprint)
+                entry['fpformat'] = FPFORMAT
+                (oldblob, blob) = (os.path.join(STOREDIR, old),
+                                   os.path.join(STOREDIR, entry['fingerprint']))
+                if os.path.exists(oldblob) and not os.path.exists(blob):
+                    os.rename(oldblob, blob)
+            if images[img.filename]['fingerprint'] == img.fingerprint:
+                current.append(img)
+    update_state(_adopt)
+    # images built before we had the store go into it too
+    for img in current:
+        if not os.path.exists(os.path.join(STOREDIR, img.fingerprint)):
+            store_add(img.filename, img.fingerprint)
+
 def do_renames(hdds):
     """Rename files according to the 'renames' list in hdds.json,
     which is just a list of 'old name, new name' pairs. Say there's
@@ -508,16 +3155,20 @@ def do_renames(hdds):
     for (orig, new) in hdds['renames']:
         if os.path.isfile(orig) and not os.path.exists(new):
             logger.info("Renaming %s to %s...", orig, new)
-            os.rename(orig, new)
+            rename_image(orig, new)
 
 def delete_all():
     """Remove absolutely all createhdds-controlled files; we assume
     anything in the working directory starting with 'disk' and ending
-    with 'img' is one of our files.
+    with 'img' or 'qcow2' is one of our files. The image store is
+    emptied too.
     """
-    files = [fl for fl in os.listdir('.') if fl.startswith('disk') and fl.endswith('img')]
+    files = [fl for fl in os.listdir('.') if is_image_file(fl)]
     for _file in files:
         os.remove(_file)
+    forget_images(files)
+    # or they'd just be restored from the store, not rebuilt
+    shutil.rmtree(STOREDIR, ignore_errors=True)
 
 def clean(unknown):
     """This simply removes all the files in the list. The list is
@@ -528,14 +3179,255 @@ def clean(unknown):
     files when the image group name has been changed to indicate an
     incompatible change to the image(s).
     """
-    for filename in unknown:
-        try:
-            logger.info("Removing unknown image %s", filename)
-            os.remove(filename)
-        except OSError:
-            # We don't really care if the file didn't exist for some
-            # reason, so just pass.
-            pass
+    for filename in unknown:
+        try:
+            logger.info("Removing unknown image %s", filename)
+            os.remove(filename)
+        except OSError:
+            # We don't really care if the file didn't exist for some
+            # reason, so just pass.
+            pass
+    forget_images(unknown)
+
+def _share(src, dst):
+    """Make 'dst' a copy of 'src' that shares its data: a reflink (copy
+    on write) clone if the filesystem can do that, otherwise a hard
+    link. A clone gets the original's mode and times. 'dst' must not
+    exist.
+    """
+    try:
+        with open(src, 'rb') as srcfh, open(dst, 'xb') as dstfh:
+            fcntl.ioctl(dstfh.fileno(), FICLONE, srcfh.fileno())
+        stat = os.stat(src)
+        os.chmod(dst, stat.st_mode)
+        os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    except OSError:
+        if os.path.isfile(dst):
+            os.remove(dst)
+        os.link(src, dst)
+
+def store_add(filename, fprint):
+    """Add the image file 'filename' to the image store, a directory of
+    images (STOREDIR) named after the fingerprint of their inputs,
+    'fprint'. Images with the same inputs come out the same however
+    they're named (the image group name and imgver aren't part of the
+    fingerprint), so an image that's in the store never needs
+    building again under another name: store_restore() just exposes
+    the stored copy under the new name. The store shares the image's
+    data (see _share()), so this takes no extra space. Problems are
+    logged, not raised; the store is only an optimization.
+    """
+    blob = os.path.join(STOREDIR, fprint)
+    tmp = "{0}.tmp".format(blob)
+    try:
+        if os.path.exists(blob) and os.path.samefile(blob, filename):
+            return
+        os.makedirs(STOREDIR, exist_ok=True)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        _share(filename, tmp)
+        os.replace(tmp, blob)
+    except OSError as err:
+        logger.warning("Could not add %s to the image store: %s", filename, err)
+
+def store_blob(img):
+    """The image store's copy of 'img', if it has a usable one: with
+    the same fingerprint, and (if the image has a maxage) built
+    recently enough. Otherwise None.
+    """
+    blob = os.path.join(STOREDIR, img.fingerprint)
+    try:
+        mtime = os.stat(blob).st_mtime
+    except OSError:
+        return None
+    if img.maxage and time.time() - mtime > int(img.maxage) * 24 * 60 * 60:
+        return None
+    return blob
+
+def store_restore(img):
+    """Expose the image store's copy of 'img' (see store_blob()) under
+    the image's filename, replacing any existing file, and record
+    it. Returns whether there was a copy to restore.
+    """
+    blob = store_blob(img)
+    if not blob:
+        return False
+    tmp = "{0}.tmp".format(img.filename)
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    _share(blob, tmp)
+    os.replace(tmp, img.filename)
+    logger.info("Restored %s from the image store", img.filename)
+    img.record()
+    return True
+
+def store_gc(fprints, dry_run=False):
+    """Remove the blobs in the image store whose fingerprints aren't
+    in 'fprints' (the fingerprints of all the expected images), and
+    any temporary files left behind. Returns a list of (blob, bytes
+    freed) tuples; a blob still linked to an image file frees
+    nothing. With 'dry_run', nothing is actually removed.
+    """
+    removed = []
+    try:
+        entries = list(os.scandir(STOREDIR))
+    except OSError:
+        return removed
+    for entry in entries:
+        if entry.name in fprints:
+            continue
+        stat = entry.stat()
+        freed = stat.st_blocks * 512 if stat.st_nlink == 1 else 0
+        if not dry_run:
+            os.remove(entry.path)
+        removed.append((entry.name, freed))
+    return removed
+
+def store_plan(imgs, fresh=False):
+    """Work out which of the images in the list 'imgs' really need
+    building. Returns three lists: the images to build; the images
+    the image store has a usable copy of (see store_blob()), which can
+    just be restored; and the images with the same fingerprint as one
+    in the first list, which can be restored once that's built. If
+    'fresh' is set, the store's current contents are ignored.
+    """
+    (build, restore, dupes) = ([], [], [])
+    fprints = set()
+    for img in imgs:
+        fprint = img.fingerprint
+        if not fresh and store_blob(img):
+            restore.append(img)
+        elif fprint in fprints:
+            dupes.append(img)
+        else:
+            fprints.add(fprint)
+            build.append(img)
+    return (build, restore, dupes)
+
+def parse_budget(value):
+    """Parse an 'all --budget' value: a time like '6h', '90m' or
+    '600s', or a plain number of images. Returns a tuple of the unit
+    ('seconds' or 'images') and the amount.
+    """
+    match = re.match(r'^([0-9]+)([smh]?)$', value)
+    if not match:
+        raise argparse.ArgumentTypeError(
+            "'{0}' is not a time (like 6h, 90m or 600s) or a number of images".format(value))
+    (num, unit) = match.groups()
+    if not unit:
+        return ('images', int(num))
+    return ('seconds', int(num) * {'s': 1, 'm': 60, 'h': 3600}[unit])
+
+def refresh_plan(missing, outdated, current, budget, jobs=1):
+    """Work out which images 'all --budget' should build this time,
+    so the images that all went out of date on the same day (because
+    they were all built in the same run) get rebuilt over several
+    runs, not all in one. 'missing', 'outdated' and 'current' are
+    lists of images as check() sorts them, 'budget' is a parse_budget()
+    tuple, and a time budget is spread over 'jobs' workers, using the
+    build times preflight() estimates. The images are taken in order
+    until the budget runs out: all the missing images, whatever the
+    budget, as tests need them; then the outdated images, those whose
+    inputs have changed first and then the most overdue first; and
+    then, if all of those fit, images that aren't outdated yet but are
+    at least EARLY_REFRESH of the way through their maxage, those
+    closest to expiring first, until the run has done its fair share
+    of rebuilding (as 'all' usually runs daily, the build time all the
+    images need per day, on average), so rebuilds spread out evenly
+    over the runs. Images the image store has (or that another
+    image being built will provide) and images for arches this host
+    can't build cost nothing. If the first
+    outdated image alone is too big for the budget and nothing else
+    is being built, it's built anyway, so it isn't put off forever.
+    Returns three lists: the images to build (which store_plan()
+    should sort out), the images to rebuild early (which must really
+    be built, not restored), and the outdated images put off.
+    """
+    images = load_state()['images']
+    history = history_estimates()
+    (unit, limit) = budget
+    # a count of images is the same however many workers there are
+    workers = [0] * (max(jobs, 1) if unit == 'seconds' else 1)
+    fprints = set()
+    stale = set(img.filename for img in missing + outdated)
+    arches = supported_arches()
+    (build, early, deferred) = ([], [], [])
+    # what we've taken so far, in the budget's unit, and our fair
+    # share: how much rebuilding all the images with a maxage need on
+    # average per day, which is all we rebuild early (any more would
+    # just move the spike, and rebuild images more often than needed)
+    spent = [0]
+    share = sum((estimate_seconds(img, images, history) if unit == 'seconds' else 1) /
+                int(img.maxage) for img in missing + outdated + current
+                if img.maxage and img.arch in arches)
+
+    def _fits(img, fresh=False, force=False):
+        fprint = img.fingerprint
+        # images for other arches are skipped by build_images(), and
+        # the store's images are just restored
+        if img.arch not in arches or fprint in fprints or (not fresh and store_blob(img)):
+            return True
+        cost = estimate_seconds(img, images, history) if unit == 'seconds' else 1
+        # like preflight(), each build goes to whichever worker is
+        # free soonest
+        slot = workers.index(min(workers))
+        if workers[slot] + cost > limit and not force:
+            return False
+        workers[slot] += cost
+        spent[0] += cost
+        fprints.add(fprint)
+        return True
+
+    def _take(img, fresh=False, force=False):
+        # a derived image can only be built if its base is up to date
+        # or built too, so take any stale bases along with it, or
+        # none of them
+        chain = [img]
+        while getattr(chain[0], 'base', None) and chain[0].base.filename in stale and \
+                chain[0].base.filename not in [each.filename for each in build]:
+            chain.insert(0, chain[0].base)
+        saved = (list(workers), set(fprints), spent[0])
+        if all(_fits(each, fresh=fresh, force=force) for each in chain):
+            return chain
+        workers[:] = saved[0]
+        fprints.clear()
+        fprints.update(saved[1])
+        spent[0] = saved[2]
+        return []
+
+    def _due(img):
+        if not img.inputs_unchanged(images.get(img.filename, {})):
+            return float('-inf')
+        return img.expires(images) or 0
+
+    for img in missing + sorted(outdated, key=_due):
+        if img.filename in [each.filename for each in build]:
+            # already taken as the base of a derived image
+            continue
+        chain = _take(img, force=img in missing or not build)
+        if chain:
+            build.extend(chain)
+        else:
+            deferred.append(img)
+    # a base that didn't fit on its own may have been taken along
+    # with a derived image after all
+    deferred = [img for img in deferred if img.filename not in
+                [each.filename for each in build]]
+    if not deferred:
+        now = time.time()
+        due = [img for img in current if img.maxage and
+               img.expires(images) - now < int(img.maxage) * 24 * 60 * 60 * (1 - EARLY_REFRESH)]
+        for img in sorted(due, key=_due):
+            if spent[0] >= share:
+                break
+            early.extend(_take(img, fresh=True))
+    if deferred:
+        logger.info("Putting off rebuilding %s outdated image(s) to keep within the budget: %s",
+                    len(deferred), ', '.join(img.filename for img in deferred))
+    if early:
+        logger.info("Rebuilding %s image(s) early with the spare budget: %s",
+                    len(early), ', '.join(img.filename for img in early))
+    return (build, early, deferred)
 
 def check(hdds, nextrel=None):
     """This calls get_all_images() to find out what images are expected
@@ -543,8 +3435,9 @@ def check(hdds, nextrel=None):
     present and returns three lists. The first two are lists of Image
     subclass instances, the last is a list of filenames. The first is a
     list of the images that just aren't there at all. The second is a
-    list of images that are present but 'outdated', because they've
-    exceeded their maxage. The last is a list of image files that are
+    list of images that are present but 'outdated', because the inputs
+    they were built from have changed, or they've exceeded their
+    maxage. The last is a list of image files that are
     present but don't match any of the expected images - 'unknown'
     images. The 'clean()' function can be used to remove these.
     'nextrel' is passed through to get_all_images(), and is available
@@ -553,29 +3446,37 @@ def check(hdds, nextrel=None):
     current = []
     missing = []
     outdated = []
-    unknown = []
     # Get the list of all 'expected' images
     expected = get_all_images(hdds, nextrel=nextrel)
+    arches = supported_arches()
+    # we look at the image directory just once, and rely on the state
+    # file manifest for image mtimes where possible, as the images may
+    # be on slow storage
+    files = set(entry.name for entry in os.scandir('.') if is_image_file(entry.name))
+    images = load_state()['images']
 
     # Now determine if images are absent or outdated
     for img in expected:
-        if img.arch in supported_arches() and not os.path.isfile(img.filename):
-            # handle renaming qcow2 images from old ('.img') to new ('.qcow2')
+        if img.arch in arches and img.filename not in files:
+            # handle renaming virt-install qcow2 images from old
+            # ('.img') to new ('.qcow2'). guestfs images can be qcow2
+            # too, but for those a .img file is a different format
             oldfn = img.filename.replace(".qcow2", ".img")
-            if os.path.isfile(oldfn):
-                os.rename(oldfn, img.filename)
-                if img.outdated:
+            if isinstance(img, VirtInstallImage) and oldfn in files:
+                rename_image(oldfn, img.filename)
+                files.discard(oldfn)
+                files.add(img.filename)
+                images = load_state()['images']
+                if img.is_outdated(images):
                     outdated.append(img)
             else:
                 missing.append(img)
             continue
-        if img.outdated:
+        if img.filename in files and img.is_outdated(images):
             outdated.append(img)
             continue
         current.append(img)
 
-    # Get the list of all present image files
-    files = set(fl for fl in os.listdir('.') if fl.startswith('disk') and (fl.endswith('img') or fl.endswith('qcow2')))
     # Compare present images vs. expected images to produce 'unknown'
     expnames = set(img.filename for img in expected)
     unknown = list(files.difference(expnames))
@@ -584,57 +3485,1323 @@ def check(hdds, nextrel=None):
     logger.debug("Missing images: %s", ', '.join([img.filename for img in missing]))
     logger.debug("Outdated images: %s", ', '.join([img.filename for img in outdated]))
     logger.debug("Unknown images: %s", ', '.join(unknown))
+    save_input_hashes()
     return (missing, outdated, unknown)
 
+def check_backend(name):
+    """Check one of the things building images needs (see the images'
+    'requires') is available. 'guestfs' and 'libvirt' are the Python
+    bindings - we make a guestfs handle (without launching it) and
+    connect to libvirt, to be sure they work; anything else is a
+    command that must be on $PATH. Returns None if all is well, or a
+    string saying what's wrong.
+    """
+    if name not in ('guestfs', 'libvirt'):
+        if shutil.which(name):
+            return None
+        return "command not found"
+    try:
+        if name == 'guestfs':
+            import guestfs
+            guestfs.GuestFS(python_return_dict=True).close()
+        else:
+            import libvirt
+            libvirt.open().close()
+    except ImportError as err:
+        return "Python bindings not available ({0})".format(err)
+    except Exception as err:
+        return "not working ({0})".format(err)
+    return None
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    image TEXT NOT NULL,
+    started REAL NOT NULL,
+    seconds REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    size INTEGER,
+    allocated INTEGER
+);
+CREATE INDEX IF NOT EXISTS builds_image ON builds (image, started);
+CREATE TABLE IF NOT EXISTS phases (
+    build INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_build ON phases (build);
+"""
+
+@contextlib.contextmanager
+def history_db(path=HISTORYFILE):
+    """Context manager which opens the build history database at
+    'path', creating it if need be, and commits on the way out (or
+    rolls back, on an exception). Each build is a row in 'builds':
+    the 'image' filename, when it 'started' (epoch time), how many
+    'seconds' it took, its 'outcome' ('ok' or 'failed'), the number of
+    install 'attempts', and for successful builds the image's 'size'
+    and 'allocated' size; each of its phases (see span()) is a row in
+    'phases'. Parallel builds each open their own connection; sqlite
+    makes them take turns.
+    """
+    import sqlite3
+    db = sqlite3.connect(path, timeout=60)
+    try:
+        db.executescript(HISTORY_SCHEMA)
+        with db:
+            yield db
+    finally:
+        db.close()
+
+def record_history(img, outcome):
+    """Add the build of 'img' that just finished with 'outcome' ('ok'
+    or 'failed') to the build history (see history_db()), with the
+    phases and attempts METRICS recorded for it, and drop all but the
+    latest HISTORY_KEEP builds of the image. This is only a record, so
+    problems are logged, not raised.
+    """
+    import sqlite3
+    (phases, attempts) = METRICS.image_phases(img.filename, img.started_at)
+    (size, allocated) = (None, None)
+    try:
+        if outcome == 'ok':
+            (size, allocated) = image_sizes(img.filename)
+        with history_db() as db:
+            cursor = db.execute(
+                "INSERT INTO builds (image, started, seconds, outcome, attempts, size, "
+                "allocated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (img.filename, img.started_at, time.monotonic() - img.started, outcome,
+                 attempts, size, allocated))
+            db.executemany("INSERT INTO phases (build, phase, seconds) VALUES (?, ?, ?)",
+                           [(cursor.lastrowid, phase, seconds)
+                            for (phase, seconds) in sorted(phases.items())])
+            db.execute("DELETE FROM builds WHERE image = ? AND id NOT IN (SELECT id FROM "
+                       "builds WHERE image = ? ORDER BY started DESC LIMIT ?)",
+                       (img.filename, img.filename, HISTORY_KEEP))
+            db.execute("DELETE FROM phases WHERE build NOT IN (SELECT id FROM builds)")
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Could not record build of %s in %s: %s", img.filename,
+                       HISTORYFILE, err)
+
+def history_estimates(path=HISTORYFILE):
+    """Return a dict of how long building each image in the build
+    history should take, in seconds: the median of its latest
+    HISTORY_RECENT successful builds, which one unusually quick or
+    slow build doesn't throw off. Empty if there's no history yet (or
+    it can't be read, which is logged).
+    """
+    import sqlite3
+    if not os.path.exists(path):
+        return {}
+    durations = {}
+    try:
+        with history_db(path) as db:
+            for (image, seconds) in db.execute(
+                    "SELECT image, seconds FROM builds WHERE outcome = 'ok' "
+                    "ORDER BY started DESC"):
+                durations.setdefault(image, []).append(seconds)
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Could not read %s: %s", path, err)
+        return {}
+    return dict((image, statistics.median(seconds[:HISTORY_RECENT]))
+                for (image, seconds) in durations.items())
+
+def history_report(days=0, filenames=(), path=HISTORYFILE):
+    """Summarize the build history for 'history': for each image (or
+    just those in 'filenames'), over the last 'days' days (or all the
+    history we have, if 0), the number of 'builds', how many 'failed'
+    and how many were 'retried' (took more than one attempt), the
+    'median' and 'last' time of the successful builds, the 'phases'
+    of the last successful build (slowest first), its 'size' and
+    'allocated' size, and the 'last_outcome'. An image is 'slow' if its
+    last successful build took over SLOW_FACTOR times the median of
+    the HISTORY_RECENT before it, and 'flaky' if any build failed or
+    needed retrying. Returns a dict of those dicts by image.
+    """
+    since = time.time() - days * 86400 if days else 0
+    with history_db(path) as db:
+        builds = db.execute(
+            "SELECT id, image, seconds, outcome, attempts, size, allocated FROM builds "
+            "WHERE started >= ? ORDER BY started DESC", (since,)).fetchall()
+        report = {}
+        for (buildid, image, seconds, outcome, attempts, size, allocated) in builds:
+            if filenames and image not in filenames:
+                continue
+            stats = report.setdefault(image, {
+                'builds': 0, 'failed': 0, 'retried': 0, 'last_outcome': outcome,
+                'times': [], 'phases': None, 'size': None, 'allocated': None})
+            stats['builds'] += 1
+            stats['failed'] += outcome == 'failed'
+            stats['retried'] += attempts > 1
+            if outcome == 'ok':
+                stats['times'].append(seconds)
+                if stats['phases'] is None:
+                    stats['phases'] = db.execute(
+                        "SELECT phase, seconds FROM phases WHERE build = ? "
+                        "ORDER BY seconds DESC", (buildid,)).fetchall()
+                    (stats['size'], stats['allocated']) = (size, allocated)
+    for stats in report.values():
+        # newest first
+        times = stats.pop('times')
+        stats['median'] = statistics.median(times) if times else None
+        stats['last'] = times[0] if times else None
+        before = times[1:HISTORY_RECENT+1]
+        stats['slow'] = bool(before) and times[0] > SLOW_FACTOR * statistics.median(before)
+        stats['flaky'] = bool(stats['failed'] or stats['retried'])
+        stats['phases'] = [list(phase) for phase in stats['phases'] or []]
+    return report
+
+def estimate_seconds(img, images, history=None):
+    """How long building 'img' should take, in seconds: from the build
+    history if there is some (see history_estimates(); 'history' is
+    what that returned), or how long it took last time (as recorded in
+    the state file 'images' dict), or the BUILD_SECONDS default for
+    its type. Images for arches this host can't build take no time,
+    as build_images() skips them.
+    """
+    if isinstance(img, GuestfsImage):
+        kind = 'guestfs'
+    else:
+        if img.arch not in supported_arches():
+            return 0
+        kind = 'derived' if img.base else 'virtinstall'
+    if history and img.filename in history:
+        return history[img.filename]
+    return images.get(img.filename, {}).get('build_seconds', BUILD_SECONDS[kind])
+
+def _estimate(img, images, history=None):
+    """preflight()'s guess at the disk space and time building 'img'
+    will take. If the image exists, we reckon its replacement will
+    take up as much space as it does; otherwise we go by the
+    BUILD_ALLOCATED default for its type. 'maxdisk' is its full size,
+    the most it could possibly take up. The time comes from
+    estimate_seconds() (using 'history', if given).
+    """
+    if isinstance(img, GuestfsImage):
+        (kind, maxdisk) = ('guestfs', img.size)
+    else:
+        kind = 'derived' if img.base else 'virtinstall'
+        maxdisk = handle_size("{0}G".format(img.size))
+    try:
+        disk = image_sizes(img.filename)[1]
+        reason = 'outdated'
+    except OSError:
+        disk = int(maxdisk * BUILD_ALLOCATED[kind])
+        reason = 'missing'
+    return {'image': img.filename, 'reason': reason, 'disk': disk, 'maxdisk': maxdisk,
+            'seconds': estimate_seconds(img, images, history)}
+
+def preflight(imgs, args):
+    """Check that building the images in the list 'imgs' ought to work,
+    before we spend hours on it, and work out what it will take. The
+    checks run in parallel: each image's own checks (see the images'
+    preflight()), whether each tool or binding they need is available
+    (check_backend()), and whether there's room for them. Images for
+    arches this host can't build are left out, as build_images()
+    skips them. Returns a dict: 'images' is a list of _estimate()s,
+    'skipped' the images left out, 'backends' maps each backend needed
+    to None or its problem, 'disk' and 'free' are the estimated disk
+    space needed and the space free, 'maxdisk' the most the images
+    could possibly need, 'seconds' the estimated total
+    build time, 'wall' that spread over args.jobs workers, and
+    'problems' a list of everything that's wrong, which is empty if
+    it's OK to go ahead.
+    """
+    import concurrent.futures
+    arches = supported_arches()
+    skipped = [img.filename for img in imgs
+               if isinstance(img, VirtInstallImage) and img.arch not in arches]
+    imgs = [img for img in imgs if img.filename not in skipped]
+    planned = set(img.filename for img in imgs)
+    images = load_state()['images']
+    history = history_estimates()
+    needs = sorted(set(name for img in imgs for name in img.requires))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        checks = [executor.submit(img.preflight, planned) for img in imgs]
+        backends = dict((name, executor.submit(check_backend, name)) for name in needs)
+        estimates = [executor.submit(_estimate, img, images, history) for img in imgs]
+    problems = [problem for future in checks for problem in future.result()]
+    backends = dict((name, future.result()) for (name, future) in backends.items())
+    problems.extend("{0}: {1}".format(name, err) for (name, err) in backends.items() if err)
+    estimates = [future.result() for future in estimates]
+    disk = sum(est['disk'] for est in estimates)
+    stat = os.statvfs('.')
+    free = stat.f_bavail * stat.f_frsize
+    if disk > free:
+        problems.append("not enough disk space: the images need about {0}, but only {1} is "
+                        "free".format(format_size(disk), format_size(free)))
+    # to estimate the wall clock time, hand out the builds longest
+    # first, each to whichever worker is free soonest
+    workers = [0] * max(args.jobs, 1)
+    for seconds in sorted((est['seconds'] for est in estimates), reverse=True):
+        workers[workers.index(min(workers))] += seconds
+    return {
+        'images': estimates,
+        'skipped': skipped,
+        'backends': backends,
+        'disk': disk,
+        'maxdisk': sum(est['maxdisk'] for est in estimates),
+        'free': free,
+        'seconds': sum(est['seconds'] for est in estimates),
+        'wall': max(workers),
+        'problems': problems,
+    }
+
+def print_plan(report):
+    """Print the preflight() report 'report' for --dry-run."""
+    print("Images to build: {0}".format(len(report['images'])))
+    for est in report['images']:
+        print("  {0} ({1}): about {2}, {3}".format(
+            est['image'], est['reason'], format_size(est['disk']),
+            format_duration(est['seconds'])))
+    if report.get('restored'):
+        print("From the image store: {0}".format(', '.join(report['restored'])))
+    if report.get('deferred'):
+        print("Put off (over the --budget): {0}".format(', '.join(report['deferred'])))
+    if report['skipped']:
+        print("Skipped (can't be built on this host): {0}".format(
+            ', '.join(report['skipped'])))
+    for (name, err) in sorted(report['backends'].items()):
+        print("Backend {0}: {1}".format(name, err or 'OK'))
+    print("Disk space: about {0} needed (at most {1}), {2} free".format(
+        format_size(report['disk']), format_size(report['maxdisk']),
+        format_size(report['free'])))
+    print("Time: about {0} ({1} if built one at a time)".format(
+        format_duration(report['wall']), format_duration(report['seconds'])))
+    if report['problems']:
+        print("Problems:")
+        for problem in report['problems']:
+            print("  {0}".format(problem))
+    else:
+        print("No problems found")
+
+def run_preflight(imgs, args, restored=(), early=(), deferred=()):
+    """Run preflight() on the images we're about to build. With
+    args.dry_run, print the plan and exit (with status 1 if there are
+    problems); otherwise, if there are any problems, log them and exit
+    before building anything. 'restored' is the images that will be
+    restored from the image store instead, 'early' those of 'imgs'
+    being rebuilt before they're due and 'deferred' the outdated images
+    not being rebuilt yet (see refresh_plan()), for the plan.
+    """
+    report = preflight(imgs, args)
+    report['restored'] = [img.filename for img in restored]
+    report['deferred'] = [img.filename for img in deferred]
+    early = set(img.filename for img in early)
+    for est in report['images']:
+        if est['image'] in early:
+            est['reason'] = 'early'
+    if args.dry_run:
+        print_plan(report)
+        sys.exit(1 if report['problems'] else 0)
+    if report['problems']:
+        for problem in report['problems']:
+            logger.error("%s", problem)
+        sys.exit("Preflight checks failed, not building anything!")
+    if report['images']:
+        logger.info("Building %s image(s): about %s of disk space and %s",
+                    len(report['images']), format_size(report['disk']),
+                    format_duration(report['wall']))
+
+def create_image(img, args, ctx=None):
+    """Create a single image, passing it the args its type needs.
+    'ctx' is the BuildContext for the run.
+    """
+    if isinstance(img, GuestfsImage):
+        img.create(args.textinst)
+    else:
+        img.create(args.baseurl, args.textinst, ctx=ctx)
+
+@contextlib.contextmanager
+def image_logging(img, args, counter):
+    """Context manager wrapped around the creation of each image by
+    build_images. Logs the progress message, with how long the image
+    should take and when the whole build should be done (see
+    _run_eta()). When building in
+    parallel, also sends log messages emitted by this thread while
+    the image is being built (and virt-install's output) to a log
+    file named after the image in args.logdir. The log file is left
+    in place whether the build succeeds or not.
+    """
+    with counter['lock']:
+        counter['num'] += 1
+        num = counter['num']
+        counter['waiting'].discard(img.filename)
+        counter['running'][img.filename] = time.monotonic()
+        eta = _run_eta(counter)
+    handler = None
+    if args.jobs > 1:
+        logpath = os.path.join(args.logdir, "{0}.log".format(img.filename))
+        handler = logging.FileHandler(logpath, mode='w')
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        handler.addFilter(ImageLogFilter(img.filename))
+        logger.addHandler(handler)
+        _LOGCTX.image = img.filename
+        _LOGCTX.stream = handler.stream
+    logger.info("Creating image %s...[%s/%s] (about %s, all done in about %s)", img.filename,
+                str(num), str(counter['total']),
+                format_duration(counter['estimates'].get(img.filename, 0)), format_duration(eta))
+    img.started = time.monotonic()
+    img.started_at = time.time()
+    try:
+        yield
+    finally:
+        with counter['lock']:
+            counter['running'].pop(img.filename, None)
+        if handler:
+            _LOGCTX.image = None
+            _LOGCTX.stream = None
+            logger.removeHandler(handler)
+            handler.close()
+
+def _run_eta(counter):
+    """How long until the build_images() run with the progress
+    'counter' should be done, in seconds: the time the images being
+    built have left (by their estimates), plus the images still
+    waiting, handed out longest first to whichever of the
+    counter['jobs'] workers is free soonest. Call with the counter's
+    lock held.
+    """
+    now = time.monotonic()
+    workers = [max(counter['estimates'].get(filename, 0) - (now - started), 0)
+               for (filename, started) in counter['running'].items()]
+    workers.extend([0] * max(counter['jobs'] - len(workers), 0))
+    for seconds in sorted((counter['estimates'].get(filename, 0)
+                           for filename in counter['waiting']), reverse=True):
+        workers[workers.index(min(workers))] += seconds
+    return max(workers)
+
+def chain_seconds(imgs, estimates):
+    """Given the virt-install images 'imgs' and a dict of how long
+    each should take, return a dict of how long each image holds up
+    the run: its own time plus that of the longest chain of images
+    derived from it, which can't start until it's done. So a base
+    image always counts for at least as much as the images derived
+    from it.
+    """
+    ordered = dependency_order(imgs)
+    chain = {}
+    for img in reversed(ordered):
+        below = [chain[other.filename] for other in ordered
+                 if other.base and other.base.filename == img.filename]
+        chain[img.filename] = estimates[img.filename] + max(below, default=0)
+    return chain
+
+def _build_guestfs_batch(imgs, args, counter):
+    """Build a batch of guestfs images sharing one appliance. Failed
+    images are recorded in counter['failed']; when building serially
+    the first failure is also raised, to stop the run.
+    """
+    try:
+        failed = create_guestfs_images(
+            imgs, imgctx=lambda img: image_logging(img, args, counter))
+    except Exception as err:
+        if args.jobs <= 1:
+            raise
+        logger.error("Could not set up guestfs appliance: %s", err)
+        failed = [(img, err) for img in imgs]
+    for (img, _) in failed:
+        img.record_failure()
+    with counter['lock']:
+        counter['failed'].extend(img.filename for (img, _) in failed)
+    if failed and args.jobs <= 1:
+        raise failed[0][1]
+
+def _build_direct(imgs, args, counter):
+    """Build guestfs images that don't need an appliance (see
+    GuestfsImage.create_direct()) one after another. Failures are
+    handled as in _build_guestfs_batch().
+    """
+    for img in imgs:
+        with image_logging(img, args, counter):
+            try:
+                img.create_direct()
+            except Exception as err:
+                img.record_failure()
+                if args.jobs <= 1:
+                    raise
+                logger.error("Creation of %s failed: %s", img.filename, err)
+                with counter['lock']:
+                    counter['failed'].append(img.filename)
+
+def dependency_order(imgs):
+    """Sort virt-install images so each image that is derived from a
+    base image comes after its base image, if that's in the list too.
+    Otherwise the order is kept.
+    """
+    filenames = set(img.filename for img in imgs)
+    done = set()
+    ordered = []
+
+    def _add(img):
+        if img.filename in done:
+            return
+        done.add(img.filename)
+        if img.base and img.base.filename in filenames:
+            _add([other for other in imgs if other.filename == img.base.filename][0])
+        ordered.append(img)
+
+    for img in imgs:
+        _add(img)
+    return ordered
+
+def _build_virtinstall(imgs, args, counter, ctx, after=None):
+    """Build virt-install images one after another. Failures are
+    recorded in counter['failed'] rather than raised when building in
+    parallel, so one broken image doesn't stop the rest of the run.
+    If 'after' is a future, wait for it to be done first (it's the
+    build of the base image of the first image).
+    """
+    import concurrent.futures
+    if after is not None:
+        concurrent.futures.wait([after])
+    for img in imgs:
+        if ctx.aborted.is_set():
+            return
+        with image_logging(img, args, counter):
+            try:
+                create_image(img, args, ctx)
+            except (Exception, SystemExit) as err:
+                # create() uses sys.exit() on failure, so we catch
+                # that too. if the build was interrupted, it's not
+                # the image's fault
+                if ctx.aborted.is_set():
+                    logger.info("Creation of %s stopped: %s", img.filename, err)
+                    return
+                img.record_failure()
+                if args.jobs <= 1:
+                    raise
+                logger.error("Creation of %s failed: %s", img.filename, err)
+                with counter['lock']:
+                    counter['failed'].append(img.filename)
+
+def _finish_compactions(args, counter, ctx):
+    """Wait for the background compactions of virt-install images to
+    finish, and record the ones that failed like any other failed
+    image (raising the first failure when building serially).
+    """
+    for (img, err) in ctx.finish_compactions():
+        img.record_failure()
+        if args.jobs <= 1:
+            raise err
+        with counter['lock']:
+            counter['failed'].append(img.filename)
+
+def build_images(imgs, args):
+    """Create all the images in the list 'imgs'. guestfs images with
+    simple enough layouts are built without an appliance (see
+    GuestfsImage.create_direct()); the rest are built in batches of
+    up to args.guestfs_batch images which share a single guestfs
+    appliance (see create_guestfs_images). If
+    args.jobs is 1 (the default), the batches and then the virt-
+    install images are built one at a time, and the first failure
+    stops the run. Otherwise up to args.jobs batches / images are
+    built at once by a pool of worker threads, each writing a per-
+    image log file to args.logdir. guestfs images are independent of
+    each other so the batches can all be built concurrently; so are
+    virt-install images, which each use their own libvirt domain, but
+    each install only starts once the BuildContext's
+    AdmissionController says the host has the memory, CPU and disk
+    space for it (see AdmissionController). Images derived from a base
+    image are built after it (see VirtInstallImage.derive()). In
+    parallel mode a failed image does not stop the others; we exit
+    with an error listing the failures once everything else is done.
+    Either way, each image is
+    created under a temporary name and only renamed into place on
+    success. All the builds share a BuildContext. If args.cache_dir is
+    set, virt-install images are installed via a MirrorCache using that
+    directory, which runs for the duration of the build. virt-install
+    images that are to be compacted are compacted in the background
+    while the build carries on; we wait for that at the end. In
+    parallel mode the builds that hold up the run longest (going by
+    estimate_seconds(), so the build history, and chain_seconds())
+    are started first, which gets the whole run done soonest; the
+    estimates also give the times logged as each image starts.
+    """
+    import concurrent.futures
+    guestfs_imgs = [img for img in imgs if isinstance(img, GuestfsImage) and not img.direct]
+    direct_imgs = [img for img in imgs if isinstance(img, GuestfsImage) and img.direct]
+    virtinstall_imgs = dependency_order(
+        [img for img in imgs if not isinstance(img, GuestfsImage)])
+    images = load_state()['images']
+    history = history_estimates()
+    estimates = dict((img.filename, estimate_seconds(img, images, history)) for img in imgs)
+    counter = {'lock': threading.Lock(), 'num': 0, 'total': len(imgs), 'failed': [],
+               'jobs': max(args.jobs, 1), 'estimates': estimates,
+               'waiting': set(estimates), 'running': {}}
+    batchsize = max(args.guestfs_batch, 1)
+    if args.jobs > 1 and guestfs_imgs:
+        # spread the guestfs images across the workers rather than
+        # filling up one appliance while the others sit idle
+        batchsize = min(batchsize, -(-len(guestfs_imgs) // args.jobs))
+    batches = [guestfs_imgs[i:i+batchsize] for i in range(0, len(guestfs_imgs), batchsize)]
+    mirror = None
+    if args.cache_dir and virtinstall_imgs:
+        mirror = MirrorCache(args.cache_dir, handle_size(args.cache_size),
+                             address=args.mirror_address, port=args.mirror_port)
+        mirror.start()
+    ctx = BuildContext(mirror=mirror, osinfo_cache=OSINFO_CACHE,
+                       stall_timeout=args.stall_timeout,
+                       install_timeout=args.install_timeout)
+
+    try:
+        if args.jobs <= 1:
+            _build_direct(direct_imgs, args, counter)
+            for batch in batches:
+                _build_guestfs_batch(batch, args, counter)
+            _build_virtinstall(virtinstall_imgs, args, counter, ctx)
+            _finish_compactions(args, counter, ctx)
+            return
+
+        # submit everything longest first. derived images wait for
+        # their base; as a base counts for at least as long as the
+        # images derived from it, and sorted() is stable, the base was
+        # submitted earlier and is already running by then
+        chain = chain_seconds(virtinstall_imgs, estimates)
+        tasks = [(chain[img.filename], 'virtinstall', img) for img in virtinstall_imgs]
+        tasks.extend((sum(estimates[img.filename] for img in batch), 'guestfs', batch)
+                     for batch in batches)
+        tasks.extend((estimates[img.filename], 'direct', img) for img in direct_imgs)
+        tasks.sort(key=lambda task: -task[0])
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+        try:
+            futures = []
+            vifutures = {}
+            for (_, kind, task) in tasks:
+                if kind == 'virtinstall':
+                    after = vifutures.get(task.base.filename) if task.base else None
+                    vifutures[task.filename] = executor.submit(
+                        _build_virtinstall, [task], args, counter, ctx, after)
+                    futures.append(vifutures[task.filename])
+                elif kind == 'guestfs':
+                    futures.append(executor.submit(_build_guestfs_batch, task, args, counter))
+                else:
+                    futures.append(executor.submit(_build_direct, [task], args, counter))
+            concurrent.futures.wait(futures)
+        except KeyboardInterrupt:
+            # stop the installs first, or the shutdown below would
+            # wait for them all to finish
+            ctx.abort()
+            raise
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        _finish_compactions(args, counter, ctx)
+    finally:
+        ctx.close()
+        if mirror:
+            mirror.stop()
+    if counter['failed']:
+        sys.exit("Failed to create image(s): {0}".format(', '.join(counter['failed'])))
+
+def _read_block(fileobj, num, size, blocksize=SYNC_BLOCKSIZE):
+    """Read block number 'num' of a file of 'size' bytes."""
+    fileobj.seek(num * blocksize)
+    return fileobj.read(min(blocksize, size - num * blocksize))
+
+def block_index(filename, blocksize=SYNC_BLOCKSIZE, write=True):
+    """Returns the block hash index of an image file: a dict with the
+    file's 'size' and 'mtime', the 'blocksize', and 'blocks', a list
+    of the hash of each block, or None for blocks that are all zeroes
+    (which are left as holes when syncing). The index is kept in a
+    file beside the image (named with BLOCKINDEX added) and only
+    recomputed if the image's size or mtime no longer match it; pass
+    write=False to not write it.
+    """
+    stat = os.stat(filename)
+    try:
+        with open(filename + BLOCKINDEX, 'r') as indexfh:
+            index = json.load(indexfh)
+        if (index['size'], index['mtime'], index['blocksize']) == \
+                (stat.st_size, stat.st_mtime, blocksize):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    logger.debug("Indexing blocks of %s", filename)
+    zeroes = bytes(blocksize)
+    blocks = []
+    with open(filename, 'rb') as imgfh:
+        for num in range(-(-stat.st_size // blocksize)):
+            data = _read_block(imgfh, num, stat.st_size, blocksize)
+            if data == zeroes[:len(data)]:
+                blocks.append(None)
+            else:
+                blocks.append(hashlib.blake2b(data, digest_size=16).hexdigest())
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'blocksize': blocksize,
+             'blocks': blocks}
+    if write:
+        tmpfile = "{0}{1}.tmp".format(filename, BLOCKINDEX)
+        with open(tmpfile, 'w') as indexfh:
+            json.dump(index, indexfh)
+        os.rename(tmpfile, filename + BLOCKINDEX)
+    return index
+
+def _data_ranges(fileno, size):
+    """Yield (start, end) tuples of the ranges of the open file
+    'fileno' (of 'size' bytes) that may hold data; the gaps between
+    them are holes, which read as zeroes. If the filesystem can't tell
+    us where the holes are, the whole file is one range.
+    """
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fileno, pos, os.SEEK_DATA)
+        except OSError as err:
+            if err.errno != errno.ENXIO:
+                yield (pos, size)
+            # ENXIO means there's no more data, just a hole to the end
+            return
+        end = min(os.lseek(fileno, start, os.SEEK_HOLE), size)
+        yield (start, end)
+        pos = end
+
+def file_checksum(filename, chunk=HASH_CHUNK):
+    """Return the SHA-256 checksum of a file, as a dict with the hex
+    'digest' and the 'size' and 'mtime' the file had when we started
+    (so we can tell if it's changed since). The file is read 'chunk'
+    bytes at a time into the same buffer, so this takes the same
+    memory however big the file is. Holes in sparse files aren't read
+    at all: we just hash the right number of zeroes.
+    """
+    hasher = hashlib.sha256()
+    buf = memoryview(bytearray(chunk))
+    zeroes = memoryview(bytes(chunk))
+    with open(filename, 'rb', buffering=0) as fileh:
+        stat = os.fstat(fileh.fileno())
+        os.posix_fadvise(fileh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        pos = 0
+        # a final empty range at the end of the file, so we hash any
+        # hole after the last data
+        ranges = list(_data_ranges(fileh.fileno(), stat.st_size))
+        for (start, end) in ranges + [(stat.st_size, stat.st_size)]:
+            while pos < start:
+                length = min(chunk, start - pos)
+                hasher.update(zeroes[:length])
+                pos += length
+            fileh.seek(start)
+            while pos < end:
+                got = fileh.readinto(buf[:min(chunk, end - pos)])
+                if not got:
+                    # the file got shorter under us; the size and
+                    # mtime we return won't match it any more anyway
+                    break
+                hasher.update(buf[:got])
+                pos += got
+    return {'digest': hasher.hexdigest(), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def _sum_current(filename, entry):
+    """Whether the checksum recorded in a state file 'entry' is for
+    the image file 'filename' as it is now (same size and mtime).
+    """
+    checksum = entry.get('sha256')
+    if not checksum:
+        return False
+    stat = os.stat(filename)
+    return (checksum['size'], checksum['mtime']) == (stat.st_size, stat.st_mtime)
+
+def known_checksum(entry):
+    """Return a checksum (see file_checksum()) already recorded in the
+    state file for an image with the same fingerprint, size and mtime
+    as the state file 'entry', if there is one; that's another name for
+    the same image in the image store (see _share()). Otherwise None.
+    """
+    for other in load_state()['images'].values():
+        checksum = other.get('sha256')
+        if checksum and other.get('fingerprint') == entry['fingerprint'] and \
+                (checksum['size'], checksum['mtime']) == (entry['size'], entry['mtime']):
+            return checksum
+    return None
+
+def write_sums():
+    """Write the checksum manifest (SUMSFILE), in the format
+    'sha256sum -c' reads, for all the image files in the working
+    directory whose recorded checksum is current (see _sum_current());
+    images that have changed since they were hashed are left out until
+    'checksum' hashes them again. Written atomically, and under the
+    state lock, as parallel builds all call this. Problems are logged,
+    not raised.
+    """
+    try:
+        with _STATELOCK:
+            images = load_state()['images']
+            lines = ["{0}  {1}\n".format(images[fn]['sha256']['digest'], fn)
+                     for fn in sorted(os.listdir('.')) if is_image_file(fn) and
+                     _sum_current(fn, images.get(fn, {}))]
+            tmpfile = "{0}.tmp".format(SUMSFILE)
+            with open(tmpfile, 'w') as sumsfh:
+                sumsfh.writelines(lines)
+            os.rename(tmpfile, SUMSFILE)
+    except OSError as err:
+        logger.warning("Could not write %s: %s", SUMSFILE, err)
+
+def checksum_images(filenames, jobs=1, force=False):
+    """Make sure the state file has a current checksum for each of
+    the image files in 'filenames' (see file_checksum()), hashing only
+    those whose size or mtime has changed since they were last hashed
+    (or all of them, with 'force'), up to 'jobs' at once, biggest
+    first so one big image doesn't end up being hashed on its own at
+    the end. Returns a list of the filenames that were hashed.
+    """
+    import concurrent.futures
+    images = load_state()['images']
+    todo = [fn for fn in filenames if force or not _sum_current(fn, images.get(fn, {}))]
+    todo.sort(key=os.path.getsize, reverse=True)
+
+    def _hash(filename):
+        with span('checksum', filename):
+            return file_checksum(filename)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {filename: executor.submit(_hash, filename) for filename in todo}
+    checksums = {filename: future.result() for (filename, future) in futures.items()}
+    def _record(images):
+        for (filename, checksum) in checksums.items():
+            images.setdefault(filename, {})['sha256'] = checksum
+    update_state(_record)
+    return todo
+
+class SyncReceiver(object):
+    """The receiving end of 'sync': updates copies of images in
+    'directory'. For each image the sender sends a header (the image's
+    filename, size, blocksize and block hashes, see block_index());
+    wanted() compares that with the index of the copy we have, and
+    returns the numbers of the blocks we need, then apply() builds the
+    new copy from the blocks of the old one that haven't changed plus
+    the ones that have, which the sender sends. All-zero blocks are
+    left as holes, so the copy is as sparse as the original. The new
+    copy is written to a temporary file and renamed into place, so
+    there's never a partial image under the real name, and its index
+    is written beside it for next time.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _paths(self, header):
+        filename = os.path.basename(header['filename'])
+        path = os.path.join(self.directory, filename)
+        return (path, os.path.join(self.directory, ".{0}.sync.tmp".format(filename)))
+
+    def _old_index(self, header):
+        """The index of our current copy, if we have one with the same
+        block size.
+        """
+        (path, _) = self._paths(header)
+        if not os.path.isfile(path):
+            return None
+        return block_index(path, header['blocksize'])
+
+    def wanted(self, header):
+        """Which blocks of the image described by 'header' we need."""
+        old = self._old_index(header)
+        oldblocks = old['blocks'] if old else []
+        return [num for (num, blkhash) in enumerate(header['blocks'])
+                if blkhash is not None and
+                (num >= len(oldblocks) or oldblocks[num] != blkhash)]
+
+    def apply(self, header, blocks):
+        """Build the new copy of the image described by 'header'.
+        'blocks' is an iterable of (number, data) tuples, giving the
+        blocks wanted() asked for, in order.
+        """
+        (path, tmpfile) = self._paths(header)
+        (size, blocksize) = (header['size'], header['blocksize'])
+        old = self._old_index(header)
+        oldblocks = old['blocks'] if old else []
+        if old and old['size'] == size and oldblocks == header['blocks']:
+            # our copy is already up to date
+            for _ in blocks:
+                pass
+            return
+        try:
+            with open(tmpfile, 'wb') as newfh:
+                newfh.truncate(size)
+                for (num, data) in blocks:
+                    newfh.seek(num * blocksize)
+                    newfh.write(data)
+                # now copy across the blocks that haven't changed
+                unchanged = [num for (num, blkhash) in enumerate(header['blocks'])
+                             if blkhash is not None and num < len(oldblocks) and
+                             oldblocks[num] == blkhash]
+                if unchanged:
+                    with open(path, 'rb') as oldfh:
+                        for num in unchanged:
+                            newfh.seek(num * blocksize)
+                            newfh.write(_read_block(oldfh, num, size, blocksize))
+                newfh.flush()
+                os.fsync(newfh.fileno())
+            os.chmod(tmpfile, 0o644)
+            os.rename(tmpfile, path)
+        except:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            raise
+        # write our index for next time; we know the hashes already
+        stat = os.stat(path)
+        index = {'size': size, 'mtime': stat.st_mtime, 'blocksize': blocksize,
+                 'blocks': header['blocks']}
+        with open(tmpfile, 'w') as indexfh:
+            json.dump(index, indexfh)
+        os.rename(tmpfile, path + BLOCKINDEX)
+
+class LocalTarget(object):
+    """A 'sync' target directory on this host."""
+    def __init__(self, directory):
+        self.name = directory
+        self.receiver = SyncReceiver(directory)
+
+    def send(self, header, path):
+        """Sync the image at 'path', described by 'header'. Returns the
+        number of blocks sent.
+        """
+        need = self.receiver.wanted(header)
+        with open(path, 'rb') as imgfh:
+            self.receiver.apply(header, ((num, _read_block(imgfh, num, header['size'],
+                                                           header['blocksize']))
+                                         for num in need))
+        return len(need)
+
+    def close(self):
+        pass
+
+class SSHTarget(object):
+    """A 'sync' target directory on another host, reached over ssh.
+    Runs 'createhdds.py sync-receive' (or 'command sync-receive') on
+    the host, which runs a SyncReceiver, and talks to it over the ssh
+    connection: for each image we send a JSON header line, it replies
+    with a JSON line listing the blocks it wants, we send those blocks,
+    and it replies with a JSON result line once the image is in place.
+    """
+    def __init__(self, host, directory, command='createhdds.py'):
+        self.name = "{0}:{1}".format(host, directory)
+        self.proc = subprocess.Popen(
+            ["ssh", "-o", "BatchMode=yes", host, command, "sync-receive", directory],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _reply(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            raise IOError("sync-receive on {0} exited unexpectedly".format(self.name))
+        reply = json.loads(line.decode())
+        if 'error' in reply:
+            raise IOError("sync-receive on {0} failed: {1}".format(self.name, reply['error']))
+        return reply
+
+    def send(self, header, path):
+        """Sync the image at 'path', described by 'header'. Returns the
+        number of blocks sent.
+        """
+        self.proc.stdin.write(json.dumps(header).encode() + b"\n")
+        self.proc.stdin.flush()
+        need = self._reply()['need']
+        with open(path, 'rb') as imgfh:
+            for num in need:
+                self.proc.stdin.write(_read_block(imgfh, num, header['size'],
+                                                  header['blocksize']))
+        self.proc.stdin.flush()
+        self._reply()
+        return len(need)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+def sync_target(spec, command='createhdds.py'):
+    """Returns the LocalTarget or SSHTarget for a 'sync' target given
+    as a directory or as '[user@]host:directory'.
+    """
+    (host, sep, directory) = spec.partition(':')
+    if sep and '/' not in host:
+        return SSHTarget(host, directory, command)
+    return LocalTarget(spec)
+
+def sync_images(filenames, targets, jobs=1):
+    """Sync the image files 'filenames' to each of the targets (see
+    sync_target()), sending only the blocks that each target's copy
+    doesn't already have. Up to 'jobs' targets are synced at once.
+    Returns a dict of target name to (blocks sent, blocks in total).
+    """
+    import concurrent.futures
+    headers = {}
+    for filename in filenames:
+        with span('index', filename):
+            index = block_index(filename)
+        headers[filename] = dict(index, filename=filename)
+
+    def _sync(target):
+        (sent, total) = (0, 0)
+        try:
+            for filename in filenames:
+                header = headers[filename]
+                with span('sync', filename, target=target.name):
+                    num = target.send(header, filename)
+                blocks = len([blk for blk in header['blocks'] if blk is not None])
+                logger.info("Synced %s to %s: sent %s of %s blocks", filename, target.name,
+                            num, blocks)
+                sent += num
+                total += blocks
+        finally:
+            target.close()
+        return (sent, total)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {target.name: executor.submit(_sync, target) for target in targets}
+    return {name: future.result() for (name, future) in futures.items()}
+
+class InotifyWatcher(object):
+    """Watches the directories 'dirs' (not their subdirectories) for
+    files being written, created, deleted or renamed, with inotify,
+    which we reach through ctypes. Raises OSError (or AttributeError,
+    if the C library has no inotify) if inotify can't be used.
+    """
+    name = 'inotify'
+
+    def __init__(self, dirs):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        for directory in dirs:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(err, "can't watch {0}".format(directory))
+            self.dirs[wd] = directory
+
+    def read(self, timeout=None):
+        """Wait up to 'timeout' seconds (forever if it's None) for
+        changes, and return the set of paths that changed, which is
+        empty if nothing did. None in the set means the kernel dropped
+        some events, so anything may have changed.
+        """
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        pos = 0
+        # each event is a struct inotify_event: the watch descriptor,
+        # mask, cookie and name length, then the (padded) name
+        while pos < len(data):
+            (wd, mask, _, length) = struct.unpack_from('iIII', data, pos)
+            name = data[pos+16:pos+16+length].rstrip(b'\0')
+            pos += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                changed.add(None)
+            elif wd in self.dirs:
+                changed.add(os.path.join(self.dirs[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
+
+
+class PollWatcher(object):
+    """Watches the directories 'dirs' (not their subdirectories) for
+    changes like InotifyWatcher, where inotify isn't available, by
+    looking at the size and mtime of everything in them every
+    'interval' seconds.
+    """
+    name = 'poll'
+
+    def __init__(self, dirs, interval=5):
+        self.dirs = list(dirs)
+        self.interval = interval
+        self.seen = self._scan()
+
+    def _scan(self):
+        seen = {}
+        for directory in self.dirs:
+            try:
+                for entry in os.scandir(directory):
+                    stat = entry.stat()
+                    seen[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+        return seen
+
+    def read(self, timeout=None):
+        """Wait up to 'timeout' seconds (forever if it's None) for
+        changes, and return the set of paths that changed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.monotonic(), 0))
+            time.sleep(wait)
+            seen = self._scan()
+            changed = set(path for path in set(seen) | set(self.seen)
+                          if seen.get(path) != self.seen.get(path))
+            self.seen = seen
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        """Stop watching."""
+        pass
+
+
+def file_watcher(dirs, interval=5):
+    """Return an InotifyWatcher for the directories 'dirs' if we can,
+    otherwise a PollWatcher.
+    """
+    try:
+        return InotifyWatcher(dirs)
+    except (OSError, AttributeError) as err:
+        logger.info("Can't use inotify (%s), checking for changes every %s seconds instead",
+                    err, interval)
+        return PollWatcher(dirs, interval)
+
+def write_status(path, status):
+    """Write the 'watch' status dict 'status' to the file 'path' as
+    JSON, atomically, with the time it was written.
+    """
+    status['updated'] = time.time()
+    tmpfile = "{0}.tmp".format(path)
+    with open(tmpfile, 'w') as statusfh:
+        json.dump(status, statusfh, indent=2, sort_keys=True)
+    os.rename(tmpfile, path)
+
+def restore_and_build(build, restore, dupes, args):
+    """Restore the images in 'restore' from the image store, build the
+    images in 'build', and then restore the images in 'dupes' from
+    the store, or build those that didn't make it in (see
+    store_plan()).
+    """
+    for img in restore:
+        store_restore(img)
+    build_images(build, args)
+    # if an image didn't make it into the store, build its
+    # duplicates after all
+    rebuild = [img for img in dupes if not store_restore(img)]
+    if rebuild:
+        build_images(rebuild, args)
+
 def cli_all(args, hdds):
     """Function for the CLI 'all' subcommand. Creates all images. If
     args.delete is set, blows all existing images away and recreates
     them; otherwise it will just fill in missing or outdated images.
-    If args.clean is set, also wipes 'unknown' images.
+    If args.clean is set, also wipes 'unknown' images. Images the
+    image store already has are restored from it rather than built
+    (see store_plan()). With args.budget, only as many outdated images
+    are rebuilt as fit in the budget (see refresh_plan()). Nothing is
+    deleted or built unless the preflight checks pass (see
+    run_preflight()); with args.dry_run, we stop after those, and
+    don't rename or adopt images either.
     """
+    (early, deferred) = ([], [])
     if args.delete:
-        logger.info("Removing all images...")
-        delete_all()
+        # everything will be rebuilt, and as delete_all() removes
+        # every image file (and the store), there can't be any
+        # 'unknown' ones left
+        missing = get_all_images(hdds, nextrel=args.nextrel)
+        unknown = []
+    else:
+        expected = get_all_images(hdds, nextrel=args.nextrel)
+        if not args.dry_run:
+            # handle renamed images (see do_renames docstring)
+            do_renames(hdds)
+            # make sure existing images have a fingerprint recorded,
+            # so we can tell when their inputs change
+            adopt_images(expected)
 
-    # handle renamed images (see do_renames docstring)
-    do_renames(hdds)
+        # call check() to find out what we need to do
+        (missing, outdated, unknown) = check(hdds, nextrel=args.nextrel)
+        if args.budget:
+            stale = set(img.filename for img in missing + outdated)
+            arches = supported_arches()
+            current = [img for img in expected if img.filename not in stale and
+                       img.arch in arches and os.path.isfile(img.filename)]
+            (missing, early, deferred) = refresh_plan(missing, outdated, current,
+                                                      args.budget, jobs=args.jobs)
+        else:
+            # 'missing' plus 'outdated' is all the images we need to build
+            missing.extend(outdated)
 
-    # call check() to find out what we need to do
-    (missing, outdated, unknown) = check(hdds, nextrel=args.nextrel)
+    # but images the store has, and all but one of several images
+    # with the same inputs, can come from the store instead. Early
+    # rebuilds are up to date, so the store would just give us the
+    # same image back
+    (missing, restore, dupes) = store_plan(missing, fresh=args.delete)
+    missing.extend(early)
+    run_preflight(missing, args, restored=restore + dupes, early=early, deferred=deferred)
+
+    if args.delete:
+        logger.info("Removing all images...")
+        delete_all()
 
     # wipe 'unknown' images if requested
     if args.clean:
         clean(unknown)
 
-    # 'missing' plus 'outdated' is all the images we need to build; if
-    # args.delete was set, all images will be in this list
-    missing.extend(outdated)
-    for (num, img) in enumerate(missing, 1):
-        logger.info("Creating image %s...[%s/%s]", img.filename, str(num), str(len(missing)))
-        if img.filename.endswith(".img"):
-          img.create(args.textinst)
-        else:
-          img.create(args.baseurl, args.textinst)
+    try:
+        restore_and_build(missing, restore, dupes, args)
+    finally:
+        if args.prometheus:
+            METRICS.write_prometheus(args.prometheus)
+
+def _watch_relevant(path):
+    """Whether a change to 'path' (None for 'anything') can affect
+    any images: hdds.json, the kickstarts and the upload files.
+    """
+    if path is None or path == os.path.join(SCRIPTDIR, 'hdds.json'):
+        return True
+    directory = os.path.dirname(path)
+    if directory == SCRIPTDIR:
+        return path.endswith('.ks')
+    return directory == os.path.join(SCRIPTDIR, 'uploads')
+
+def cli_watch(args, hdds):
+    """Function for the CLI 'watch' subcommand. Watches hdds.json,
+    the kickstarts and the upload files (see file_watcher()), and when
+    they change, works out which images that affects (through the
+    images' 'watches'; all of them, if hdds.json changed) and builds
+    those that are missing or whose inputs really have changed, as
+    'all' would, but without looking at any others. Changes are
+    collected until there have been none for args.debounce seconds,
+    so an editor or git changing several files (or one file several
+    times) only causes one build. Images whose inputs changed while
+    we weren't watching are built when we start. The current state is
+    written to args.status as JSON. Runs until it's interrupted.
+    """
+    hddsfile = os.path.join(SCRIPTDIR, 'hdds.json')
+    arches = supported_arches()
+
+    def _expected(hdds):
+        imgs = [img for img in get_all_images(hdds, nextrel=args.nextrel) if img.arch in arches]
+        if not args.dry_run:
+            do_renames(hdds)
+            adopt_images(imgs)
+        index = {}
+        for img in imgs:
+            for path in img.watches:
+                index.setdefault(path, []).append(img)
+        return (imgs, index)
+
+    def _stale(imgs):
+        images = load_state()['images']
+        return [img for img in imgs if not os.path.isfile(img.filename) or
+                not img.inputs_unchanged(images.get(img.filename, {}))]
+
+    (imgs, index) = _expected(hdds)
+    watcher = file_watcher([SCRIPTDIR, os.path.join(SCRIPTDIR, 'uploads')], args.interval)
+    status = {'pid': os.getpid(), 'watcher': watcher.name, 'state': 'watching',
+              'building': [], 'last_change': None, 'last_build': None}
+    # catch up with changes made while we weren't watching
+    queue = [img for img in _stale(imgs) if os.path.isfile(img.filename)]
+    try:
+        while True:
+            if queue:
+                (build, restore, dupes) = store_plan(queue)
+                names = sorted(img.filename for img in queue)
+                logger.info("Rebuilding %s", ', '.join(names))
+                status.update(state='building', building=names)
+                write_status(args.status, status)
+                started = time.time()
+                error = None
+                try:
+                    run_preflight(build, args, restored=restore + dupes)
+                    restore_and_build(build, restore, dupes, args)
+                except SystemExit as err:
+                    # failed preflight checks or builds, or the end of
+                    # a --dry-run plan
+                    error = err.code or None
+                except Exception as err:
+                    logger.exception("Rebuilding failed")
+                    error = str(err)
+                if error:
+                    logger.error("%s", error)
+                status.update(state='watching', building=[], last_build={
+                    'images': names, 'started': started, 'finished': time.time(),
+                    'result': 'failed' if error else 'ok', 'error': error})
+                queue = []
+            write_status(args.status, status)
+
+            changes = watcher.read()
+            # wait for things to settle down
+            while True:
+                more = watcher.read(args.debounce)
+                if not more:
+                    break
+                changes |= more
+            changes = set(path for path in changes if _watch_relevant(path))
+            if not changes:
+                continue
+            status['last_change'] = {'time': time.time(),
+                                     'paths': sorted(path or '*' for path in changes)}
+            logger.info("Changed: %s", ', '.join(status['last_change']['paths']))
+            candidates = {}
+            if None in changes or hddsfile in changes:
+                try:
+                    with open(hddsfile, 'r') as hddsfh:
+                        newhdds = json.load(hddsfh)
+                    errors = validate_hdds(newhdds)
+                except (OSError, ValueError) as err:
+                    errors = [str(err)]
+                if errors:
+                    logger.error("hdds.json is not valid, ignoring it until it's fixed:\n  %s",
+                                 '\n  '.join(errors))
+                else:
+                    hdds = newhdds
+                    (imgs, index) = _expected(hdds)
+                    candidates.update((img.filename, img) for img in imgs)
+            for path in changes:
+                candidates.update((img.filename, img) for img in index.get(path, []))
+            queue = _stale(candidates.values())
+            if not queue:
+                logger.info("No images affected")
+    finally:
+        watcher.close()
 
 def cli_check(args, hdds):
     """Function for the CLI 'check' subcommand. Basically just calls
     check() and prints the results. Does renames before checking if
     args.rename was set, and wipes 'unknown' images after checking if
-    args.clean was set. Exits with status 2 if any images are missing,
-    1 if all images are present but one or more is outdated.
+    args.clean was set. If args.sizes is set, also prints the apparent
+    and allocated size of each image file. If args.format is 'json',
+    prints a JSON object with 'missing', 'outdated' and 'unknown' lists
+    of filenames and an 'images' dict of what the manifest records for
+    each present image instead. Exits with status 2 if any images are
+    missing, 1 if all images are present but one or more is outdated.
     """
     if args.rename:
         do_renames(hdds)
 
     (missing, outdated, unknown) = check(hdds, nextrel=args.nextrel)
-    if missing:
-        print("Missing images: {0}".format(', '.join([img.filename for img in missing])))
-    if outdated:
-        print("Outdated images: {0}".format(', '.join([img.filename for img in outdated])))
-    if unknown:
-        print("Unknown images: {0}".format(', '.join(unknown)))
-        if args.clean:
+    if args.format == 'json':
+        images = load_state()['images']
+        present = [entry.name for entry in os.scandir('.') if is_image_file(entry.name)]
+        result = {
+            'missing': [img.filename for img in missing],
+            'outdated': [img.filename for img in outdated],
+            'unknown': unknown,
+            'images': dict((filename, images.get(filename, {})) for filename in present),
+        }
+        if args.sizes:
+            for filename in present:
+                (apparent, allocated) = image_sizes(filename)
+                result['images'][filename].update(apparent=apparent, allocated=allocated)
+        print(json.dumps(result, indent=2, sort_keys=True))
+        if unknown and args.clean:
             clean(unknown)
+    else:
+        if missing:
+            print("Missing images: {0}".format(', '.join([img.filename for img in missing])))
+        if outdated:
+            print("Outdated images: {0}".format(', '.join([img.filename for img in outdated])))
+        if unknown:
+            print("Unknown images: {0}".format(', '.join(unknown)))
+            if args.clean:
+                clean(unknown)
+        if args.sizes:
+            for filename in sorted(fl for fl in os.listdir('.') if is_image_file(fl)):
+                (apparent, allocated) = image_sizes(filename)
+                print("{0}: apparent size {1}, allocated {2}".format(
+                    filename, format_size(apparent), format_size(allocated)))
 
     if missing:
         sys.exit(2)
@@ -643,14 +4810,171 @@ def cli_check(args, hdds):
     else:
         sys.exit()
 
-def cli_image(args, *_):
+def cli_gc(args, hdds):
+    """Function for the CLI 'gc' subcommand. Removes the blobs in the
+    image store that none of the expected images need (see
+    store_gc()), printing each one, with the images it was recorded
+    as, and the space freed. With args.dry_run, just lists them.
+    """
+    expected = get_all_images(hdds, nextrel=args.nextrel)
+    if not args.dry_run:
+        # so blobs named for FPFORMAT 1 fingerprints get their new names
+        adopt_images(expected)
+    fprints = set(img.fingerprint for img in expected)
+    names = {}
+    images = load_state()['images']
+    for (filename, entry) in images.items():
+        names.setdefault(entry.get('fingerprint'), []).append(filename)
+    # and with --dry-run, those blobs aren't counted as unneeded
+    for img in expected:
+        entry = images.get(img.filename, {})
+        if 'fingerprint' in entry and entry.get('fpformat', 1) < FPFORMAT:
+            fprints.add(entry['fingerprint'])
+    removed = store_gc(fprints, dry_run=args.dry_run)
+    for (blob, freed) in removed:
+        print("{0} {1} ({2}): {3} freed".format(
+            "Would remove" if args.dry_run else "Removed", blob,
+            ', '.join(sorted(names.get(blob, []))) or 'no image', format_size(freed)))
+    print("{0} blob(s), {1} freed".format(len(removed),
+                                          format_size(sum(freed for (_, freed) in removed))))
+
+def cli_checksum(args, *_):
+    """Function for the CLI 'checksum' subcommand. Hashes the image
+    files in the working directory that have changed since they were
+    last hashed (or all of them, if args.force is set) using up to
+    args.jobs threads (see checksum_images()), and writes the
+    checksum manifest (see write_sums()).
+    """
+    filenames = sorted(fn for fn in os.listdir('.') if is_image_file(fn))
+    hashed = checksum_images(filenames, jobs=args.jobs, force=args.force)
+    write_sums()
+    for filename in hashed:
+        logger.info("Hashed %s", filename)
+    print("Hashed {0} of {1} image(s) ({2}), wrote {3}".format(
+        len(hashed), len(filenames), format_size(sum(os.path.getsize(fn) for fn in hashed)),
+        SUMSFILE))
+
+def cli_verify(args, hdds):
+    """Function for the CLI 'verify' subcommand. Checks the contents of
+    the expected images that are present (or just those named in
+    args.images) against hdds.json (see verify_images()), using up to
+    args.jobs guestfs appliances, and prints the problems found with
+    each image; as JSON if args.format is 'json'. Exits 1 if there
+    were any.
+    """
+    imgs = [img for img in get_all_images(hdds, nextrel=args.nextrel)
+            if os.path.isfile(img.filename)]
+    if args.images:
+        unknown = set(args.images).difference(img.filename for img in imgs)
+        if unknown:
+            sys.exit("Not expected images, or not present: {0}".format(
+                ', '.join(sorted(unknown))))
+        imgs = [img for img in imgs if img.filename in args.images]
+    results = verify_images(imgs, sessions=args.jobs)
+    if args.format == 'json':
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for img in imgs:
+            problems = results[img.filename]
+            status = "problems found" if problems else "OK"
+            print("{0}: {1}".format(img.filename, status))
+            for problem in problems:
+                print("  {0}".format(problem))
+    if any(results.values()):
+        sys.exit(1)
+
+def cli_history(args, *_):
+    """Function for the CLI 'history' subcommand. Reports on the build
+    history (see history_report()) of every image built here, or just
+    those in args.images, over the last args.days days: slowest
+    first, with the images that got slower or are flaky marked, and
+    only those if args.problems is set. As JSON if args.format is
+    'json'.
+    """
+    import sqlite3
+    if not os.path.exists(HISTORYFILE):
+        sys.exit("No build history yet ({0} does not exist)".format(HISTORYFILE))
+    try:
+        report = history_report(days=args.days, filenames=args.images)
+    except sqlite3.Error as err:
+        sys.exit("Could not read {0}: {1}".format(HISTORYFILE, err))
+    if args.problems:
+        report = dict((image, stats) for (image, stats) in report.items()
+                      if stats['slow'] or stats['flaky'])
+    if args.format == 'json':
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return
+    for (image, stats) in sorted(report.items(), key=lambda item: -(item[1]['median'] or 0)):
+        times = "never built OK"
+        if stats['median'] is not None:
+            times = "usually {0}, last {1}, {2}".format(
+                format_duration(stats['median']), format_duration(stats['last']),
+                format_size(stats['allocated']))
+        marks = [mark for mark in ('slow', 'flaky') if stats[mark]]
+        print("{0}: {1} build(s), {2} failed, {3} retried; {4}{5}".format(
+            image, stats['builds'], stats['failed'], stats['retried'], times,
+            " [{0}]".format(', '.join(marks)) if marks else ''))
+        if stats['slow']:
+            print("  last build: {0}".format(', '.join(
+                "{0} {1}".format(phase, format_duration(seconds))
+                for (phase, seconds) in stats['phases'][:3])))
+    print("{0} image(s), {1} slow, {2} flaky".format(
+        len(report), sum(stats['slow'] for stats in report.values()),
+        sum(stats['flaky'] for stats in report.values())))
+
+def cli_sync(args, hdds):
+    """Function for the CLI 'sync' subcommand. Syncs all the expected
+    images that are present to each target (see sync_images).
+    """
+    imgs = get_all_images(hdds, nextrel=args.nextrel)
+    filenames = [img.filename for img in imgs if os.path.isfile(img.filename)]
+    targets = [sync_target(spec, args.remote_command) for spec in args.targets]
+    results = sync_images(filenames, targets, jobs=args.jobs)
+    for (name, (sent, total)) in sorted(results.items()):
+        print("{0}: sent {1} of {2} blocks ({3})".format(
+            name, sent, total, format_size(sent * SYNC_BLOCKSIZE)))
+
+def cli_sync_receive(args, *_):
+    """Function for the CLI 'sync-receive' subcommand: the other end of
+    a 'sync' to this host over ssh (see SSHTarget). Speaks the sync
+    protocol on stdin and stdout.
+    """
+    receiver = SyncReceiver(args.directory)
+    infh = sys.stdin.buffer
+    outfh = sys.stdout.buffer
+
+    def _reply(obj):
+        outfh.write(json.dumps(obj).encode() + b"\n")
+        outfh.flush()
+
+    def _blocks(header, need):
+        for num in need:
+            length = min(header['blocksize'], header['size'] - num * header['blocksize'])
+            data = infh.read(length)
+            if len(data) != length:
+                raise IOError("short read from sender")
+            yield (num, data)
+
+    for line in infh:
+        header = json.loads(line.decode())
+        try:
+            need = receiver.wanted(header)
+            _reply({'need': need})
+            receiver.apply(header, _blocks(header, need))
+        except Exception as err:
+            _reply({'error': str(err)})
+            sys.exit(1)
+        _reply({'ok': True})
+
+def cli_image(args, hdds):
     """Function for CLI image group subcommands (a subcommand is added
     for each image group in hdds.json). Will create the image(s) from
     the specified group. For guestfs image groups with multiple labels
     and/or filesystems, the user can pass args.label and/or args.
     filesystem to limit creation to a single label and/or filesystem.
-    Note this function does no checking; the image will always be
-    recreated, even if it already exists and is current.
+    Note this function doesn't check whether the image is current; it
+    will always be recreated, even if it already exists and is up to
+    date (though the preflight checks still run, see run_preflight()).
     """
     # Note that on this path, the parsing of hdds is done by
     # parse_args(). It passes us the image type and the image group
@@ -688,19 +5012,13 @@ def cli_image(args, *_):
             else:
                 arches = ['x86_64']
             releases = {args.release: arches}
-        imgs = get_virtinstall_images(imggrp, releases=releases)
+        imgs = get_virtinstall_images(imggrp, releases=releases, groups=hdds['virtinstall'])
 
-    for (num, img) in enumerate(imgs, 1):
-        logger.info("Creating image %s...[%s/%s]", img.filename, str(num), str(len(imgs)))
-        if imgtype == 'guestfs':
-          img.create(args.textinst)
-        else:
-          img.create(args.baseurl, args.textinst)
+    run_preflight(imgs, args)
+    build_images(imgs, args)
 
-def parse_args(hdds):
-    """Parse arguments with argparse."""
-    parser = argparse.ArgumentParser(description=(
-        "Tool for creating hard disk images for Rocky Linux openQA."))
+def _add_global_args(parser):
+    """Add the options that come before the subcommand to 'parser'."""
     parser.add_argument(
         '-l', '--loglevel', help="The level of log messages to show",
         choices=('debug', 'info', 'warning', 'error', 'critical'),
@@ -712,6 +5030,64 @@ def parse_args(hdds):
         '-b', '--baseurl', help="For any virt-install images, support alt baseurl for initrd and vmlinuz.",
         choices=('pub', 'stg'),
         default='pub')
+    parser.add_argument(
+        '-j', '--jobs', help="When creating images, build up to this many at once",
+        type=int, default=1)
+    parser.add_argument(
+        '--logdir', help="When building with more than one job, write a log file for "
+        "each image to this directory (default: the working directory)", default='.')
+    parser.add_argument(
+        '--guestfs-batch', help="Build up to this many guestfs images with a single "
+        "guestfs appliance. Set to 1 to launch a new appliance for every image",
+        type=int, default=16)
+    parser.add_argument(
+        '--cache-dir', help="For any virt-install images, install via a caching mirror "
+        "of the Rocky download server which stores files in this directory. The cache "
+        "persists between runs")
+    parser.add_argument(
+        '--cache-size', help="Maximum size of the --cache-dir cache (e.g. 50G); least "
+        "recently used files are evicted beyond this", default='50G')
+    parser.add_argument(
+        '--mirror-address', help="Address install VMs and virt-install should use to "
+        "reach the caching mirror (default: this host's primary address)")
+    parser.add_argument(
+        '--mirror-port', help="Port for the caching mirror to listen on (default: pick "
+        "a free port)", type=int, default=0)
+    parser.add_argument(
+        '--stall-timeout', help="Kill and retry a virt-install if the install VM "
+        "makes no progress (disk, network or CPU activity) for this many seconds "
+        "(default: %(default)s)", type=int, default=900)
+    parser.add_argument(
+        '--install-timeout', help="Kill and retry a virt-install that hasn't finished "
+        "after this many seconds, even if it is still making progress (default: "
+        "%(default)s; 0 for no limit)", type=int, default=3600)
+    parser.add_argument(
+        '--dry-run', help="When creating images, just run the preflight checks and "
+        "show what would be built, how much disk space and time that should take, "
+        "and any problems, without changing anything. For 'gc', just show what "
+        "would be removed", action='store_true')
+    parser.add_argument(
+        '--events', help="Append a JSON line to this file for each timed phase "
+        "of each image build (see README)", metavar='FILE')
+
+def _subcommand(argv):
+    """Find which subcommand the command line 'argv' runs, without
+    building the full parser. Returns None if we can't tell.
+    """
+    parser = argparse.ArgumentParser(add_help=False, exit_on_error=False)
+    _add_global_args(parser)
+    parser.add_argument('subcommand', nargs='?')
+    parser.add_argument('rest', nargs=argparse.REMAINDER)
+    try:
+        return parser.parse_known_args(argv)[0].subcommand
+    except (argparse.ArgumentError, SystemExit):
+        return None
+
+def parse_args(hdds, argv=None):
+    """Parse arguments with argparse. 'argv' defaults to sys.argv."""
+    parser = argparse.ArgumentParser(description=(
+        "Tool for creating hard disk images for Rocky Linux openQA."))
+    _add_global_args(parser)
 
     # This is a workaround for a somewhat infamous argparse bug
     # in Python 3. See:
@@ -733,8 +5109,39 @@ def parse_args(hdds):
         "- this determines what releases some images will be built for. If "
         "not set or set to 0, createhdds will try to discover it when needed",
         type=int, default=0)
+    parser_all.add_argument(
+        '--budget', help="Only rebuild as many outdated images as fit in this "
+        "budget: a time (like 6h, 90m or 600s, going by how long each image took "
+        "to build last time and spread over --jobs) or a number of images. Missing "
+        "images are always built. The most overdue images go first, and spare "
+        "budget is used to rebuild images that will go out of date soon. Ignored "
+        "with --delete", type=parse_budget)
+    parser_all.add_argument(
+        '--prometheus', help="Write a summary of the run (time spent in each "
+        "phase, images built and failed) to this file in the Prometheus text "
+        "format, e.g. for the node_exporter textfile collector", metavar='FILE')
     parser_all.set_defaults(func=cli_all)
 
+    parser_watch = subparsers.add_parser(
+        'watch', description="Keep running, watching hdds.json, the kickstarts "
+        "and the upload files, and rebuild just the images a change affects "
+        "when they change.")
+    parser_watch.add_argument(
+        '-n', '--nextrel', help="The release to treat as the 'next' release "
+        "- this determines what releases some images will be built for. If "
+        "not set or set to 0, createhdds will try to discover it when needed",
+        type=int, default=0)
+    parser_watch.add_argument(
+        '--debounce', help="Wait until nothing has changed for this many seconds "
+        "before rebuilding (default: %(default)s)", type=float, default=5)
+    parser_watch.add_argument(
+        '--interval', help="Where inotify isn't available, check for changes "
+        "this often, in seconds (default: %(default)s)", type=float, default=5)
+    parser_watch.add_argument(
+        '--status', help="Keep the current status in this file, as JSON (default: "
+        "%(default)s)", metavar='FILE', default='.createhdds-watch.json')
+    parser_watch.set_defaults(func=cli_watch)
+
     parser_check = subparsers.add_parser(
         'check', description="Check status of existing image files.")
     parser_check.add_argument(
@@ -748,14 +5155,102 @@ def parse_args(hdds):
     parser_check.add_argument(
         '-c', '--clean', help="Remove unknown (usually old) images",
         action='store_true')
+    parser_check.add_argument(
+        '-s', '--sizes', help="Also show the apparent and allocated (on disk) size "
+        "of each image file", action='store_true')
+    parser_check.add_argument(
+        '-f', '--format', help="Output format: 'text' (the default) or 'json'",
+        choices=('text', 'json'), default='text')
     parser_check.set_defaults(func=cli_check)
 
+    parser_gc = subparsers.add_parser(
+        'gc', description="Remove images from the image store that no expected "
+        "image needs any more.")
+    parser_gc.add_argument(
+        '-n', '--nextrel', help="The release to treat as the 'next' release "
+        "- this determines what releases some images are expected to exist for. If "
+        "not set or set to 0, createhdds will try to discover it when needed",
+        type=int, default=0)
+    parser_gc.set_defaults(func=cli_gc)
+
+    parser_checksum = subparsers.add_parser(
+        'checksum', description="Write SHA-256 checksums of all the image files to "
+        "{0}, hashing only the images that have changed since they were last "
+        "hashed. Images are hashed as they are built, too. Use --jobs to hash "
+        "more than one image at once.".format(SUMSFILE))
+    parser_checksum.add_argument(
+        '-f', '--force', help="Hash all the images, even if they haven't changed",
+        action='store_true')
+    parser_checksum.set_defaults(func=cli_checksum)
+
+    parser_verify = subparsers.add_parser(
+        'verify', description="Check the images that are present contain what "
+        "hdds.json says they should: partition tables, filesystems, files, and "
+        "for virt-install images, a bootable operating system. Use --jobs to "
+        "spread the images over that many guestfs appliances.")
+    parser_verify.add_argument(
+        'images', help="Only verify these image files (default: all the expected "
+        "images that are present)", nargs='*', metavar='IMAGE')
+    parser_verify.add_argument(
+        '-n', '--nextrel', help="The release to treat as the 'next' release "
+        "- this determines what releases some images are expected to exist for. If "
+        "not set or set to 0, createhdds will try to discover it when needed",
+        type=int, default=0)
+    parser_verify.add_argument(
+        '-f', '--format', help="Output format: 'text' (the default) or 'json'",
+        choices=('text', 'json'), default='text')
+    parser_verify.set_defaults(func=cli_verify)
+
+    parser_history = subparsers.add_parser(
+        'history', description="Report how long building each image has taken, "
+        "and how often it failed or needed retrying, from the build history, "
+        "slowest first. Images whose last build was much slower than usual "
+        "are marked 'slow', and those that failed or were retried 'flaky'.")
+    parser_history.add_argument(
+        'images', help="Only report on these image files (default: all of them)",
+        nargs='*', metavar='IMAGE')
+    parser_history.add_argument(
+        '-d', '--days', help="Only look at builds from the last DAYS days (0 for all "
+        "of them; default %(default)s)", type=int, default=30)
+    parser_history.add_argument(
+        '-p', '--problems', help="Only report slow or flaky images", action='store_true')
+    parser_history.add_argument(
+        '-f', '--format', help="Output format: 'text' (the default) or 'json'",
+        choices=('text', 'json'), default='text')
+    parser_history.set_defaults(func=cli_history)
+
+    parser_sync = subparsers.add_parser(
+        'sync', description="Copy the images to one or more other directories or "
+        "hosts, sending only the blocks that have changed since the last sync.")
+    parser_sync.add_argument(
+        'targets', help="Target directory, or [user@]host:directory to sync to "
+        "another host over ssh", nargs='+', metavar='TARGET')
+    parser_sync.add_argument(
+        '-n', '--nextrel', help="The release to treat as the 'next' release "
+        "- this determines what releases some images are expected to exist for. If "
+        "not set or set to 0, createhdds will try to discover it when needed",
+        type=int, default=0)
+    parser_sync.add_argument(
+        '--remote-command', help="How to run createhdds on the target hosts "
+        "(default: %(default)s)", default='createhdds.py')
+    parser_sync.set_defaults(func=cli_sync)
+
+    parser_receive = subparsers.add_parser(
+        'sync-receive', description="The receiving end of 'sync' to another host; "
+        "run by 'sync' over ssh.")
+    parser_receive.add_argument('directory', help="Directory to sync into")
+    parser_receive.set_defaults(func=cli_sync_receive)
+
     # This here is somewhat clever-clever: we generate a subcommand for
     # each image group listed in hdds.json, which can be used to build
     # image(s) from that group. For guestfs image groups, we also check
     # if the group has multiple labels and/or filesystems by default,
     # and add arguments to limit image creation to just a single label
-    # and/or filesystem.
+    # and/or filesystem. That takes a while with a lot of groups, so if
+    # we can see the command line is for one of the subcommands above
+    # (like 'check', which gets run a lot), we skip it
+    if _subcommand(sys.argv[1:] if argv is None else argv) in subparsers.choices:
+        return parser.parse_args(argv)
     for imggrp in hdds['guestfs']:
         imgparser = subparsers.add_parser(
             imggrp['name'], description="Create {0} image(s)".format(imggrp['name']))
@@ -796,7 +5291,7 @@ def parse_args(hdds):
         # Here we're stuffing the type of the image and the dict from
         # hdds into args for cli_image() to use.
         imgparser.set_defaults(imggrp=('virtinstall', imggrp))
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 def main():
     """Main loop - set up logging, parse args, run subcommand
@@ -805,10 +5300,17 @@ def main():
     try:
         with open('{0}/hdds.json'.format(SCRIPTDIR), 'r') as fout:
             hdds = json.load(fout)
+        # the subcommands are built from hdds.json, so this has to be
+        # checked before anything else
+        errors = validate_hdds(hdds)
+        if errors:
+            sys.exit("hdds.json is not valid:\n  {0}".format('\n  '.join(errors)))
         args = parse_args(hdds)
         loglevel = getattr(
             logging, args.loglevel.upper(), logging.INFO)
         logging.basicConfig(level=loglevel)
+        if args.events:
+            METRICS.open_events(args.events)
         args.func(args, hdds)
     except KeyboardInterrupt:
         sys.stderr.write("Interrupted, exiting...\n")
@@ -0,0 +1,169 @@
+"""Tests for building guestfs images without an appliance
+(GuestfsImage.create_direct() and write_partition_table()): the
+partition tables, filesystems and files must be what hdds.json asks
+for, and what the guestfs appliance builds. Needs mke2fs, debugfs and
+blkid; the comparison with the appliance also needs libguestfs.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import bench
+import createhdds
+
+try:
+    import guestfs
+except ImportError:
+    guestfs = None
+
+TOOLS = all(shutil.which(tool) for tool in ('mke2fs', 'debugfs', 'blkid'))
+
+
+def get_images(name, label=None):
+    """The images of the guestfs group 'name' in hdds.json (just those
+    with the given disk label, if 'label' is set).
+    """
+    with open(os.path.join(TOPDIR, 'hdds.json'), 'r') as hddsfh:
+        hdds = json.load(hddsfh)
+    grp = [grp for grp in hdds['guestfs'] if grp['name'] == name][0]
+    return [img for img in createhdds.get_guestfs_images(grp)
+            if label is None or img.label == label]
+
+
+@unittest.skipUnless(TOOLS, "needs mke2fs, debugfs and blkid")
+class TestDirect(unittest.TestCase):
+    """Build images with create_direct() and check what's in them."""
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.oldscriptdir = createhdds.SCRIPTDIR
+        self.workdir = tempfile.mkdtemp(prefix='createhdds-test-')
+        os.chdir(self.workdir)
+        createhdds.SCRIPTDIR = TOPDIR
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        createhdds.SCRIPTDIR = self.oldscriptdir
+        shutil.rmtree(self.workdir)
+
+    def build(self, img):
+        """Build 'img' directly and describe it (see
+        bench.describe_image()).
+        """
+        self.assertTrue(img.direct)
+        self.assertEqual(img.preflight(), [])
+        img.create_direct()
+        return bench.describe_image(img)
+
+    def check_image(self, img, desc):
+        """Check the description 'desc' of the built image 'img'
+        against its hdds.json definition.
+        """
+        self.assertEqual(os.path.getsize(img.filename), img.size)
+        self.assertEqual(desc['label'], img.label)
+        ptype = createhdds.GPT_LINUX if img.label == 'gpt' else '83'
+        self.assertEqual(desc['parts'], [(start, end, ptype) for (_, start, end)
+                                         in img.sectors()])
+        for (num, (part, fsdesc)) in enumerate(zip(img.parts, desc['filesystems']), 1):
+            self.assertEqual(fsdesc['type'], part.get('filesystem', img.filesystem))
+            self.assertEqual(fsdesc['label'], part.get('label'))
+            expected = {}
+            for write in img.writes:
+                if int(write['part']) == num:
+                    expected[write['path']] = write['content'].encode()
+            for upload in img.uploads:
+                if int(upload['part']) == num:
+                    with open(os.path.join(TOPDIR, 'uploads', upload['source']), 'rb') as srcfh:
+                        expected[upload['target']] = srcfh.read()
+            self.assertEqual(fsdesc['files'], expected)
+            # the root directory listing is (mode, uid, gid, name)
+            owners = dict((entry[3], entry[:3]) for entry in fsdesc['root'])
+            for path in expected:
+                self.assertEqual(owners[path.lstrip('/')], ('100644', '0', '0'))
+
+    def test_ks(self):
+        """ks-8: one MBR partition to the end of the disk, with three
+        uploaded kickstarts.
+        """
+        (img,) = get_images('ks-8')
+        self.check_image(img, self.build(img))
+
+    def test_updates_img(self):
+        """updates_img: a labelled filesystem with an uploaded file."""
+        (img,) = get_images('updates_img')
+        self.check_image(img, self.build(img))
+
+    def test_freespace_gpt(self):
+        """freespace_gpt: a GPT disk with free space after the one
+        partition, whose backup header must be intact.
+        """
+        (img,) = get_images('freespace', label='gpt')
+        self.check_image(img, self.build(img))
+        with open(img.filename, 'rb') as imgfh:
+            imgfh.seek(img.size - 512)
+            self.assertEqual(imgfh.read(8), b'EFI PART')
+
+    @unittest.skipUnless(guestfs, "needs the libguestfs Python bindings")
+    def test_same_as_appliance(self):
+        """The three images come out the same with the appliance."""
+        for img in get_images('ks-8') + get_images('updates_img') + \
+                get_images('freespace', label='gpt'):
+            with self.subTest(image=img.filename):
+                direct = self.build(img)
+                os.remove(img.filename)
+                self.assertEqual(createhdds.create_guestfs_images([img]), [])
+                appliance = bench.describe_image(img)
+                os.remove(img.filename)
+                self.assertEqual(direct, appliance)
+
+
+class TestPartitionTable(unittest.TestCase):
+    """write_partition_table() and the preflight checks on GPT disks."""
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='createhdds-test-')
+        os.close(fd)
+        self.size = 10 * 1024 * 1024
+        os.truncate(self.path, self.size)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_gpt_backup_overlap(self):
+        """A GPT partition may not run into the backup table."""
+        sectors = self.size // 512
+        with self.assertRaises(ValueError):
+            createhdds.write_partition_table(self.path, self.size, 'gpt',
+                                             [(2048, sectors - 1, None)])
+        createhdds.write_partition_table(self.path, self.size, 'gpt',
+                                         [(2048, sectors - 34, None)])
+        self.assertEqual(bench.read_partition_table(self.path),
+                         ('gpt', [(2048, sectors - 34, createhdds.GPT_LINUX)]))
+
+    def test_gpt_preflight(self):
+        """Preflight rejects a GPT partition ending at -1, and accepts
+        one ending at -34.
+        """
+        grp = {'name': 'test', 'size': '10M', 'labels': ['gpt'],
+               'parts': [{'type': 'p', 'start': '2048', 'end': '-1'}]}
+        (img,) = createhdds.get_guestfs_images(grp)
+        self.assertEqual(len(img.preflight()), 1)
+        grp['parts'][0]['end'] = '-34'
+        (img,) = createhdds.get_guestfs_images(grp)
+        self.assertEqual(img.preflight(), [])
+
+    def test_mbr(self):
+        """MBR entries have the Linux type and the right sectors."""
+        createhdds.write_partition_table(self.path, self.size, 'mbr',
+                                         [(2048, 10239, None), (10240, 20479, None)])
+        self.assertEqual(bench.read_partition_table(self.path),
+                         ('mbr', [(2048, 10239, '83'), (10240, 20479, '83')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Tests for kickstart_delta(), which works out how to derive an image
+from its base image's kickstart: it must refuse %packages differences
+it can't apply to an installed system.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import createhdds
+
+BASE = """text
+rootpw --plaintext weakpassword
+%packages
+@core
+vim-enhanced
+-plymouth
+%end
+"""
+
+
+class TestKickstartDelta(unittest.TestCase):
+    """Derive kickstarts with different %packages from BASE."""
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='createhdds-test-')
+        self.base = self.kickstart('base.ks', BASE)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def kickstart(self, name, content):
+        """Write a kickstart and return its path."""
+        path = os.path.join(self.workdir, name)
+        with open(path, 'w') as ksfh:
+            ksfh.write(content)
+        return path
+
+    def delta(self, packages):
+        """kickstart_delta() from BASE to BASE with its %packages
+        lines replaced by 'packages'.
+        """
+        content = BASE.replace("@core\nvim-enhanced\n-plymouth\n", "\n".join(packages) + "\n")
+        return createhdds.kickstart_delta(self.base, self.kickstart('ks.ks', content))
+
+    def test_added(self):
+        """Added packages are installed, added '-pkg' lines removed."""
+        (args, scripts) = self.delta(["@core", "vim-enhanced", "-plymouth", "tmux", "-chrony"])
+        self.assertEqual(args, ["--install", "tmux", "--uninstall", "chrony"])
+        self.assertEqual(scripts, [])
+
+    def test_dropped(self):
+        """A package the base installs and ks just leaves out can't be
+        derived.
+        """
+        with self.assertRaises(ValueError):
+            self.delta(["@core", "-plymouth"])
+
+    def test_dropped_exclusion(self):
+        """Nor can a package the base excludes and ks doesn't."""
+        with self.assertRaises(ValueError):
+            self.delta(["@core", "vim-enhanced"])
+
+    def test_flipped(self):
+        """A package ks explicitly removes or installs instead is fine."""
+        (args, _) = self.delta(["@core", "-vim-enhanced", "plymouth"])
+        self.assertEqual(args, ["--install", "plymouth", "--uninstall", "vim-enhanced"])
+
+
+if __name__ == '__main__':
+    unittest.main()
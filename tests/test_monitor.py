@@ -0,0 +1,75 @@
+"""Tests for InstallMonitor, run against bench.py's fake libvirt and
+virt-install: the monitor must see progress in an install that is
+making some, and must not mistake a failure to sample the domain for
+the domain not being there.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import bench
+import createhdds
+
+
+class TestInstallMonitor(unittest.TestCase):
+    """Watch fake installs with a short interval and stall window."""
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.oldpath = os.environ.get('PATH', '')
+        self.oldmodules = dict((name, sys.modules.get(name)) for name in ('guestfs', 'libvirt'))
+        self.workdir = tempfile.mkdtemp(prefix='createhdds-test-')
+        bench.install_fakes(self.workdir, {'virt-install': 1.5})
+        os.chdir(self.workdir)
+        self.ctx = createhdds.BuildContext()
+
+    def tearDown(self):
+        self.ctx.close()
+        os.chdir(self.olddir)
+        os.environ['PATH'] = self.oldpath
+        for (name, module) in self.oldmodules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        shutil.rmtree(self.workdir)
+
+    def install(self, disk):
+        """Run the fake virt-install on 'disk.tmp' and watch it with
+        the monitor sampling the disk 'disk'. Returns the monitor.
+        """
+        proc = subprocess.Popen(["virt-install", "--disk", "size=0.001,path=disk.tmp",
+                                 "--name", "test"])
+        monitor = createhdds.InstallMonitor(self.ctx, "test", "disk.img", disk, proc, 0.5,
+                                            limit=30, interval=0.05, report=60)
+        monitor.start()
+        try:
+            self.assertEqual(proc.wait(), 0)
+        finally:
+            monitor.stop()
+        return monitor
+
+    def test_progress(self):
+        """An install that keeps writing to its disk isn't killed."""
+        monitor = self.install(os.path.abspath("disk.tmp"))
+        self.assertIsNone(monitor.stalled)
+
+    def test_sample_failure(self):
+        """If the domain's disk can't be sampled (libvirt only knows
+        it by its absolute path), the install isn't killed as if the
+        domain never started.
+        """
+        with self.assertLogs(createhdds.logger, 'WARNING') as logs:
+            monitor = self.install("disk.tmp")
+        self.assertIsNone(monitor.stalled)
+        self.assertIn("Can't sample install progress", logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()